@@ -49,3 +49,145 @@ def gui(config, operator):
     from dug_seis.graphical_interface.main import launch
 
     launch(config=config, operator=operator)
+
+
+@cli.command("build-cache")
+@click.option(
+    "--config",
+    required=True,
+    metavar="<config_file>",
+    help="Path to the DUGSeis configuration file.",
+)
+@click.option(
+    "--num-workers",
+    type=int,
+    default=None,
+    metavar="<num_workers>",
+    help="Number of processes to use. Defaults to the number of CPUs.",
+)
+def build_cache(config, num_workers):
+    """
+    Create or update the waveform caches of a project.
+
+    Useful to warm the caches before anybody opens the project in the GUI.
+    """
+    import os
+
+    from dug_seis.project.project import DUGSeisProject
+    from dug_seis.util import setup_logging_to_file
+
+    setup_logging_to_file()
+
+    project = DUGSeisProject(config=config)
+    project.config["waveform_handler"]["num_workers"] = (
+        num_workers if num_workers is not None else os.cpu_count()
+    )
+    wh = project.waveforms
+    click.echo(
+        f"Waveform caches of {len(wh._files)} file(s) with {len(wh.receivers)} "
+        "channel(s) are up-to-date."
+    )
+
+
+@cli.command()
+@click.option(
+    "--config",
+    required=True,
+    metavar="<config_file>",
+    help="Path to the DUGSeis configuration file.",
+)
+@click.option(
+    "--output",
+    required=True,
+    type=click.Path(file_okay=False),
+    metavar="<folder>",
+    help="Empty or not yet existing output folder.",
+)
+@click.option(
+    "--chunk-duration",
+    type=float,
+    default=60.0,
+    show_default=True,
+    metavar="<seconds>",
+    help="Duration of each chunk in seconds.",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["none", "zlib", "bz2", "lzma"]),
+    default="none",
+    show_default=True,
+    help="Lossless compression of the chunks.",
+)
+def transcode(config, output, chunk_duration, compression):
+    """
+    Convert the waveforms of a project into a chunked store.
+
+    All channels are stored together in chunks of a fixed duration, so
+    reading a window of many channels only touches a few files. Point
+    `paths.asdf_folders` to the output folder and set
+    `waveform_handler.backend` to "chunked" to use it.
+    """
+    from dug_seis.project.project import DUGSeisProject
+    from dug_seis.util import setup_logging_to_file
+    from dug_seis.waveform_handler.backends import write_chunked_store
+
+    setup_logging_to_file()
+
+    project = DUGSeisProject(config=config)
+    write_chunked_store(
+        waveforms=project.waveforms,
+        folder=output,
+        chunk_duration_in_seconds=chunk_duration,
+        compression=None if compression == "none" else compression,
+        progress=True,
+    )
+    click.echo(f"Wrote chunked waveform store to '{output}'.")
+
+
+@cli.command("serve-waveforms")
+@click.option(
+    "--config",
+    required=True,
+    metavar="<config_file>",
+    help="Path to the DUGSeis configuration file.",
+)
+@click.option(
+    "--address",
+    default=None,
+    metavar="<address>",
+    help="'host:port' or path of a Unix socket. Defaults to "
+    "`waveform_handler.server_address` of the configuration.",
+)
+def serve_waveforms(config, address):
+    """
+    Share the waveforms of a project with other processes.
+
+    Other DUGSeis processes with the same `waveform_handler.server_address`
+    use this process' index and caches instead of opening the waveforms
+    themselves.
+    """
+    from dug_seis.project.project import DUGSeisProject
+    from dug_seis.util import setup_logging_to_file
+    from dug_seis.waveform_handler.server import WaveformServer
+
+    setup_logging_to_file()
+
+    project = DUGSeisProject(config=config)
+    address = address or project.config["waveform_handler"]["server_address"]
+    if not address:
+        raise click.UsageError("No address given.")
+    # Open the waveforms here and not through another server.
+    project.config["waveform_handler"]["server_address"] = None
+    server = WaveformServer(
+        waveforms=project.waveforms,
+        address=address,
+        authkey=project._waveform_server_authkey,
+        allow_remote=project.config["waveform_handler"]["server_allow_remote"],
+    )
+    click.echo(f"Serving waveforms on {server.address}. Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
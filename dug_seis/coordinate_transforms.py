@@ -47,11 +47,14 @@ the nominal sea level given by the WGS84 ellipsoid. This is slightly different
 from the usual convention in StationXML files to set the elevation to the
 height of the local surface and the depth the burial beneath that.
 """
+
 import functools
 import typing
 
 import numpy as np
-import pyproj
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    import pyproj
 
 # For convenience.
 EPSG_CODES = {
@@ -66,7 +69,7 @@ EPSG_CODES = {
 @functools.lru_cache(maxsize=128)
 def _get_transformer(
     source_epsg_code: int, target_epsg_code: int
-) -> pyproj.Transformer:
+) -> "pyproj.Transformer":
     """
     Helper function returning a pyproj Transformer object. The function caches
     the transformer creation so repeated calls are cheap.
@@ -75,6 +78,9 @@ def _get_transformer(
         source_epsg_code: EPSG code for the source reference system.
         target_epsg_code: EPSG code for the target reference system.
     """
+    # Imported here as most runs never need it.
+    import pyproj
+
     return pyproj.Transformer.from_crs(source_epsg_code, target_epsg_code)
 
 
@@ -164,3 +170,119 @@ def global_to_local(
         return new_p - np.array(translation_vector)
     else:
         return new_p
+
+
+def _to_points(
+    points: typing.Union[typing.List[typing.Sequence[float]], np.ndarray],
+) -> np.ndarray:
+    """
+    Make sure points are a (N, 3) float array.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if not points.size:
+        return points.reshape((0, 3))
+    if points.ndim != 2 or points.shape[1] != 3:
+        raise ValueError(
+            f"Points must be an array of shape (N, 3), not {points.shape}."
+        )
+    return points
+
+
+def local_to_global_array(
+    *,
+    local_crs: typing.Union[int, str],
+    global_crs: typing.Union[int, str],
+    translation_vector: typing.Optional[
+        typing.Union[typing.Tuple[float, float, float], typing.List[float], np.ndarray]
+    ] = None,
+    points: typing.Union[typing.List[typing.Sequence[float]], np.ndarray],
+) -> np.ndarray:
+    """
+    Same as `local_to_global()` but for many points at once.
+
+    Converting all points with a single call is much faster than converting
+    them one after another.
+
+    Args:
+        local_crs: The local coordinate reference system either as a string or a
+            EPSG code.
+        global_crs: The local coordinate reference system either as a string or a
+            EPSG code.
+        translation_vector: The translation vector.
+        points: The points to convert as an array of shape (N, 3).
+
+    Returns:
+        The converted points as an array of shape (N, 3).
+    """
+    if not isinstance(local_crs, int):
+        local_crs = EPSG_CODES[local_crs]
+
+    if not isinstance(global_crs, int):
+        global_crs = EPSG_CODES[global_crs]
+
+    points = _to_points(points)
+    if translation_vector is not None:
+        points = points + np.array(translation_vector, dtype=np.float64)
+
+    if not len(points):
+        return np.empty((0, 3), dtype=np.float64)
+
+    transformer = _get_transformer(
+        source_epsg_code=local_crs, target_epsg_code=global_crs
+    )
+
+    return np.stack(
+        transformer.transform(xx=points[:, 0], yy=points[:, 1], zz=points[:, 2]),
+        axis=1,
+    )
+
+
+def global_to_local_array(
+    *,
+    local_crs: typing.Union[int, str],
+    global_crs: typing.Union[int, str],
+    translation_vector: typing.Optional[
+        typing.Union[typing.Tuple[float, float, float], typing.List[float], np.ndarray]
+    ] = None,
+    points: typing.Union[typing.List[typing.Sequence[float]], np.ndarray],
+) -> np.ndarray:
+    """
+    Same as `global_to_local()` but for many points at once.
+
+    Converting all points with a single call is much faster than converting
+    them one after another.
+
+    Args:
+        local_crs: The local coordinate reference system either as a string or a
+            EPSG code.
+        global_crs: The local coordinate reference system either as a string or a
+            EPSG code.
+        translation_vector: The translation vector.
+        points: The points to convert as an array of shape (N, 3).
+
+    Returns:
+        The converted points as an array of shape (N, 3).
+    """
+    if not isinstance(local_crs, int):
+        local_crs = EPSG_CODES[local_crs]
+
+    if not isinstance(global_crs, int):
+        global_crs = EPSG_CODES[global_crs]
+
+    points = _to_points(points)
+    if not len(points):
+        return np.empty((0, 3), dtype=np.float64)
+
+    transformer = _get_transformer(
+        source_epsg_code=global_crs, target_epsg_code=local_crs
+    )
+
+    new_p = np.stack(
+        transformer.transform(xx=points[:, 0], yy=points[:, 1], zz=points[:, 2]),
+        axis=1,
+    )
+
+    if translation_vector is not None:
+        return new_p - np.array(translation_vector, dtype=np.float64)
+    else:
+        return new_p
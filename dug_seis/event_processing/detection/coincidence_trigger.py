@@ -25,8 +25,6 @@ import warnings
 import numpy as np
 
 from obspy import UTCDateTime
-from obspy.signal.trigger import trigger_onset
-from obspy.signal.cross_correlation import templates_max_similarity
 
 
 def coincidence_trigger(
@@ -142,6 +140,10 @@ def coincidence_trigger(
     :rtype: list
     :returns: List of event triggers sorted chronologically.
     """
+    # obspy.signal pulls in matplotlib and scipy - only import it when needed.
+    from obspy.signal.cross_correlation import templates_max_similarity
+    from obspy.signal.trigger import trigger_onset
+
     st = stream.copy()
     # if no trace ids are specified use all traces ids found in stream
     if trace_ids is None:
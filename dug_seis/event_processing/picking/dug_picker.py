@@ -17,16 +17,15 @@
 """
 Central picking routine in DUGSeis.
 """
+
 import typing
 
 import obspy
 from obspy.core.event import WaveformStreamID, Pick
-from obspy.signal.trigger import recursive_sta_lta, trigger_onset
 
-from .pickers.PhasePApy_Austin_Holland.fbpicker import FBPicker
-from .pickers.PhasePApy_Austin_Holland.ktpicker import KTPicker
-from .pickers.PhasePApy_Austin_Holland.aicdpicker import AICDPicker
-from .pickers.P_Phase_Picker_USGS.pphasepicker import pphasepicker
+# The pickers and obspy.signal are imported in the branches using them.
+# Together they pull in matplotlib, scipy, and pyasdf which most runs do not
+# need.
 
 
 def dug_picker(
@@ -51,6 +50,8 @@ def dug_picker(
 
     # apply the fb picker.
     if pick_algorithm == "fb":
+        from .pickers.PhasePApy_Austin_Holland.fbpicker import FBPicker
+
         t_long = 5 / 1000
         freqmin = 1
         mode = "rms"
@@ -111,6 +112,7 @@ def dug_picker(
 
     # apply the kt (kurtosis) picker.
     elif pick_algorithm == "kt":
+        from .pickers.PhasePApy_Austin_Holland.ktpicker import KTPicker
 
         t_win = 1 / 2000
         t_ma = 10 / 2000
@@ -163,6 +165,8 @@ def dug_picker(
 
     # apply the AICD picker - has to be fixed at a lower level.
     elif pick_algorithm == "aicd":
+        from .pickers.PhasePApy_Austin_Holland.aicdpicker import AICDPicker
+
         st = st.copy().filter(
             "bandpass",
             freqmin=picker_opts["bandpass_f_min"],
@@ -214,6 +218,8 @@ def dug_picker(
 
     # apply the P Phase picker.
     elif pick_algorithm == "pphase":
+        from .pickers.P_Phase_Picker_USGS.pphasepicker import pphasepicker
+
         Tn = 0.01
         xi = 0.6
 
@@ -252,6 +258,8 @@ def sta_lta(stream, st_window, lt_window, thresholds):
     """
     Apply the STA LTA picker
     """
+    from obspy.signal.trigger import recursive_sta_lta, trigger_onset
+
     stream.detrend("constant")
     # stream.filter("bandpass", freqmin=1000.0, freqmax=20000.0)
     sampling_rate = stream[0].stats.sampling_rate
@@ -175,10 +175,20 @@ def virginie_picker(
         # workers.
         # Import here to not depend on joblib.
         from joblib import Parallel, delayed  # NOQA
-
-        results = Parallel(n_jobs=number_of_parallel_jobs)(
-            delayed(virginie_picker_per_trace)(tr, *args) for tr in st
+        from ...waveform_handler.shared_buffers import (
+            SharedWaveformBlock,
+            call_with_shared_trace,
         )
+
+        # Workers map the data from shared memory instead of receiving a
+        # pickled copy of each trace.
+        with SharedWaveformBlock.from_stream(st) as block:
+            results = Parallel(n_jobs=number_of_parallel_jobs)(
+                delayed(call_with_shared_trace)(
+                    virginie_picker_per_trace, shared, *args
+                )
+                for shared in block.traces
+            )
     elif number_of_parallel_jobs == 1:
         # Fall back to a list-comprehension for serial execution - this makes
         # debugging the algorithm simpler as it does not run through joblib in
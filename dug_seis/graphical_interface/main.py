@@ -63,14 +63,16 @@ class ReloadDataWorker(QtCore.QObject):
     def run(self):
         try:
             self._run()
-        except Exception as e:
-            print(f"Failed running thread due to: {str(type(e))}: {e}")
+        except Exception:
+            # Logged with the traceback - otherwise new data silently stops
+            # showing up.
+            logger.exception("Failed to reload the waveform data.")
         self.finished.emit()
 
     def _run(self):
         try:
             self._mutex.lock()
-            self._project._load_waveforms()
+            self._project.refresh_waveforms()
         # Always release the lock.
         finally:
             self._mutex.unlock()
@@ -159,12 +161,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.data_monitoring_timer = QtCore.QTimer()
         self.data_monitoring_timer.timeout.connect(self.check_if_data_changed)
 
-        self.ui.show_only_events_with_m_origins_button.setStyleSheet(
-            """
+        self.ui.show_only_events_with_m_origins_button.setStyleSheet("""
             QPushButton{font-weight:400;}
             QPushButton:checked{font-weight:700; color:black}
-            """
-        )
+            """)
 
     def _init_3d_view(self, set_camera: bool = True):
         """
@@ -204,15 +204,11 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         Updates the events in the 3D view.
         """
-        event_coordinates = np.array(
-            [
-                self.project.global_to_local_coordinates(
-                    latitude=c["latitude"],
-                    longitude=c["longitude"],
-                    depth=c["depth"],
-                )
-                for c in self.event_summary
-            ]
+        # Convert all events at once - much faster for large catalogs.
+        event_coordinates = self.project.global_to_local_coordinates(
+            latitude=np.array([c["latitude"] for c in self.event_summary]),
+            longitude=np.array([c["longitude"] for c in self.event_summary]),
+            depth=np.array([c["depth"] for c in self.event_summary]),
         )
         origin_counts = [c["origin_count"] for c in self.event_summary]
         event_times = [c["origin_time"] for c in self.event_summary]
@@ -1207,11 +1203,15 @@ class MainWindow(QtWidgets.QMainWindow):
 
         if fct_name == "no filter":
             ff = None
+            filter_id = None
         else:
             ff = self.filter_functions[fct_name]
+            filter_id = fct_name
 
         for v in self.plots.values():
-            v["plot_object"].items[0].set_filter_function(filter_function=ff)
+            v["plot_object"].items[0].set_filter_function(
+                filter_function=ff, filter_id=filter_id
+            )
 
     @QtCore.Slot()
     def on_origin_selection_combo_box_currentIndexChanged(self, *args, **kwargs):
@@ -50,6 +50,7 @@ class WaveformPlotCurveItem(pg.PlotCurveItem):
         self.main_window = main_window
 
         self.filter_function = filter_function
+        self.filter_id = None
 
         # Always get the binned data.
         bd = list(self.wh.get_binned_index_data(channel_id=self.channel_id))
@@ -64,8 +65,19 @@ class WaveformPlotCurveItem(pg.PlotCurveItem):
         self.setData(x=self.binned_data[0], y=self.binned_data[1])
         self.currently_plotted = "binned_data"
 
-    def set_filter_function(self, filter_function: typing.Optional[typing.Callable]):
+    def set_filter_function(
+        self,
+        filter_function: typing.Optional[typing.Callable],
+        filter_id: typing.Optional[str] = None,
+    ):
+        """
+        Args:
+            filter_function: Function to filter a trace.
+            filter_id: If given, the filtered data comes from the cache of
+                the waveform handler instead.
+        """
         self.filter_function = filter_function
+        self.filter_id = filter_id
         self.updatePlot()
 
     def viewRangeChanged(self):
@@ -134,11 +146,19 @@ class WaveformPlotCurveItem(pg.PlotCurveItem):
             min_t = max(self.wh.starttime.timestamp, time_range[0] - duration)
             max_t = min(self.wh.endtime.timestamp, time_range[1] + duration)
             out = self.wh.get_waveform_data(
-                channel_id=self.channel_id, start_time=min_t, end_time=max_t, npts=30000
+                channel_id=self.channel_id,
+                start_time=min_t,
+                end_time=max_t,
+                npts=30000,
+                filter_id=self.filter_id if self.filter_function else None,
             )
 
             data = out["data"]
-            if self.filter_function and out["is_max_resolution"]:
+            if (
+                self.filter_function
+                and self.filter_id is None
+                and out["is_max_resolution"]
+            ):
                 tr = obspy.Trace(data=out["data"], header={"delta": out["delta"]})
                 data = self.filter_function(tr).data
 
@@ -20,18 +20,31 @@ Central DUGSeis project class.
 
 import functools
 import logging
+import os
 import pathlib
+import secrets
 import typing
 
-import matplotlib.pyplot as plt
 import numpy as np
 import obspy
 import schema
 import yaml
 
-from ..coordinate_transforms import local_to_global, global_to_local
-from ..waveform_handler.waveform_handler import WaveformHandler
-from ..db.db import DB
+from ..coordinate_transforms import (
+    local_to_global,
+    global_to_local,
+    local_to_global_array,
+    global_to_local_array,
+)
+from ..waveform_handler.backends import BACKENDS
+from ..waveform_handler.utils import FINGERPRINT_STRATEGIES
+from .stationxml import list_stationxml_files, load_channel_table, read_inventory
+
+# The waveform handler and the database pull in numba, scipy, and a lot more.
+# They are imported on first use so scripts only pay for what they need.
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from ..db.db import DB
+    from ..waveform_handler.waveform_handler import WaveformHandler
 
 
 def _is_valid_resource_id(r_id):
@@ -75,7 +88,10 @@ def _4c_float_array(a):
 def _colormap_or_color(a):
     # Colormap.
     if isinstance(a, str):
-        if a not in plt.colormaps():
+        # Importing pyplot would also load a GUI backend.
+        import matplotlib
+
+        if a not in matplotlib.colormaps:
             raise ValueError(
                 f"'{a}' must either be a color as 4 floats or a valid "
                 "matplotlib colormap."
@@ -108,6 +124,56 @@ _CONFIG_FILE_SCHEMA = schema.Schema(
             "cache_folder": schema.Use(_directory_exists),
             "database": str,
         },
+        schema.Optional(
+            "waveform_handler",
+            default={
+                "num_workers": 1,
+                "trace_cache_size_in_mb": 2048.0,
+                "filtered_cache_size_in_mb": 256.0,
+                "max_open_files": 20,
+                "index_pyramid_finest_decimation": 64,
+                "fingerprint": "sampled",
+                "backend": "asdf",
+                "server_address": None,
+                "server_authkey": None,
+                "server_allow_remote": False,
+                "max_cache_folder_size_in_mb": None,
+            },
+        ): {
+            # Number of processes used to index new waveform files.
+            schema.Optional("num_workers", default=1): int,
+            # Memory budget for decoded waveform data.
+            schema.Optional("trace_cache_size_in_mb", default=2048.0): schema.And(
+                schema.Use(float), lambda x: x >= 0
+            ),
+            # Memory budget for filtered waveform data.
+            schema.Optional("filtered_cache_size_in_mb", default=256.0): schema.And(
+                schema.Use(float), lambda x: x >= 0
+            ),
+            schema.Optional("max_open_files", default=20): int,
+            # Decimation of the finest level of the min/max pyramid. None to disable.
+            schema.Optional("index_pyramid_finest_decimation", default=64): schema.Or(
+                None, schema.And(int, lambda x: x > 1)
+            ),
+            # How to identify the contents of newly indexed waveform files.
+            schema.Optional("fingerprint", default="sampled"): schema.Or(
+                *FINGERPRINT_STRATEGIES
+            ),
+            # Format of the waveform files.
+            schema.Optional("backend", default="asdf"): schema.Or(*BACKENDS),
+            # Use the waveform handler of a `dug-seis serve-waveforms` process
+            # instead of opening the waveforms in this process.
+            schema.Optional("server_address", default=None): schema.Or(None, str),
+            # Shared secret of the server. Generated and stored in the cache
+            # folder if not given.
+            schema.Optional("server_authkey", default=None): schema.Or(None, str),
+            # Serve on addresses that are not loopback addresses.
+            schema.Optional("server_allow_remote", default=False): bool,
+            # Disk budget for the cache folder. None for no limit.
+            schema.Optional("max_cache_folder_size_in_mb", default=None): schema.Or(
+                None, schema.And(schema.Use(float), lambda x: x >= 0)
+            ),
+        },
         "temporal_range": {
             # Any valid time string or number or what not should work.
             "start_time": schema.Use(obspy.UTCDateTime),
@@ -285,11 +351,11 @@ class DUGSeisProject:
         # Load the StationXML files.
         self._load_stationxml_files()
 
-        self.__waveform_handler: typing.Optional[WaveformHandler] = None
-        self.__db: typing.Optional[DB] = None
+        self.__waveform_handler: typing.Optional["WaveformHandler"] = None
+        self.__db: typing.Optional["DB"] = None
 
     @property
-    def waveforms(self) -> WaveformHandler:
+    def waveforms(self) -> "WaveformHandler":
         """
         Access the project's waveform handler.
         """
@@ -299,7 +365,7 @@ class DUGSeisProject:
         return self.__waveform_handler
 
     @property
-    def db(self) -> DB:
+    def db(self) -> "DB":
         """
         Access the project's database.
         """
@@ -316,14 +382,55 @@ class DUGSeisProject:
         return {k: np.array(v["coordinates"]) for k, v in self.channels.items()}
 
     def _open_db(self):
+        from ..db.db import DB
+
         self.__db = DB(url=self.config["paths"]["database"])
 
+    def refresh_waveforms(self):
+        """
+        Pick up new waveform files. Only the new files are indexed - the
+        existing waveform handler is kept.
+        """
+        if self.__waveform_handler is None:
+            self._load_waveforms()
+            return
+        self.__waveform_handler.refresh()
+
+    @property
+    def _waveform_server_authkey(self) -> bytes:
+        """
+        The configured shared secret of the waveform server. Otherwise a
+        random one that is created once and stored in the cache folder, which
+        only processes of the same user can read.
+        """
+        key = self.config["waveform_handler"]["server_authkey"]
+        if key:
+            return key.encode()
+        filename = pathlib.Path(self.config["paths"]["cache_folder"]) / (
+            "waveform_server.key"
+        )
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return filename.read_bytes().strip()
+        with os.fdopen(fd, "wb") as f:
+            f.write(secrets.token_hex(32).encode())
+        return filename.read_bytes().strip()
+
     def _load_waveforms(self):
-        # Reuse caches if possible.
-        if self.__waveform_handler is not None:
-            existing_caches = self.__waveform_handler._individual_caches
-        else:
-            existing_caches = None
+        from ..waveform_handler.server import WaveformClient
+        from ..waveform_handler.waveform_handler import WaveformHandler
+
+        # The index is persistent in the cache folder so reloading only has
+        # to look at new files.
+        first_load = self.__waveform_handler is None
+
+        if self.config["waveform_handler"]["server_address"]:
+            self.__waveform_handler = WaveformClient(
+                address=self.config["waveform_handler"]["server_address"],
+                authkey=self._waveform_server_authkey,
+            )
+            return
 
         wh = WaveformHandler(
             waveform_folders=self.config["paths"]["asdf_folders"],
@@ -331,13 +438,35 @@ class DUGSeisProject:
             index_sampling_rate_in_hz=100,
             start_time=self.config["temporal_range"]["start_time"],
             end_time=self.config["temporal_range"]["end_time"],
-            existing_caches=existing_caches,
+            num_workers=self.config["waveform_handler"]["num_workers"],
+            trace_cache_size_in_bytes=int(
+                self.config["waveform_handler"]["trace_cache_size_in_mb"] * 1024**2
+            ),
+            max_open_files=self.config["waveform_handler"]["max_open_files"],
+            pyramid_finest_decimation=self.config["waveform_handler"][
+                "index_pyramid_finest_decimation"
+            ],
+            fingerprint=self.config["waveform_handler"]["fingerprint"],
+            backend=self.config["waveform_handler"]["backend"],
+            filters=self.config["filters"],
+            filtered_cache_size_in_bytes=int(
+                self.config["waveform_handler"]["filtered_cache_size_in_mb"] * 1024**2
+            ),
+            max_cache_folder_size_in_bytes=(
+                None
+                if self.config["waveform_handler"]["max_cache_folder_size_in_mb"]
+                is None
+                else int(
+                    self.config["waveform_handler"]["max_cache_folder_size_in_mb"]
+                    * 1024**2
+                )
+            ),
         )
 
         # Time to check that the data also corresponds to the StationXML
         # meta-data. Only do this the first time around to not clutter the
         # output.
-        if existing_caches is None:
+        if first_load:
             channels_in_data = set(wh.receivers)
             channels_in_meta_data = set(self.channels.keys())
 
@@ -435,21 +564,52 @@ class DUGSeisProject:
                 "translation_vector"
             ],
         )
+        self._local_to_global_array_transform = functools.partial(
+            local_to_global_array,
+            local_crs=v_config["local_coordinate_system"]["epsg_code"],
+            global_crs="WGS84",
+            translation_vector=v_config["local_coordinate_system"][
+                "translation_vector"
+            ],
+        )
+        self._global_to_local_array_transform = functools.partial(
+            global_to_local_array,
+            local_crs=v_config["local_coordinate_system"]["epsg_code"],
+            global_crs="WGS84",
+            translation_vector=v_config["local_coordinate_system"][
+                "translation_vector"
+            ],
+        )
 
         self.config = v_config
 
     def global_to_local_coordinates(
-        self, latitude: float, longitude: float, depth: float
+        self,
+        latitude: typing.Union[float, np.ndarray],
+        longitude: typing.Union[float, np.ndarray],
+        depth: typing.Union[float, np.ndarray],
     ) -> np.ndarray:
         """
         Convert WGS84 coordinates to the project's local coordinate system.
 
+        Arrays of coordinates are converted in one go and result in an array
+        of shape (N, 3). This is much faster than converting them one by one.
+
         Args:
             latitude: The WGS84 latitude in degrees.
             longitude: The WGS84 longitude in degrees.
             depth: The depth beneath the WGS84 ellipsoid in meters Positive is
                 down.
         """
+        if np.ndim(latitude) or np.ndim(longitude) or np.ndim(depth):
+            latitude, longitude, depth = np.broadcast_arrays(
+                np.asarray(latitude, dtype=np.float64),
+                np.asarray(longitude, dtype=np.float64),
+                np.asarray(depth, dtype=np.float64),
+            )
+            return self._global_to_local_array_transform(
+                points=np.stack([latitude, longitude, -depth], axis=1)
+            )
         return self._global_to_local_coordinate_transform(
             point=[latitude, longitude, -depth]
         )
@@ -464,67 +624,45 @@ class DUGSeisProject:
         Convert a point in the project's local Cartesian reference frame to
         WGS84. Will return latitude, longitude, depth beneath the ellipsoid.
 
+        An array of shape (N, 3) converts all points in one go and returns an
+        array of the same shape.
+
         Args:
             point: x, y, z of the point in the project's local reference frame.
                 z points up.
         """
+        if np.ndim(point) == 2:
+            p = self._local_to_global_array_transform(points=point)
+            p[:, -1] *= -1.0
+            return p
         p = list(self._local_to_global_coordinate_transform(point=point))
         p[-1] = -1.0 * p[-1]
         return tuple(p)
 
     def _load_stationxml_files(self):
         """
-        Read all StationXML files.
+        Load the channel table of all StationXML files.
 
-        Does some sanity checks and also extras the Cartesian coordinates.
+        Comes from the cache folder unless a StationXML file or the local
+        coordinate system changed. The full inventory is only read if needed,
+        see `inventory`.
         """
-        # First read all to a common inventory.
-        inv = obspy.core.inventory.Inventory()
-        for p in self.config["paths"]["stationxml_folders"]:
-            for f in p.glob("*.xml"):
-                inv += obspy.read_inventory(str(f))
-
-        # Keep the inventory around.
-        self.inventory = inv
-
-        channels = {}
-        # Now parse per channel but make sure each channel is there exactly
-        # once.
-        for network in inv.networks:
-            for station in network.stations:
-                for channel in station.channels:
-                    identifier = (
-                        f"{network.code}.{station.code}."
-                        f"{channel.location_code}.{channel.code}"
-                    )
-                    # Only one per channel.
-                    if identifier in channels:
-                        raise ValueError(
-                            f"Channel {identifier} exists multiple times in the "
-                            "StationXML files."
-                        )
-
-                    # Must have channel level coordinates. These are invalid.
-                    if channel.latitude == 0.0 and channel.longitude == 0.0:
-                        raise ValueError(
-                            f"Channel {identifier} does not have channel level "
-                            "coordinates. These must be available."
-                        )
-
-                    if channel.elevation != 0.0:
-                        raise ValueError(
-                            f"Channel {identifier}: The channel level elevation "
-                            "must be zero so the depth is with respect to the WGS84 "
-                            "ellipsoid."
-                        )
-
-                    channels[identifier] = {
-                        "coordinates": self.global_to_local_coordinates(
-                            latitude=channel.latitude,
-                            longitude=channel.longitude,
-                            depth=channel.depth,
-                        ),
-                        "channel_objects": channel,
-                    }
-
-        self.channels = channels
+        self.channels, self.__inventory = load_channel_table(
+            stationxml_folders=self.config["paths"]["stationxml_folders"],
+            cache_folder=self.config["paths"]["cache_folder"],
+            local_coordinate_system=self.config["local_coordinate_system"],
+            global_to_local=self.global_to_local_coordinates,
+            get_inventory=lambda: self.inventory,
+        )
+
+    @property
+    def inventory(self) -> obspy.Inventory:
+        """
+        All StationXML files of the project as a single inventory. Read on
+        first access.
+        """
+        if self.__inventory is None:
+            self.__inventory = read_inventory(
+                list_stationxml_files(self.config["paths"]["stationxml_folders"])
+            )
+        return self.__inventory
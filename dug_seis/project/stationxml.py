@@ -0,0 +1,278 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Channel table of a project derived from its StationXML files.
+
+Parsing response-rich StationXML files with ObsPy is slow. Everything DUGSeis
+needs at startup - the channel ids, their coordinates, and some basic meta
+data - is thus cached in a small JSON file in the cache folder. It is only
+rebuilt if a StationXML file is added, removed, or changed or if the local
+coordinate system of the project changes. The ObsPy channel objects are only
+resolved from the full inventory when they are accessed.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import typing
+
+import numpy as np
+import obspy
+
+logger = logging.getLogger(__name__)
+
+# Bump if the contents of the cache change.
+CHANNEL_TABLE_VERSION = 1
+
+CHANNEL_TABLE_FILENAME = "stationxml_channels.json"
+
+
+def list_stationxml_files(
+    folders: typing.List[pathlib.Path],
+) -> typing.List[pathlib.Path]:
+    """
+    All StationXML files in the given folders.
+    """
+    return sorted(f for p in folders for f in pathlib.Path(p).glob("*.xml"))
+
+
+def read_inventory(filenames: typing.List[pathlib.Path]) -> obspy.Inventory:
+    """
+    Read all StationXML files into a single inventory.
+    """
+    inv = obspy.core.inventory.Inventory()
+    for f in filenames:
+        inv += obspy.read_inventory(str(f))
+    return inv
+
+
+def build_channel_table(
+    inventory: obspy.Inventory,
+    global_to_local: typing.Callable[..., np.ndarray],
+) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """
+    Extract the channel table from an inventory.
+
+    Makes sure each channel exists exactly once and has valid channel level
+    coordinates.
+
+    Args:
+        inventory: The inventory.
+        global_to_local: Converts arrays of latitudes, longitudes, and depths
+            to an array of shape (N, 3) of local coordinates of the project.
+    """
+    channels = {}
+    for network in inventory.networks:
+        for station in network.stations:
+            for channel in station.channels:
+                identifier = (
+                    f"{network.code}.{station.code}."
+                    f"{channel.location_code}.{channel.code}"
+                )
+                # Only one per channel.
+                if identifier in channels:
+                    raise ValueError(
+                        f"Channel {identifier} exists multiple times in the "
+                        "StationXML files."
+                    )
+
+                # Must have channel level coordinates. These are invalid.
+                if channel.latitude == 0.0 and channel.longitude == 0.0:
+                    raise ValueError(
+                        f"Channel {identifier} does not have channel level "
+                        "coordinates. These must be available."
+                    )
+
+                if channel.elevation != 0.0:
+                    raise ValueError(
+                        f"Channel {identifier}: The channel level elevation "
+                        "must be zero so the depth is with respect to the WGS84 "
+                        "ellipsoid."
+                    )
+
+                channels[identifier] = {
+                    "latitude": float(channel.latitude),
+                    "longitude": float(channel.longitude),
+                    "depth": float(channel.depth),
+                    "sampling_rate": (
+                        None
+                        if channel.sample_rate is None
+                        else float(channel.sample_rate)
+                    ),
+                    "start_date": (
+                        None if channel.start_date is None else str(channel.start_date)
+                    ),
+                    "end_date": (
+                        None if channel.end_date is None else str(channel.end_date)
+                    ),
+                }
+
+    # Convert all coordinates in one go.
+    if channels:
+        coordinates = np.asarray(
+            global_to_local(
+                latitude=np.array([c["latitude"] for c in channels.values()]),
+                longitude=np.array([c["longitude"] for c in channels.values()]),
+                depth=np.array([c["depth"] for c in channels.values()]),
+            ),
+            dtype=np.float64,
+        )
+        for c, coords in zip(channels.values(), coordinates):
+            c["coordinates"] = coords
+    return channels
+
+
+class ChannelTableEntry(dict):
+    """
+    A single channel of the channel table.
+
+    The ``"channel_objects"`` item, the ObsPy channel object, is not part of
+    the cache. It is looked up in the inventory on first access.
+
+    Args:
+        channel_id: The SEED id of the channel.
+        values: The cached values of the channel.
+        get_inventory: Returns the inventory of the project.
+    """
+
+    def __init__(
+        self,
+        channel_id: str,
+        values: typing.Dict[str, typing.Any],
+        get_inventory: typing.Callable[[], obspy.Inventory],
+    ):
+        super().__init__(values)
+        self._channel_id = channel_id
+        self._get_inventory = get_inventory
+
+    def __missing__(self, key: str) -> typing.Any:
+        if key != "channel_objects":
+            raise KeyError(key)
+        network, station, location, channel = self._channel_id.split(".")
+        inv = self._get_inventory().select(
+            network=network, station=station, location=location, channel=channel
+        )
+        self[key] = inv[0][0][0]
+        return self[key]
+
+    def __reduce__(self):
+        # The inventory stays with the project.
+        return (dict, (dict(self),))
+
+
+def _get_cache_key(
+    filenames: typing.List[pathlib.Path], local_coordinate_system: typing.Dict
+) -> typing.Dict[str, typing.Any]:
+    """
+    Everything the channel table depends on.
+    """
+    files = []
+    for f in filenames:
+        s = f.stat()
+        files.append([str(pathlib.Path(f).absolute()), s.st_size, s.st_mtime_ns])
+    return {
+        "version": CHANNEL_TABLE_VERSION,
+        "files": files,
+        "local_coordinate_system": {
+            "epsg_code": local_coordinate_system["epsg_code"],
+            "translation_vector": [
+                float(i) for i in local_coordinate_system["translation_vector"]
+            ],
+        },
+    }
+
+
+def load_channel_table(
+    stationxml_folders: typing.List[pathlib.Path],
+    cache_folder: pathlib.Path,
+    local_coordinate_system: typing.Dict,
+    global_to_local: typing.Callable[..., np.ndarray],
+    get_inventory: typing.Callable[[], obspy.Inventory],
+) -> typing.Tuple[
+    typing.Dict[str, ChannelTableEntry], typing.Optional[obspy.Inventory]
+]:
+    """
+    Get the channel table of a project, from the cache if possible.
+
+    Args:
+        stationxml_folders: Folders with the StationXML files.
+        cache_folder: The project's cache folder.
+        local_coordinate_system: The ``local_coordinate_system`` section of
+            the project configuration.
+        global_to_local: Converts arrays of latitudes, longitudes, and depths
+            to the local coordinates of the project, see
+            `build_channel_table()`.
+        get_inventory: Returns the inventory of the project. Used to resolve
+            the ObsPy channel objects, see `ChannelTableEntry`.
+
+    Returns:
+        The channel table and the inventory if it had to be read to build the
+        table, otherwise `None`.
+    """
+    filenames = list_stationxml_files(stationxml_folders)
+    key = _get_cache_key(
+        filenames=filenames, local_coordinate_system=local_coordinate_system
+    )
+    cache_file = pathlib.Path(cache_folder) / CHANNEL_TABLE_FILENAME
+
+    try:
+        with open(cache_file, "r") as fh:
+            cached = json.load(fh)
+    except (OSError, ValueError):
+        cached = None
+    if cached is not None and cached.get("key") == key:
+        channels = cached["channels"]
+        for c in channels.values():
+            c["coordinates"] = np.array(c["coordinates"], dtype=np.float64)
+        return _to_entries(channels, get_inventory=get_inventory), None
+
+    logger.info(f"Reading {len(filenames)} StationXML file(s) ...")
+    inventory = read_inventory(filenames)
+    channels = build_channel_table(inventory=inventory, global_to_local=global_to_local)
+
+    # Write to a temporary file first so other processes never see a
+    # partially written cache.
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_file, "w") as fh:
+            json.dump(
+                {
+                    "key": key,
+                    "channels": {
+                        k: {**v, "coordinates": v["coordinates"].tolist()}
+                        for k, v in channels.items()
+                    },
+                },
+                fh,
+            )
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.warning(f"Could not cache the StationXML channel table: {e}")
+
+    return _to_entries(channels, get_inventory=get_inventory), inventory
+
+
+def _to_entries(
+    channels: typing.Dict[str, typing.Dict[str, typing.Any]],
+    get_inventory: typing.Callable[[], obspy.Inventory],
+) -> typing.Dict[str, ChannelTableEntry]:
+    return {
+        k: ChannelTableEntry(channel_id=k, values=v, get_inventory=get_inventory)
+        for k, v in channels.items()
+    }
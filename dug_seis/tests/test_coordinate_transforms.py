@@ -17,7 +17,12 @@
 import numpy as np
 import pytest
 
-from dug_seis.coordinate_transforms import local_to_global, global_to_local
+from dug_seis.coordinate_transforms import (
+    local_to_global,
+    global_to_local,
+    local_to_global_array,
+    global_to_local_array,
+)
 
 
 def test_local_to_global():
@@ -106,3 +111,32 @@ def test_error_for_repeated_roundtripping_not_too_large():
 
     # Still within 1.5 cm after roundtripping 10 times.
     np.testing.assert_allclose([111.0, 222.0, -333.0], point, atol=0.015)
+
+
+def test_array_transforms_match_single_point_transforms():
+    kwargs = {
+        "local_crs": "CH1903",
+        "global_crs": "WGS84",
+        "translation_vector": [579300.0, 247500.0, 500.0],
+    }
+    points = np.array(
+        [[0.0, 0.0, 0.0], [1.0, 3.0, 100.0], [2.0, 40.0, -20.0], [30.0, 5.0, 40.0]]
+    )
+
+    global_coords = local_to_global_array(points=points, **kwargs)
+    assert global_coords.shape == (4, 3)
+    for p, g in zip(points, global_coords):
+        np.testing.assert_allclose(g, local_to_global(point=p, **kwargs))
+
+    local_coords = global_to_local_array(points=global_coords, **kwargs)
+    assert local_coords.shape == (4, 3)
+    for g, p in zip(global_coords, local_coords):
+        np.testing.assert_allclose(p, global_to_local(point=g, **kwargs))
+    np.testing.assert_allclose(local_coords, points, atol=1.5e-3)
+
+    # No points at all.
+    assert local_to_global_array(points=np.empty((0, 3)), **kwargs).shape == (0, 3)
+    assert global_to_local_array(points=[], **kwargs).shape == (0, 3)
+
+    with pytest.raises(ValueError, match=r"shape \(N, 3\)"):
+        local_to_global_array(points=[1.0, 2.0, 3.0], **kwargs)
@@ -17,10 +17,19 @@
 """
 Test suite for the DUGSeis project class.
 """
+
+import os
 import pathlib
+import pickle
+import subprocess
+import sys
 
+import numpy as np
 import obspy
+import pytest
+from obspy.core.inventory import Channel, Inventory, Network, Station
 
+from dug_seis.project import stationxml
 from dug_seis.project.project import DUGSeisProject
 
 
@@ -84,3 +93,205 @@ def test_config_validation(tmp_path):
         "2021-04-19T12:05:23.658960Z"
     )
     assert isinstance(p.config["temporal_range"]["end_time"], obspy.UTCDateTime)
+
+    # A random waveform server secret is shared through the cache folder.
+    authkey = p._waveform_server_authkey
+    assert len(authkey) == 64
+    assert DUGSeisProject(config=config)._waveform_server_authkey == authkey
+    key_file = d / "cache_folder" / "waveform_server.key"
+    assert key_file.stat().st_mode & 0o777 == 0o600
+    config["waveform_handler"] = {"server_authkey": "secret"}
+    assert DUGSeisProject(config=config)._waveform_server_authkey == b"secret"
+
+
+def _write_stationxml_file(filename, codes):
+    channels = [
+        Channel(
+            code=code,
+            location_code="00",
+            latitude=46.5 + i * 1e-4,
+            longitude=8.5,
+            elevation=0.0,
+            depth=1000.0 + i,
+            sample_rate=200000.0,
+        )
+        for i, code in enumerate(codes)
+    ]
+    station = Station(
+        code="A", latitude=46.5, longitude=8.5, elevation=0.0, channels=channels
+    )
+    Inventory(networks=[Network(code="XX", stations=[station])], source="").write(
+        str(filename), format="stationxml"
+    )
+
+
+def test_stationxml_channel_table_is_cached(tmp_path, monkeypatch):
+    for name in ["asdf", "stationxml", "cache"]:
+        (tmp_path / name).mkdir()
+    _write_stationxml_file(tmp_path / "stationxml" / "a.xml", ["001", "002"])
+    config = {
+        "version": 14,
+        "meta": {"project_name": "Example"},
+        "local_coordinate_system": {
+            "epsg_code": 2056,
+            "translation_vector": [2679720.696, 1151600.128, 1480.0],
+        },
+        "paths": {
+            "asdf_folders": [str(tmp_path / "asdf")],
+            "stationxml_folders": [str(tmp_path / "stationxml")],
+            "database": "sqlite://:memory:",
+            "cache_folder": str(tmp_path / "cache"),
+        },
+        "temporal_range": {
+            "start_time": "2021-04-19T12:05:23.658960Z",
+            "end_time": "2021-04-19T12:09:23.658960Z",
+        },
+        "graphical_interface": {
+            "classifications": ["passive"],
+            "pick_types": ["P"],
+            "uncertainties_in_ms": [0.1],
+        },
+        "filters": [],
+    }
+
+    p = DUGSeisProject(config=config)
+    assert sorted(p.channels) == ["XX.A.00.001", "XX.A.00.002"]
+    assert (tmp_path / "cache" / stationxml.CHANNEL_TABLE_FILENAME).exists()
+    expected = p.cartesian_coordinates
+    np.testing.assert_allclose(
+        expected["XX.A.00.001"],
+        p.global_to_local_coordinates(latitude=46.5, longitude=8.5, depth=1000.0),
+    )
+    assert p.channels["XX.A.00.002"]["sampling_rate"] == 200000.0
+
+    # Arrays of coordinates are converted at once.
+    local = p.global_to_local_coordinates(
+        latitude=np.array([46.5, 46.5]), longitude=8.5, depth=np.array([1000.0, 0.0])
+    )
+    assert local.shape == (2, 3)
+    np.testing.assert_allclose(local[0], expected["XX.A.00.001"])
+    np.testing.assert_allclose(
+        local[1], p.global_to_local_coordinates(latitude=46.5, longitude=8.5, depth=0)
+    )
+    np.testing.assert_allclose(
+        p.local_to_global_coordinates(local),
+        [[46.5, 8.5, 1000.0], [46.5, 8.5, 0.0]],
+        atol=1e-6,
+    )
+    np.testing.assert_allclose(
+        p.local_to_global_coordinates(local[0]), (46.5, 8.5, 1000.0), atol=1e-6
+    )
+
+    # The second time around nothing is parsed until the inventory is needed.
+    calls = []
+    read_inventory = stationxml.read_inventory
+
+    def _read_inventory(filenames):
+        calls.append(filenames)
+        return read_inventory(filenames)
+
+    monkeypatch.setattr(stationxml, "read_inventory", _read_inventory)
+    monkeypatch.setattr("dug_seis.project.project.read_inventory", _read_inventory)
+    p = DUGSeisProject(config=config)
+    assert calls == []
+    for k, v in expected.items():
+        np.testing.assert_array_equal(p.cartesian_coordinates[k], v)
+    assert p.inventory.get_contents()["channels"] == ["XX.A.00.001", "XX.A.00.002"]
+    assert len(calls) == 1
+
+    # The ObsPy channel objects come from the inventory.
+    p = DUGSeisProject(config=config)
+    channel = p.channels["XX.A.00.002"]["channel_objects"]
+    assert isinstance(channel, Channel)
+    assert channel.code == "002"
+    assert channel.sample_rate == 200000.0
+    assert len(calls) == 2
+    assert p.channels["XX.A.00.002"]["channel_objects"] is channel
+    assert "channel_objects" not in p.channels["XX.A.00.001"]
+    with pytest.raises(KeyError):
+        p.channels["XX.A.00.001"]["something_else"]
+    # Pickles as plain dictionaries without the inventory.
+    pickled = pickle.loads(pickle.dumps(p.channels))["XX.A.00.002"]
+    assert type(pickled) is dict
+    assert sorted(pickled) == sorted(p.channels["XX.A.00.002"])
+
+    # Changed files and coordinate systems invalidate it.
+    _write_stationxml_file(tmp_path / "stationxml" / "a.xml", ["001", "002", "003"])
+    st = os.stat(tmp_path / "stationxml" / "a.xml")
+    os.utime(
+        tmp_path / "stationxml" / "a.xml",
+        ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000),
+    )
+    p = DUGSeisProject(config=config)
+    assert len(calls) == 3
+    assert len(p.channels) == 3
+
+    config["local_coordinate_system"]["translation_vector"] = [0.0, 0.0, 0.0]
+    p = DUGSeisProject(config=config)
+    assert len(calls) == 4
+    assert not np.allclose(
+        p.cartesian_coordinates["XX.A.00.001"], expected["XX.A.00.001"]
+    )
+
+
+def test_project_startup_does_not_import_heavy_modules(tmp_path):
+    """
+    Opening a project must not load plotting, signal processing, or waveform
+    reading libraries - headless batch jobs should not pay for them.
+    """
+    for name in ["asdf", "stationxml", "cache"]:
+        (tmp_path / name).mkdir()
+    config = {
+        "version": 14,
+        "meta": {"project_name": "Example"},
+        "local_coordinate_system": {
+            "epsg_code": 2056,
+            "translation_vector": [2679720.696, 1151600.128, 1480.0],
+        },
+        "paths": {
+            "asdf_folders": [str(tmp_path / "asdf")],
+            "stationxml_folders": [str(tmp_path / "stationxml")],
+            "database": "sqlite://:memory:",
+            "cache_folder": str(tmp_path / "cache"),
+        },
+        "temporal_range": {
+            "start_time": "2021-04-19T12:05:23.658960Z",
+            "end_time": "2021-04-19T12:09:23.658960Z",
+        },
+        "graphical_interface": {
+            "classifications": ["passive"],
+            "pick_types": ["P"],
+            "uncertainties_in_ms": [0.1],
+        },
+        "filters": [],
+    }
+    modules = [
+        "matplotlib",
+        "scipy.signal",
+        "numba",
+        "pyasdf",
+        "h5py",
+        "pyproj",
+        "PySide6",
+    ]
+    code = (
+        "import sys\n"
+        "from dug_seis.project.project import DUGSeisProject\n"
+        f"DUGSeisProject(config={config!r})\n"
+        f"print([m for m in {modules!r} if m in sys.modules])\n"
+    )
+    # Needs a fresh interpreter - the test session itself has imported
+    # everything already.
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(pathlib.Path(__file__).parent.parent.parent)]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    assert out.stdout.strip().splitlines()[-1] == "[]"
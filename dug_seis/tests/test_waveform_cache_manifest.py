@@ -0,0 +1,95 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Test suite for the manifest of the waveform handler's cache folder.
+"""
+
+import sqlite3
+
+from dug_seis.waveform_handler.cache_manifest import CacheManifest, lock_cache_entry
+
+
+def _make_store(folder, version, size):
+    folder.mkdir()
+    c = sqlite3.connect(str(folder / "index.sqlite"))
+    c.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    c.execute("INSERT INTO meta VALUES ('version', ?)", (str(version),))
+    c.commit()
+    c.close()
+    (folder / "minmax_0.bin").write_bytes(b"1" * size)
+
+
+def test_cache_manifest(tmp_path):
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    # Leftovers of earlier versions and things not managed by the manifest.
+    (cache / "a__1234.npz").write_bytes(b"1234")
+    (cache / "notes.txt").write_bytes(b"1234")
+    _make_store(cache / "minmax_index_100hz", version=3, size=1000)
+    _make_store(cache / "minmax_index_50hz", version=2, size=2000)
+
+    manifest = CacheManifest(folder=cache)
+    assert manifest.entries == []
+    assert not manifest.validate("minmax_index_100hz", "index_store", 3)
+
+    # Orphans are removed, existing stores are adopted with their version.
+    assert manifest.collect_garbage() == ["a__1234.npz"]
+    assert not (cache / "a__1234.npz").exists()
+    assert (cache / "notes.txt").exists()
+    entries = {e["name"]: e for e in manifest.entries}
+    assert sorted(entries) == ["minmax_index_100hz", "minmax_index_50hz"]
+    assert entries["minmax_index_100hz"]["version"] == 3
+    assert entries["minmax_index_50hz"]["version"] == 2
+    assert entries["minmax_index_50hz"]["size"] > 2000
+    manifest.close()
+
+    # Persistent.
+    manifest = CacheManifest(folder=cache)
+    assert manifest.validate("minmax_index_100hz", "index_store", 3)
+    # Outdated entries are removed without opening them.
+    assert not manifest.validate("minmax_index_50hz", "index_store", 3)
+    assert not (cache / "minmax_index_50hz").exists()
+    assert [e["name"] for e in manifest.entries] == ["minmax_index_100hz"]
+
+    # Least recently used entries are evicted first.
+    _make_store(cache / "minmax_index_50hz", version=3, size=2000)
+    manifest.touch("minmax_index_50hz", "index_store", 3, sources=[tmp_path])
+    _make_store(cache / "minmax_index_200hz", version=3, size=3000)
+    manifest.touch("minmax_index_200hz", "index_store", 3, sources=[tmp_path])
+    assert manifest.entries[-1]["sources"] == [str(tmp_path)]
+    assert manifest.evict(max_size=10**9) == []
+    assert manifest.evict(
+        max_size=manifest.total_size - 1000, keep=["minmax_index_100hz"]
+    ) == ["minmax_index_50hz"]
+    assert not (cache / "minmax_index_50hz").exists()
+    assert (cache / "minmax_index_100hz").exists()
+
+    # Entries in use by any process are kept.
+    in_use = lock_cache_entry(cache / "minmax_index_200hz", is_folder=True)
+    assert manifest.evict(max_size=0, keep=["minmax_index_100hz"]) == []
+    assert (cache / "minmax_index_200hz" / "minmax_0.bin").exists()
+    in_use.close()
+    (cache / "minmax_index_200hz" / "in_use.lock").unlink()
+
+    # Entries deleted by hand are forgotten.
+    (cache / "minmax_index_200hz" / "index.sqlite").unlink()
+    (cache / "minmax_index_200hz" / "minmax_0.bin").unlink()
+    (cache / "minmax_index_200hz").rmdir()
+    manifest.collect_garbage()
+    assert [e["name"] for e in manifest.entries] == ["minmax_index_100hz"]
+    manifest.close()
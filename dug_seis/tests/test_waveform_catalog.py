@@ -0,0 +1,175 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Test suite for the persistent waveform file catalog.
+"""
+
+import os
+
+import obspy
+
+from dug_seis.waveform_handler.catalog import FileCatalog, parse_filename
+
+
+def test_parse_filename():
+    assert parse_filename(
+        "2017_02_09T13_24_15_000058__2017_02_09T13_24_25_000058__HS4.h5"
+    ) == (
+        obspy.UTCDateTime(2017, 2, 9, 13, 24, 15, 58).ns,
+        obspy.UTCDateTime(2017, 2, 9, 13, 24, 25, 58).ns,
+    )
+    assert parse_filename(
+        "2021_05_05T17_59_30_000294Z__2021_05_05T17_59_51_352674Z__04.h5"
+    ) == (
+        obspy.UTCDateTime(2021, 5, 5, 17, 59, 30, 294).ns,
+        obspy.UTCDateTime(2021, 5, 5, 17, 59, 51, 352674).ns,
+    )
+    assert parse_filename("random_file.h5") is None
+
+
+def test_file_catalog_incremental_updates(tmp_path):
+    folder = tmp_path / "asdf"
+    folder.mkdir()
+    names = [
+        "2021_01_01T00_00_00_000000__2021_01_01T00_00_10_000000__A.h5",
+        "2021_01_01T00_00_10_000000__2021_01_01T00_00_20_000000__A.h5",
+    ]
+    for name in names:
+        (folder / name).write_bytes(b"1234")
+    # Not matching the pattern or the regex.
+    (folder / "something.h5").write_bytes(b"1234")
+    (folder / "a__b__c.h5").write_bytes(b"1234")
+
+    catalog_file = tmp_path / "cache" / "catalog.sqlite"
+    catalog = FileCatalog(filename=catalog_file)
+    assert catalog.update(folders=[folder]) == {
+        "added": 2,
+        "updated": 0,
+        "removed": 0,
+    }
+    files = catalog.get_files()
+    assert [f["path"] for f in files] == [folder / n for n in names]
+    assert files[0]["start_time_ns"] == obspy.UTCDateTime(2021, 1, 1).ns
+    assert files[0]["end_time_ns"] == obspy.UTCDateTime(2021, 1, 1, 0, 0, 10).ns
+    assert files[0]["size"] == 4
+    assert catalog.generation == 1
+
+    # Nothing changed.
+    assert catalog.update(folders=[folder]) == {
+        "added": 0,
+        "updated": 0,
+        "removed": 0,
+    }
+    assert catalog.generation == 1
+
+    # Files growing in place do not change the modification time of their
+    # folder. Only full scans pick them up.
+    folder_st = os.stat(folder)
+    (folder / names[0]).write_bytes(b"12345")
+    os.utime(folder, ns=(folder_st.st_atime_ns, folder_st.st_mtime_ns))
+    assert catalog.update(folders=[folder])["updated"] == 0
+    assert catalog.last_full_scan is None
+    changes = {}
+    assert catalog.update(folders=[folder], changes=changes, full_scan=True) == {
+        "added": 0,
+        "updated": 1,
+        "removed": 0,
+    }
+    assert changes["updated"] == [folder / names[0]]
+    assert catalog.get_files()[0]["size"] == 5
+    assert catalog.last_full_scan is not None
+
+    # Folders that did not change are not even listed.
+    old_mtime_ns = folder_st.st_mtime_ns - 60_000_000_000
+    os.utime(folder, ns=(folder_st.st_atime_ns, old_mtime_ns))
+    catalog.update(folders=[folder])
+    extra = folder / "2021_01_01T00_01_00_000000__2021_01_01T00_01_10_000000__A.h5"
+    extra.write_bytes(b"1234")
+    os.utime(folder, ns=(folder_st.st_atime_ns, old_mtime_ns))
+    assert catalog.update(folders=[folder])["added"] == 0
+    assert catalog.update(folders=[folder], full_scan=True)["added"] == 1
+    extra.unlink()
+    assert catalog.update(folders=[folder])["removed"] == 1
+
+    # Files that are possibly still being written are left alone.
+    (folder / names[0]).write_bytes(b"123456")
+    assert catalog.update(
+        folders=[folder], min_file_age_in_seconds=60.0, full_scan=True
+    ) == {
+        "added": 0,
+        "updated": 0,
+        "removed": 0,
+    }
+    assert catalog.get_files()[0]["size"] == 5
+    st = os.stat(folder / names[0])
+    os.utime(folder / names[0], ns=(st.st_atime_ns, st.st_mtime_ns - 120_000_000_000))
+    assert (
+        catalog.update(folders=[folder], min_file_age_in_seconds=60.0, full_scan=True)[
+            "updated"
+        ]
+        == 1
+    )
+    assert catalog.get_files()[0]["size"] == 6
+    catalog.close()
+
+    # Survives reopening. Add a file, remove another one, and change a third.
+    new_name = "2021_01_01T00_00_20_000000__2021_01_01T00_00_30_000000__A.h5"
+    (folder / new_name).write_bytes(b"1234")
+    (folder / names[0]).unlink()
+    (folder / names[1]).write_bytes(b"123456")
+    # Make sure the folder modification time changes.
+    st = os.stat(folder)
+    os.utime(folder, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    catalog = FileCatalog(filename=catalog_file)
+    generation = catalog.generation
+    assert catalog.update(folders=[folder]) == {
+        "added": 1,
+        "updated": 0,
+        "removed": 1,
+    }
+    # What changed since the last time.
+    assert [f["path"] for f in catalog.get_files(since_generation=generation)] == [
+        folder / new_name
+    ]
+    assert catalog.get_removed_files(since_generation=generation) == [folder / names[0]]
+    assert catalog.get_removed_files(since_generation=catalog.generation) == []
+    assert catalog.update(folders=[folder], full_scan=True)["updated"] == 1
+    files = catalog.get_files()
+    assert [f["path"] for f in files] == [folder / names[1], folder / new_name]
+    assert files[0]["size"] == 6
+
+    # Temporal filtering.
+    files = catalog.get_files(
+        start_time_ns=obspy.UTCDateTime(2021, 1, 1, 0, 0, 25).ns,
+    )
+    assert [f["path"] for f in files] == [folder / new_name]
+    files = catalog.get_files(
+        end_time_ns=obspy.UTCDateTime(2021, 1, 1, 0, 0, 15).ns,
+    )
+    assert [f["path"] for f in files] == [folder / names[1]]
+
+    # Folders no longer part of the project are dropped.
+    other = tmp_path / "other"
+    other.mkdir()
+    assert catalog.update(folders=[other]) == {
+        "added": 0,
+        "updated": 0,
+        "removed": 2,
+    }
+    assert catalog.get_files() == []
+    catalog.close()
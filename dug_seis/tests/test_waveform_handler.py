@@ -0,0 +1,1353 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Test suite for the waveform handler.
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import multiprocessing.shared_memory
+import os
+import threading
+import time
+import types
+
+import h5py
+import numpy as np
+import obspy
+import pyasdf
+import pytest
+
+from dug_seis.util import compute_intervals
+from dug_seis.waveform_handler.backends import (
+    get_backend,
+    write_chunked_store,
+    write_raw_binary_file,
+)
+from dug_seis.waveform_handler.cache_manifest import CacheManifest
+from dug_seis.waveform_handler.catalog import FileCatalog
+from dug_seis.waveform_handler.caching import LRUCache, SharedHandle
+from dug_seis.waveform_handler.server import WaveformClient, WaveformServer
+from dug_seis.waveform_handler.shared_buffers import (
+    SharedWaveformBlock,
+    call_with_shared_trace,
+)
+from dug_seis.waveform_handler.utils import (
+    compute_file_fingerprint,
+    compute_sha256_hash_for_file,
+)
+from dug_seis.waveform_handler.waveform_handler import WaveformHandler
+
+CHANNELS = ["XX.A.00.001", "XX.A.00.002", "XX.B.00.001"]
+START_TIME = obspy.UTCDateTime(2021, 1, 1)
+SAMPLING_RATE = 1000.0
+
+
+def _write_asdf_files(folder, n_files, npts=1000, start_time=START_TIME, seed=1):
+    """
+    Write a couple of continuous ASDF files. Each channel has random integer
+    data. Returns the full continuous data per channel.
+    """
+    rng = np.random.default_rng(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    full_data = {c: [] for c in CHANNELS}
+    for i in range(n_files):
+        t = start_time + i * npts / SAMPLING_RATE
+        st = obspy.Stream()
+        for c in CHANNELS:
+            data = rng.integers(-1000, 1000, npts, dtype=np.int32)
+            full_data[c].append(data)
+            net, sta, loc, cha = c.split(".")
+            st.append(
+                obspy.Trace(
+                    data=data,
+                    header={
+                        "network": net,
+                        "station": sta,
+                        "location": loc,
+                        "channel": cha,
+                        "sampling_rate": SAMPLING_RATE,
+                        "starttime": t,
+                    },
+                )
+            )
+        end = st[0].stats.endtime
+        name = (
+            f"{t.strftime('%Y_%m_%dT%H_%M_%S_%f')}__"
+            f"{end.strftime('%Y_%m_%dT%H_%M_%S_%f')}__test.h5"
+        )
+        with pyasdf.ASDFDataSet(str(folder / name), mode="w") as ds:
+            ds.add_waveforms(st, tag="raw_recording")
+    return {k: np.concatenate(v) for k, v in full_data.items()}
+
+
+def _get_handler(tmp_path, **kwargs):
+    kwargs.setdefault("start_time", START_TIME - 100)
+    kwargs.setdefault("end_time", START_TIME + 1000)
+    return WaveformHandler(
+        waveform_folders=[tmp_path / "asdf"],
+        cache_folder=tmp_path / "cache",
+        index_sampling_rate_in_hz=100,
+        **kwargs,
+    )
+
+
+def test_waveform_handler_basic_access(tmp_path):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path)
+
+    assert wh.receivers == CHANNELS
+    assert len(wh._files) == 3
+    assert wh.starttime == START_TIME
+    assert wh.endtime == START_TIME + 2.999
+    assert wh.sampling_rate == SAMPLING_RATE
+
+    # Across a file boundary.
+    st = wh.get_waveforms(
+        channel_ids=CHANNELS[:2],
+        start_time=START_TIME + 0.5,
+        end_time=START_TIME + 1.5,
+    )
+    assert [tr.id for tr in st] == CHANNELS[:2]
+    for tr in st:
+        assert tr.stats.starttime == START_TIME + 0.5
+        assert tr.stats.npts == 1001
+        np.testing.assert_array_equal(tr.data, full_data[tr.id][500:1501])
+
+    # Binned index data - min/max of each 10 ms bin. Samples on a bin
+    # boundary are counted towards the earlier bin, so only check the samples
+    # strictly inside each bin.
+    times, values = wh.get_binned_index_data(channel_id=CHANNELS[2])
+    assert times.shape == values.shape
+    d = full_data[CHANNELS[2]].reshape(300, 10)[:, 1:]
+    assert np.all(values[0::2][:300] <= d.min(axis=1))
+    assert np.all(values[1::2][:300] >= d.max(axis=1))
+    assert values.min() == full_data[CHANNELS[2]].min()
+    assert values.max() == full_data[CHANNELS[2]].max()
+    # Directly served from the memory-mapped index.
+    assert np.shares_memory(values, wh._index.segments[0].data)
+
+    # The index is persistent - a new handler does not index anything.
+    wh = _get_handler(tmp_path)
+    assert all(
+        wh._index.is_indexed(filename=k, mtime_ns=v["mtime_ns"], size=v["size"])
+        for k, v in wh._files.items()
+    )
+    _, values_2 = wh.get_binned_index_data(channel_id=CHANNELS[2])
+    np.testing.assert_array_equal(values, values_2)
+
+
+def test_waveform_handler_temporal_range_and_catalog(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=3)
+
+    # Only files in the temporal range are used.
+    wh = _get_handler(tmp_path, start_time=START_TIME + 1.5)
+    assert len(wh._files) == 2
+    assert wh.starttime == START_TIME + 1.0
+
+    # The catalog is persisted in the cache folder and reused.
+    assert (tmp_path / "cache" / "waveform_catalog.sqlite").exists()
+    _write_asdf_files(tmp_path / "asdf", n_files=1, start_time=START_TIME + 3.0)
+    wh = _get_handler(tmp_path)
+    assert len(wh._files) == 4
+    assert wh.endtime == START_TIME + 3.999
+
+
+def test_waveform_handler_gaps(tmp_path):
+    a = _write_asdf_files(tmp_path / "asdf", n_files=2)
+    # One hour later.
+    b = _write_asdf_files(
+        tmp_path / "asdf", n_files=1, start_time=START_TIME + 3600, seed=2
+    )
+    wh = _get_handler(tmp_path, end_time=START_TIME + 7200)
+
+    assert wh.time_ranges == [
+        (START_TIME, START_TIME + 1.999),
+        (START_TIME + 3600, START_TIME + 3600.999),
+    ]
+    assert wh.gaps == [(START_TIME + 1.999, START_TIME + 3600)]
+
+    # The index does not cover the gap.
+    assert len(wh._index.segments) == 2
+    times, values = wh.get_binned_index_data(channel_id=CHANNELS[0])
+    assert times.shape == values.shape == (600,)
+    assert times[399] < START_TIME.timestamp + 2
+    assert times[400] == (START_TIME + 3600).timestamp
+
+    # One trace per time range.
+    st = wh.get_waveforms(CHANNELS[:1], START_TIME + 1.5, START_TIME + 3600.5)
+    assert len(st) == 2
+    np.testing.assert_array_equal(st[0].data, a[CHANNELS[0]][1500:])
+    np.testing.assert_array_equal(st[1].data, b[CHANNELS[0]][:501])
+    with pytest.raises(ValueError, match="Could not find data"):
+        wh.get_waveforms(CHANNELS[:1], START_TIME + 10, START_TIME + 20)
+
+    # Intervals only cover the time ranges.
+    project = types.SimpleNamespace(
+        config={
+            "temporal_range": {
+                "start_time": START_TIME,
+                "end_time": START_TIME + 7200,
+            }
+        },
+        waveforms=wh,
+    )
+    intervals = compute_intervals(
+        project=project, interval_length_in_seconds=1.0, interval_overlap_in_seconds=0.5
+    )
+    assert [i[0] - START_TIME for i in intervals] == [
+        0.0,
+        0.5,
+        1.0,
+        1.5,
+        3599.0,
+        3599.5,
+        3600.0,
+        3600.5,
+    ]
+
+
+def test_waveform_handler_parallel_indexing(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=4)
+    wh = _get_handler(tmp_path, num_workers=3)
+    assert wh._num_workers == 3
+    values = [wh.get_binned_index_data(channel_id=c)[1] for c in CHANNELS]
+
+    # Must be identical to indexing the files one after the other.
+    other = tmp_path / "other"
+    other.mkdir()
+    (tmp_path / "asdf").rename(other / "asdf")
+    wh = _get_handler(other, num_workers=1)
+    for c, v in zip(CHANNELS, values):
+        np.testing.assert_array_equal(wh.get_binned_index_data(channel_id=c)[1], v)
+
+
+def test_waveform_handler_index_pyramid(tmp_path):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path, pyramid_finest_decimation=4)
+    # 4, 16, 64, and 256 ms bins.
+    assert sorted(wh._pyramid.keys()) == [
+        4_000_000,
+        16_000_000,
+        64_000_000,
+        256_000_000,
+    ]
+
+    # 3000 samples for 100 points - served by the 16 ms level.
+    out = wh.get_waveform_data(
+        channel_id=CHANNELS[0],
+        start_time=START_TIME,
+        end_time=START_TIME + 2.999,
+        npts=100,
+    )
+    assert out["is_max_resolution"] is False
+    assert out["delta"] == 0.016
+    assert out["npts"] == 188
+    assert out["data"].shape == out["times"].shape == (376,)
+    d = np.concatenate([full_data[CHANNELS[0]], np.zeros(8, dtype=np.int32)])
+    d = d.reshape(-1, 16)
+    d[-1, -8:] = d[-1, 0]
+    np.testing.assert_array_equal(out["data"][0::2], d.min(axis=1))
+    np.testing.assert_array_equal(out["data"][1::2], d.max(axis=1))
+    assert not out["data"].flags.writeable
+
+    # Short windows still use the raw data.
+    out = wh.get_waveform_data(
+        channel_id=CHANNELS[0],
+        start_time=START_TIME,
+        end_time=START_TIME + 0.1,
+        npts=100,
+    )
+    assert out["is_max_resolution"] is True
+
+    # Newly indexed files also end up in the pyramid.
+    _write_asdf_files(tmp_path / "asdf", n_files=1, start_time=START_TIME + 3.0)
+    wh = _get_handler(tmp_path, pyramid_finest_decimation=4)
+    assert all(
+        store.segments[0].npts * store.dt_ns >= 4e9 for store in wh._pyramid.values()
+    )
+
+
+def test_waveform_handler_refresh(tmp_path):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh = _get_handler(tmp_path)
+    index = wh._index
+
+    # Nothing changed.
+    assert wh.refresh() == {"added": [], "updated": [], "removed": []}
+
+    # New files are appended to the existing index.
+    more_data = _write_asdf_files(
+        tmp_path / "asdf", n_files=2, start_time=START_TIME + 2.0, seed=2
+    )
+    st = os.stat(tmp_path / "asdf")
+    os.utime(tmp_path / "asdf", ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    changes = wh.refresh()
+    assert len(changes["added"]) == 2
+    assert wh._index is index
+    assert len(wh._files) == 4
+    assert wh.endtime == START_TIME + 3.999
+    assert len(wh._file_lookup.names) == 4
+
+    tr = wh.get_waveforms(CHANNELS[:1], START_TIME + 1.5, START_TIME + 2.5)[0]
+    np.testing.assert_array_equal(
+        tr.data,
+        np.concatenate([full_data[CHANNELS[0]], more_data[CHANNELS[0]]])[1500:2501],
+    )
+    _, values = wh.get_binned_index_data(channel_id=CHANNELS[0])
+    assert values.shape == (800,)
+
+    # Same as a newly created handler.
+    np.testing.assert_array_equal(
+        _get_handler(tmp_path).get_binned_index_data(channel_id=CHANNELS[0])[1],
+        values,
+    )
+
+    # Files that are already known are not added again.
+    assert wh.add_files(list(wh._files.keys())) == []
+
+    # Files modified in place do not change the modification time of their
+    # folder. Full scans, on request or once in a while, pick them up.
+    modified = sorted(wh._files.keys())[0]
+    folder_st = os.stat(tmp_path / "asdf")
+    with h5py.File(modified, "r+") as f:
+        for name, ds in f["Waveforms"]["XX.A"].items():
+            if name.startswith(CHANNELS[0]):
+                ds[100] = 50000
+    st = os.stat(modified)
+    os.utime(modified, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    os.utime(tmp_path / "asdf", ns=(folder_st.st_atime_ns, folder_st.st_mtime_ns))
+    assert wh.refresh() == {"added": [], "updated": [], "removed": []}
+    changes = wh.refresh(full_scan=True)
+    assert changes == {"added": [], "updated": [modified], "removed": []}
+    assert wh.get_binned_index_data(channel_id=CHANNELS[0])[1].max() == 50000
+    assert (
+        _get_handler(tmp_path).get_binned_index_data(channel_id=CHANNELS[0])[1].max()
+        == 50000
+    )
+
+    # New handlers only scan everything if the last full scan is too old.
+    with h5py.File(modified, "r+") as f:
+        for name, ds in f["Waveforms"]["XX.A"].items():
+            if name.startswith(CHANNELS[0]):
+                ds[100] = 60000
+    os.utime(modified, ns=(st.st_atime_ns, st.st_mtime_ns + 2_000_000_000))
+    os.utime(tmp_path / "asdf", ns=(folder_st.st_atime_ns, folder_st.st_mtime_ns))
+    for kwargs, expected in [
+        ({}, 50000),
+        ({"full_scan_interval_in_seconds": 0}, 60000),
+    ]:
+        other = _get_handler(tmp_path, **kwargs)
+        assert other.get_binned_index_data(channel_id=CHANNELS[0])[1].max() == expected
+
+    # Removing a file reopens everything.
+    removed = sorted(wh._files.keys())[-1]
+    removed.unlink()
+    changes = wh.refresh()
+    assert changes["removed"] == [removed]
+    assert len(wh._files) == 3
+    assert wh.endtime == START_TIME + 2.999
+
+
+def test_waveform_handler_refresh_shared_cache_folder(tmp_path):
+    """
+    The GUI and the live processing share the catalog in the cache folder.
+    """
+    _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh_a = _get_handler(tmp_path)
+    wh_b = _get_handler(tmp_path)
+
+    _write_asdf_files(tmp_path / "asdf", n_files=2, start_time=START_TIME + 2.0)
+    changes_a = wh_a.refresh()
+    changes_b = wh_b.refresh()
+    assert len(changes_a["added"]) == 2
+    assert changes_b == changes_a
+    assert wh_b.endtime == wh_a.endtime == START_TIME + 3.999
+
+    removed = sorted(wh_a._files)[-1]
+    removed.unlink()
+    assert wh_a.refresh()["removed"] == [removed]
+    assert wh_b.refresh() == {"added": [], "updated": [], "removed": [removed]}
+    assert wh_b.endtime == START_TIME + 2.999
+
+
+def test_waveform_handler_refresh_cost(tmp_path, monkeypatch):
+    """
+    Refreshing only looks at what changed, not at all files.
+    """
+    _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path)
+
+    calls = []
+    get_files = FileCatalog.get_files
+
+    def _get_files(self, **kwargs):
+        files = get_files(self, **kwargs)
+        calls.append(len(files))
+        return files
+
+    monkeypatch.setattr(FileCatalog, "get_files", _get_files)
+    assert wh.refresh() == {"added": [], "updated": [], "removed": []}
+    assert calls == []
+    _write_asdf_files(tmp_path / "asdf", n_files=1, start_time=START_TIME + 3.0)
+    assert len(wh.refresh()["added"]) == 1
+    assert calls == [1]
+
+
+def test_waveform_handler_add_files_failure(tmp_path, monkeypatch):
+    """
+    Files that fail to be added are not put into the catalog and can be
+    added again later.
+    """
+    _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh = _get_handler(tmp_path)
+    known = set(wh._files.keys())
+    _write_asdf_files(tmp_path / "asdf", n_files=1, start_time=START_TIME + 2.0)
+    new = sorted(set((tmp_path / "asdf").iterdir()).difference(known))
+    assert len(new) == 1
+
+    def _fail(files):
+        raise OSError("Cannot index.")
+
+    monkeypatch.setattr(wh, "_index_files", _fail)
+    with pytest.raises(OSError):
+        wh.add_files(new)
+    assert set(wh._files.keys()) == known
+    catalog = wh._open_catalog()
+    try:
+        assert new[0] not in [f["path"] for f in catalog.get_files()]
+    finally:
+        catalog.close()
+
+    # Offered again by the next refresh.
+    monkeypatch.undo()
+    assert wh.refresh()["added"] == new
+    assert wh.endtime == START_TIME + 2.999
+
+
+def test_waveform_handler_add_files_waits_for_readers(tmp_path):
+    """
+    New files are published at once and not while other threads read.
+    """
+    _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh = _get_handler(tmp_path)
+    known = set(wh._files.keys())
+    _write_asdf_files(tmp_path / "asdf", n_files=1, start_time=START_TIME + 2.0)
+    new = sorted(set((tmp_path / "asdf").iterdir()).difference(known))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        with wh._state_lock.read():
+            future = executor.submit(wh.add_files, new)
+            time.sleep(0.5)
+            assert not future.done()
+            assert set(wh._files.keys()) == known
+            assert wh.endtime == START_TIME + 1.999
+            assert len(wh._file_lookup.names) == 2
+        assert future.result() == new
+    assert wh.endtime == START_TIME + 2.999
+    assert len(wh._file_lookup.names) == 3
+
+
+def test_waveform_handler_refresh_from_worker_thread(tmp_path):
+    """
+    The GUI refreshes the waveforms in a worker thread.
+    """
+    _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh = _get_handler(tmp_path, pyramid_finest_decimation=4)
+    more_data = _write_asdf_files(
+        tmp_path / "asdf", n_files=2, start_time=START_TIME + 2.0, seed=2
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
+        changes = ex.submit(wh.refresh).result()
+    assert len(changes["added"]) == 2
+    assert len(wh._files) == 4
+
+    # Readable from this thread again.
+    tr = wh.get_waveforms(CHANNELS[:1], START_TIME + 2.0, START_TIME + 3.0)[0]
+    np.testing.assert_array_equal(tr.data, more_data[CHANNELS[0]][:1001])
+    np.testing.assert_array_equal(
+        wh.get_binned_index_data(channel_id=CHANNELS[0])[1],
+        _get_handler(tmp_path).get_binned_index_data(channel_id=CHANNELS[0])[1],
+    )
+
+
+def test_waveform_handler_reads_wait_for_full_refresh(tmp_path, monkeypatch):
+    _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path)
+    expected = wh.get_waveforms(CHANNELS[:1], START_TIME, START_TIME + 1.0)
+    sorted(wh._files)[-1].unlink()
+
+    # Pause the refresh halfway through reopening everything.
+    rebuilding = threading.Event()
+    resume = threading.Event()
+    build_cache = wh._build_cache
+
+    def _build_cache():
+        rebuilding.set()
+        assert resume.wait(timeout=10)
+        build_cache()
+
+    monkeypatch.setattr(wh, "_build_cache", _build_cache)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as ex:
+        refresh = ex.submit(wh.refresh)
+        assert rebuilding.wait(timeout=10)
+        read = ex.submit(wh.get_waveforms, CHANNELS[:1], START_TIME, START_TIME + 1.0)
+        # The stores are closed - the read waits instead of failing.
+        with pytest.raises(concurrent.futures.TimeoutError):
+            read.result(timeout=0.2)
+        resume.set()
+        assert len(refresh.result()["removed"]) == 1
+        assert read.result() == expected
+
+
+def test_waveform_handler_file_lookup(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=5)
+    wh = _get_handler(tmp_path)
+
+    # Same as checking every single file.
+    rng = np.random.default_rng(3)
+    for _ in range(100):
+        start_ns, end_ns = np.sort(
+            rng.integers((START_TIME - 1).ns, (START_TIME + 6).ns, 2)
+        )
+        expected = [
+            f
+            for f, v in wh._files.items()
+            if v["start_time_ns"] <= end_ns and v["end_time_ns"] >= start_ns
+        ]
+        assert (
+            wh._get_files_in_window(
+                channel_id=CHANNELS[0], start_time_ns=start_ns, end_time_ns=end_ns
+            )
+            == expected
+        )
+
+    # Boundaries are inclusive.
+    files = list(wh._files.keys())
+    assert (
+        wh._get_files_in_window(
+            CHANNELS[0], (START_TIME + 0.999).ns, (START_TIME + 1.0).ns
+        )
+        == files[:2]
+    )
+    assert (
+        wh._get_files_in_window("XX.C.00.001", START_TIME.ns, (START_TIME + 1).ns) == []
+    )
+
+
+def test_compute_file_fingerprint(tmp_path):
+    filename = tmp_path / "a.bin"
+    data = np.random.default_rng(1).bytes(100_000)
+    filename.write_bytes(data)
+
+    s = filename.stat()
+    assert compute_file_fingerprint(filename, "size_mtime") == (
+        f"size_mtime:{s.st_size}:{s.st_mtime_ns}"
+    )
+    assert compute_file_fingerprint(filename, "full") == (
+        f"full:{compute_sha256_hash_for_file(filename)}"
+    )
+
+    # Only some blocks are sampled.
+    sampled = compute_file_fingerprint(filename, "sampled", block_size=1000)
+    assert sampled.startswith("sampled:")
+    filename.write_bytes(data[:5000] + b"x" + data[5001:])
+    assert compute_file_fingerprint(filename, "sampled", block_size=1000) == sampled
+    filename.write_bytes(data[:-1] + b"x")
+    assert compute_file_fingerprint(filename, "sampled", block_size=1000) != sampled
+
+    with pytest.raises(ValueError, match="Unknown fingerprint strategy"):
+        compute_file_fingerprint(filename, "something")
+
+
+def test_waveform_handler_fingerprints(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh = _get_handler(tmp_path, fingerprint="full")
+    # Full hashes are computed in the background.
+    wh._hash_thread.join()
+    hashes = dict(
+        wh._index._connection.execute("SELECT path, filehash FROM files").fetchall()
+    )
+    assert hashes == {
+        str(f): f"full:{compute_sha256_hash_for_file(f)}" for f in wh._files.keys()
+    }
+    assert wh._index.get_files_without_hash() == []
+
+    with pytest.raises(ValueError, match="Unknown fingerprint strategy"):
+        _get_handler(tmp_path, fingerprint="md5")
+
+
+def test_lru_cache_evicts_by_size():
+    cache = LRUCache(max_size=100)
+    cache.put("a", np.zeros(40, dtype=np.uint8))
+    cache.put("b", np.zeros(40, dtype=np.uint8))
+    assert cache.get("a") is not None
+    # Evicts "b" as "a" has been used more recently.
+    cache.put("c", np.zeros(40, dtype=np.uint8))
+    assert "b" not in cache
+    assert cache.size == 80
+    # Too large to ever fit.
+    cache.put("d", np.zeros(101, dtype=np.uint8))
+    assert "d" not in cache
+    assert cache.get("b") is None
+    assert cache.stats == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 1,
+        "entries": 2,
+        "size": 80,
+        "max_size": 100,
+    }
+    cache.resize(50)
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_lru_cache_get_or_create_creates_once():
+    cache = LRUCache(max_size=100)
+    calls = []
+    started = threading.Event()
+
+    def _create():
+        calls.append(1)
+        started.set()
+        time.sleep(0.05)
+        return np.zeros(10, dtype=np.uint8)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+        first = ex.submit(cache.get_or_create, "a", _create)
+        started.wait()
+        others = [ex.submit(cache.get_or_create, "a", _create) for _ in range(3)]
+        values = [f.result() for f in [first, *others]]
+    assert len(calls) == 1
+    assert all(v is values[0] for v in values)
+
+
+def test_waveform_handler_trace_cache(tmp_path):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(
+        tmp_path,
+        trace_cache_size_in_bytes=10000,
+        trace_cache_chunk_size_in_samples=250,
+    )
+
+    # The chunks overlapping the window are read and cached: all 4 chunks of
+    # the first file and 3 of the second one.
+    tr = wh.get_waveforms(CHANNELS[:1], START_TIME, START_TIME + 1.5)[0]
+    np.testing.assert_array_equal(tr.data, full_data[CHANNELS[0]][:1501])
+    assert wh.trace_cache.stats["misses"] == 7
+    assert wh.trace_cache.size == 1750 * 4
+    wh.get_waveforms(CHANNELS[:1], START_TIME, START_TIME + 1.5)
+    assert wh.trace_cache.stats["hits"] == 7
+
+    # Other windows overlapping them are served from the same chunks.
+    tr = wh.get_waveforms(CHANNELS[:1], START_TIME + 0.3, START_TIME + 1.2)[0]
+    np.testing.assert_array_equal(tr.data, full_data[CHANNELS[0]][300:1201])
+    out = wh.get_waveform_array(CHANNELS[:1], START_TIME + 0.6, START_TIME + 0.7)
+    np.testing.assert_array_equal(out.data[0], full_data[CHANNELS[0]][600:701])
+    assert wh.trace_cache.stats["misses"] == 7
+    assert wh.trace_cache.stats["hits"] == 12
+
+    # Stays within the budget.
+    wh.get_waveforms(CHANNELS, START_TIME, START_TIME + 2.5)
+    assert wh.trace_cache.size <= 10000
+    assert wh.trace_cache.stats["evictions"] > 0
+
+
+def test_shared_handle_is_closed_after_last_user():
+    closed = []
+    f = SharedHandle(handle="file", close=closed.append)
+    assert f.acquire()
+    f.evict()
+    # Still in use.
+    assert closed == []
+    assert not f.acquire()
+    f.release()
+    assert closed == ["file"]
+    assert f.closed
+
+    # Values that do not fit into a cache are evicted right away.
+    cache = LRUCache(max_size=0, get_size=lambda _: 1, on_evict=lambda h: h.evict())
+    f = cache.get_or_create("a", lambda: SharedHandle("other", close=closed.append))
+    assert f.closed
+    assert closed == ["file", "other"]
+
+
+def test_waveform_handler_max_open_files(tmp_path, monkeypatch):
+    _write_asdf_files(tmp_path / "asdf", n_files=6)
+    wh = _get_handler(tmp_path, max_open_files=2, trace_cache_size_in_bytes=0)
+
+    # Keep a reference to all opened files - evicted files must be closed
+    # explicitly and not only once they are garbage collected.
+    handles = []
+    open_file = type(wh._backend).open
+
+    def _open(self, filename):
+        handles.append(open_file(self, filename))
+        return handles[-1]
+
+    monkeypatch.setattr(type(wh._backend), "open", _open)
+
+    def _num_open_files():
+        return sum(bool(h.id.valid) for h in handles)
+
+    for i in range(6):
+        wh.get_waveforms(CHANNELS, START_TIME + i, START_TIME + i + 0.5)
+        assert _num_open_files() <= 2
+    assert len(wh._open_files) == 2
+
+    # Concurrent reads never use a closed file.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+        streams = list(
+            ex.map(
+                lambda i: wh.get_waveforms(
+                    CHANNELS, START_TIME + i % 6, START_TIME + i % 6 + 0.5
+                ),
+                range(40),
+            )
+        )
+    assert all(len(st) == len(CHANNELS) for st in streams)
+    assert _num_open_files() <= 2
+
+    wh._open_files.clear()
+    assert _num_open_files() == 0
+
+
+def test_waveform_handler_reads_only_requested_samples(tmp_path):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh = _get_handler(tmp_path, trace_cache_chunk_size_in_samples=100)
+
+    # Short window in a single file - only its chunk is read.
+    tr = wh.get_waveforms(CHANNELS[1:2], START_TIME + 0.2, START_TIME + 0.23)[0]
+    assert tr.stats.starttime == START_TIME + 0.2
+    assert tr.stats.npts == 31
+    np.testing.assert_array_equal(tr.data, full_data[CHANNELS[1]][200:231])
+    assert wh.trace_cache.size == 100 * 4
+
+    # Times between samples select the nearest samples, just like trimming.
+    tr = wh.get_waveforms(CHANNELS[1:2], START_TIME + 0.9996, START_TIME + 1.0104)[0]
+    assert tr.stats.starttime == START_TIME + 1.0
+    np.testing.assert_array_equal(tr.data, full_data[CHANNELS[1]][1000:1011])
+
+    # Window partially outside the data.
+    tr = wh.get_waveforms(CHANNELS[1:2], START_TIME - 1.0, START_TIME + 0.01)[0]
+    assert tr.stats.starttime == START_TIME
+    np.testing.assert_array_equal(tr.data, full_data[CHANNELS[1]][:11])
+
+    # The returned data can be modified without affecting the cache.
+    tr.data[:] = 0
+    tr = wh.get_waveforms(CHANNELS[1:2], START_TIME - 1.0, START_TIME + 0.01)[0]
+    np.testing.assert_array_equal(tr.data, full_data[CHANNELS[1]][:11])
+
+
+def test_waveform_handler_dtypes(tmp_path):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh = _get_handler(tmp_path)
+
+    # Samples keep their dtype by default.
+    st = wh.get_waveforms(CHANNELS[:1], START_TIME + 0.5, START_TIME + 1.5)
+    assert st[0].data.dtype == np.int32
+    assert wh.get_waveform_array(CHANNELS, START_TIME, START_TIME + 1).data.dtype == (
+        np.int32
+    )
+
+    # Or are converted on request - the cache still holds the original data.
+    cache_size = wh.trace_cache.size
+    st = wh.get_waveforms(
+        CHANNELS[:1], START_TIME + 0.5, START_TIME + 1.5, dtype=np.float32
+    )
+    assert st[0].data.dtype == np.float32
+    np.testing.assert_array_equal(st[0].data, full_data[CHANNELS[0]][500:1501])
+    assert wh.trace_cache.size == cache_size
+    out = wh.get_waveform_array(CHANNELS, START_TIME, START_TIME + 1, dtype=np.float32)
+    assert out.data.dtype == np.float32
+    np.testing.assert_array_equal(out.data[1], full_data[CHANNELS[1]][:1001])
+
+    # Decimated display data as well.
+    out = wh.get_waveform_data(CHANNELS[0], START_TIME, START_TIME + 1.999, npts=100)
+    assert out["is_max_resolution"] is False
+    assert out["data"].dtype == np.int32
+
+    async def _run():
+        return await wh.aget_waveforms(
+            CHANNELS[:1], START_TIME, START_TIME + 1, dtype="float32"
+        )
+
+    assert asyncio.run(_run())[0].data.dtype == np.float32
+
+
+def test_waveform_handler_filtered_cache(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=3)
+    settings = {
+        "filter_type": "butterworth_bandpass",
+        "highpass_frequency_in_hz": 10.0,
+        "lowpass_frequency_in_hz": 100.0,
+        "filter_corners": 4,
+    }
+    wh = _get_handler(
+        tmp_path,
+        filters=[
+            {
+                "filter_id": "causal",
+                "filter_settings": {**settings, "zerophase": False},
+            },
+            {
+                "filter_id": "zerophase",
+                "filter_settings": {**settings, "zerophase": True},
+            },
+        ],
+    )
+
+    for filter_id, zerophase in [("causal", False), ("zerophase", True)]:
+        st = wh.get_filtered_waveforms(
+            CHANNELS[:2], START_TIME + 0.5, START_TIME + 1.5, filter_id=filter_id
+        )
+        expected = wh.get_waveforms(CHANNELS[:2], START_TIME + 0.5, START_TIME + 1.5)
+        expected.filter(
+            "bandpass", freqmin=10.0, freqmax=100.0, corners=4, zerophase=zerophase
+        )
+        for tr, tr_e in zip(st, expected):
+            np.testing.assert_allclose(tr.data, tr_e.data)
+            assert tr.stats.starttime == tr_e.stats.starttime
+
+    # Served from the cache, with a copy for each caller.
+    hits = wh.filtered_cache.stats["hits"]
+    st_2 = wh.get_filtered_waveforms(
+        CHANNELS[:2], START_TIME + 0.5, START_TIME + 1.5, filter_id="zerophase"
+    )
+    assert wh.filtered_cache.stats["hits"] == hits + 2
+    assert st_2 == st
+    assert not np.shares_memory(st_2[0].data, st[0].data)
+
+    # Causal filters continue where the previous window ended.
+    full = wh.get_waveforms(CHANNELS[:1], START_TIME, START_TIME + 2.999)
+    full.filter("bandpass", freqmin=10.0, freqmax=100.0, corners=4)
+    chunks = [
+        wh.get_filtered_waveforms(CHANNELS[:1], t, t + 0.999, filter_id="causal")[0]
+        for t in [START_TIME, START_TIME + 1.0, START_TIME + 2.0]
+    ]
+    np.testing.assert_allclose(
+        np.concatenate([tr.data for tr in chunks]), full[0].data, atol=1e-9
+    )
+
+    # Another preceding window leaves another state behind.
+    wh.get_filtered_waveforms(
+        CHANNELS[:1], START_TIME + 0.5, START_TIME + 0.999, filter_id="causal"
+    )
+    tr = wh.get_filtered_waveforms(
+        CHANNELS[:1], START_TIME + 1.0, START_TIME + 1.999, filter_id="causal"
+    )[0]
+    expected = wh.get_waveforms(CHANNELS[:1], START_TIME + 0.5, START_TIME + 1.999)
+    expected.filter("bandpass", freqmin=10.0, freqmax=100.0, corners=4)
+    np.testing.assert_allclose(tr.data, expected[0].data[-tr.stats.npts :], atol=1e-9)
+
+    with pytest.raises(ValueError, match="Unknown filter"):
+        wh.get_filtered_waveforms(CHANNELS, START_TIME, START_TIME + 1, "other")
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+def test_waveform_handler_iter_intervals(tmp_path, prefetch):
+    _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path)
+
+    out = list(
+        wh.iter_intervals(
+            channel_ids=CHANNELS[:2],
+            interval_length_in_seconds=1.0,
+            interval_overlap_in_seconds=0.2,
+            start_time=START_TIME,
+            prefetch=prefetch,
+        )
+    )
+    assert [(s - START_TIME, e - START_TIME) for s, e, _ in out] == [
+        (0.0, 1.0),
+        (0.8, 1.8),
+        (1.6, 2.6),
+        (2.4, 3.4),
+    ]
+    for s, e, st in out:
+        expected = wh.get_waveforms(CHANNELS[:2], s, e)
+        assert [tr.id for tr in st] == CHANNELS[:2]
+        for tr, tr_e in zip(st, expected):
+            assert tr == tr_e
+
+    # Stopping early is fine.
+    it = wh.iter_intervals(
+        channel_ids=CHANNELS[:1],
+        interval_length_in_seconds=0.1,
+        interval_overlap_in_seconds=0.0,
+        prefetch=prefetch,
+    )
+    next(it)
+    it.close()
+
+
+def test_waveform_handler_cache_manifest(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=2)
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "some_file__abc.npz").write_bytes(b"1234")
+
+    wh = _get_handler(tmp_path, pyramid_finest_decimation=4)
+    assert not (tmp_path / "cache" / "some_file__abc.npz").exists()
+    assert sorted(e["name"] for e in CacheManifest(tmp_path / "cache").entries) == [
+        "minmax_index_100hz",
+        "minmax_pyramid_16000000ns",
+        "minmax_pyramid_256000000ns",
+        "minmax_pyramid_4000000ns",
+        "minmax_pyramid_64000000ns",
+        "waveform_catalog.sqlite",
+    ]
+    assert all(e["size"] > 0 for e in CacheManifest(tmp_path / "cache").entries)
+
+    # A handler with a tight budget removes what it does not need - but
+    # nothing another handler still uses.
+    def _get_tight_handler():
+        return WaveformHandler(
+            waveform_folders=[tmp_path / "asdf"],
+            cache_folder=tmp_path / "cache",
+            index_sampling_rate_in_hz=50,
+            start_time=START_TIME - 100,
+            end_time=START_TIME + 1000,
+            max_cache_folder_size_in_bytes=0,
+        )
+
+    _get_tight_handler()
+    assert len(CacheManifest(tmp_path / "cache").entries) == 7
+    for store in [wh._index, *wh._pyramid.values()]:
+        store.close()
+    wh = _get_tight_handler()
+    assert sorted(e["name"] for e in CacheManifest(tmp_path / "cache").entries) == [
+        "minmax_index_50hz",
+        "waveform_catalog.sqlite",
+    ]
+    assert not (tmp_path / "cache" / "minmax_index_100hz").exists()
+    st = wh.get_waveforms(CHANNELS[:1], START_TIME, START_TIME + 1)
+    assert st[0].stats.npts == 1001
+
+
+def test_waveform_handler_quiet_intervals(tmp_path):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path)
+
+    # The index knows the energy of all samples.
+    times, rms = wh.get_rms_envelope(CHANNELS[0])
+    assert times.shape == rms.shape
+    assert times[0] == START_TIME.timestamp
+    ((_, piece),) = wh._index.get_energy(
+        CHANNELS[0], START_TIME.ns, (START_TIME + 100).ns
+    )
+    data = full_data[CHANNELS[0]].astype(np.float64)
+    assert piece[:, 0].sum() == data.size
+    np.testing.assert_allclose(piece[:, 2].sum(), (data**2).sum())
+
+    # Uniform noise between -1000 and 1000.
+    levels = wh.get_noise_levels(CHANNELS)
+    assert sorted(levels) == CHANNELS
+    for level in levels.values():
+        assert 500 < level < 650
+
+    kwargs = {
+        "channel_ids": CHANNELS[:1],
+        "interval_length_in_seconds": 0.2,
+        "interval_overlap_in_seconds": 0.0,
+        "start_time": START_TIME,
+        "prefetch": 0,
+    }
+    all_intervals = [(s, e) for s, e, _ in wh.iter_intervals(**kwargs)]
+    assert len(all_intervals) == 15
+
+    # Everything is quiet.
+    assert not list(wh.iter_intervals(quiet_thresholds={CHANNELS[0]: 1e6}, **kwargs))
+
+    # Only intervals with at least one loud bin are read.
+    peaks = [
+        wh.get_rms_envelope(CHANNELS[0], start_time=s, end_time=e)[1].max()
+        for s, e in all_intervals
+    ]
+    threshold = float(np.median(peaks))
+    out = list(wh.iter_intervals(quiet_thresholds={CHANNELS[0]: threshold}, **kwargs))
+    assert [(s, e) for s, e, _ in out] == [
+        i for i, p in zip(all_intervals, peaks) if p >= threshold
+    ]
+    assert 0 < len(out) < len(all_intervals)
+
+    # Loud if any of the channels is loud.
+    out = list(
+        wh.iter_intervals(
+            quiet_thresholds={CHANNELS[0]: threshold, CHANNELS[1]: 0.0}, **kwargs
+        )
+    )
+    assert len(out) == len(all_intervals)
+
+
+def test_waveform_handler_async_access(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path, async_max_workers=2)
+
+    calls = []
+    get_trace = wh._get_trace
+
+    def _get_trace(**kwargs):
+        calls.append(kwargs)
+        return get_trace(**kwargs)
+
+    wh._get_trace = _get_trace
+
+    async def _run():
+        # Identical concurrent requests share a single read.
+        st_1, st_2 = await asyncio.gather(
+            wh.aget_waveforms(CHANNELS, START_TIME + 0.5, START_TIME + 1.5),
+            wh.aget_waveforms(CHANNELS, START_TIME + 0.5, START_TIME + 1.5),
+        )
+        assert len(calls) == 3
+        assert not wh._async_reads
+        expected = wh.get_waveforms(CHANNELS, START_TIME + 0.5, START_TIME + 1.5)
+        assert st_1 == st_2 == expected
+        # But each gets its own copy.
+        assert not np.shares_memory(st_1[0].data, st_2[0].data)
+
+        with pytest.raises(ValueError, match="Could not find data"):
+            await wh.aget_waveforms(["XX.C.00.001"], START_TIME, START_TIME + 1)
+
+        # Cancellation.
+        task = asyncio.ensure_future(
+            wh.aget_waveforms(CHANNELS, START_TIME, START_TIME + 2.5)
+        )
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        intervals = []
+        async for s, e, st in wh.aiter_intervals(
+            channel_ids=CHANNELS[:1],
+            interval_length_in_seconds=1.0,
+            interval_overlap_in_seconds=0.0,
+            start_time=START_TIME,
+            prefetch=2,
+        ):
+            assert st == wh.get_waveforms(CHANNELS[:1], s, e)
+            intervals.append(s - START_TIME)
+        assert intervals == [0.0, 1.0, 2.0]
+
+    asyncio.run(_run())
+
+
+def test_waveform_handler_get_waveform_array(tmp_path):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path)
+
+    channels = [CHANNELS[2], CHANNELS[0]]
+    out = wh.get_waveform_array(
+        channel_ids=channels,
+        start_time=START_TIME + 0.7,
+        end_time=START_TIME + 2.2,
+    )
+    assert out.channel_ids == channels
+    assert out.start_time_ns == (START_TIME + 0.7).ns
+    assert out.sampling_rate == SAMPLING_RATE
+    assert out.data.shape == (2, 1501)
+    assert out.data.dtype == np.int32
+    assert out.data.flags.c_contiguous
+    for row, c in enumerate(channels):
+        np.testing.assert_array_equal(out.data[row], full_data[c][700:2201])
+
+    # Identical to the stream based access.
+    st = wh.get_waveforms(channels, START_TIME + 0.7, START_TIME + 2.2)
+    for row, tr in enumerate(st):
+        assert tr.stats.starttime.ns == out.start_time_ns
+        np.testing.assert_array_equal(tr.data, out.data[row])
+
+    # Only the part with data is returned.
+    out = wh.get_waveform_array(channels, START_TIME + 2.9, START_TIME + 5.0)
+    assert out.start_time_ns == (START_TIME + 2.9).ns
+    assert out.data.shape == (2, 100)
+
+    with pytest.raises(ValueError, match="Could not find data"):
+        wh.get_waveform_array(["XX.C.00.001"], START_TIME, START_TIME + 1)
+
+
+@pytest.mark.parametrize("backend", ["raw_binary", "mseed"])
+def test_waveform_handler_backends(tmp_path, backend):
+    rng = np.random.default_rng(1)
+    full_data = {c: [] for c in CHANNELS}
+    folder = tmp_path / "asdf"
+    folder.mkdir()
+    for i in range(3):
+        t = START_TIME + i
+        data = rng.integers(-1000, 1000, (len(CHANNELS), 1000), dtype=np.int32)
+        for c, d in zip(CHANNELS, data):
+            full_data[c].append(d)
+        name = (
+            f"{t.strftime('%Y_%m_%dT%H_%M_%S_%f')}__"
+            f"{(t + 0.999).strftime('%Y_%m_%dT%H_%M_%S_%f')}__test"
+        )
+        if backend == "raw_binary":
+            write_raw_binary_file(
+                folder / f"{name}.bin",
+                data=data,
+                channels=CHANNELS,
+                start_time=t,
+                sampling_rate=SAMPLING_RATE,
+            )
+        else:
+            st = obspy.Stream()
+            for c, d in zip(CHANNELS, data):
+                net, sta, loc, cha = c.split(".")
+                st.append(
+                    obspy.Trace(
+                        data=d,
+                        header={
+                            "network": net,
+                            "station": sta,
+                            "location": loc,
+                            "channel": cha,
+                            "sampling_rate": SAMPLING_RATE,
+                            "starttime": t,
+                        },
+                    )
+                )
+            st.write(str(folder / f"{name}.mseed"), format="MSEED")
+    full_data = {k: np.concatenate(v) for k, v in full_data.items()}
+
+    wh = _get_handler(tmp_path, backend=backend)
+    assert wh.receivers == CHANNELS
+    assert len(wh._files) == 3
+    assert wh.starttime == START_TIME
+    assert wh.endtime == START_TIME + 2.999
+
+    st = wh.get_waveforms(CHANNELS[:2], START_TIME + 0.5, START_TIME + 1.5)
+    for tr in st:
+        np.testing.assert_array_equal(tr.data, full_data[tr.id][500:1501])
+    _, values = wh.get_binned_index_data(channel_id=CHANNELS[2])
+    assert values.min() == full_data[CHANNELS[2]].min()
+    assert values.max() == full_data[CHANNELS[2]].max()
+
+    with pytest.raises(ValueError, match="Unknown waveform backend"):
+        _get_handler(tmp_path, backend="segy")
+
+
+def test_raw_binary_files_are_complete_once_visible(tmp_path):
+    data = np.arange(20, dtype=np.int16).reshape(2, 10)
+    filename = tmp_path / "a.bin"
+    backend = get_backend("raw_binary")
+    write_raw_binary_file(
+        filename,
+        data=data,
+        channels=CHANNELS[:2],
+        start_time=START_TIME,
+        sampling_rate=SAMPLING_RATE,
+    )
+    # No leftover temporary files.
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.bin", "a.json"]
+    np.testing.assert_array_equal(backend.open(filename)[1], data)
+
+    # A binary file without its header is not a waveform file (yet).
+    filename.with_suffix(".json").unlink()
+    assert backend.parse_filename(filename) is None
+
+
+def test_mseed_backend_fills_gaps(tmp_path):
+    data = np.arange(1000, dtype=np.int32)
+    tr = obspy.Trace(
+        data=data,
+        header={"network": "XX", "station": "A", "location": "00", "channel": "001"},
+    )
+    tr.stats.sampling_rate = SAMPLING_RATE
+    tr.stats.starttime = START_TIME
+    st = obspy.Stream(
+        [tr.slice(START_TIME, START_TIME + 0.4), tr.slice(START_TIME + 0.6, None)]
+    )
+    filename = tmp_path / "a.mseed"
+    st.write(str(filename), format="MSEED")
+
+    (out,) = list(get_backend("mseed").iter_traces(filename))
+    assert not np.ma.isMaskedArray(out.data)
+    # Linear data is interpolated exactly.
+    np.testing.assert_array_equal(out.data, data)
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_waveform_handler_chunked_store(tmp_path, compression):
+    full_data = _write_asdf_files(tmp_path / "asdf", n_files=3)
+    _write_asdf_files(
+        tmp_path / "asdf", n_files=1, start_time=START_TIME + 10.0, seed=2
+    )
+    wh = _get_handler(tmp_path)
+    write_chunked_store(
+        waveforms=wh,
+        folder=tmp_path / "chunked",
+        chunk_duration_in_seconds=0.7,
+        compression=compression,
+    )
+    with pytest.raises(ValueError, match="not empty"):
+        write_chunked_store(waveforms=wh, folder=tmp_path / "chunked")
+
+    chunked = WaveformHandler(
+        waveform_folders=[tmp_path / "chunked"],
+        cache_folder=tmp_path / "cache_chunked",
+        index_sampling_rate_in_hz=100,
+        start_time=START_TIME - 100,
+        end_time=START_TIME + 1000,
+        backend="chunked",
+    )
+    # 3000 and 1000 samples in chunks of 700.
+    assert len(chunked._files) == 7
+    assert chunked.receivers == CHANNELS
+    assert chunked.time_ranges == wh.time_ranges
+
+    out = chunked.get_waveform_array(CHANNELS, START_TIME + 0.5, START_TIME + 2.5)
+    for row, c in enumerate(CHANNELS):
+        np.testing.assert_array_equal(out.data[row], full_data[c][500:2501])
+    # Across the gap.
+    assert chunked.get_waveforms(
+        CHANNELS, START_TIME + 2.5, START_TIME + 10.5
+    ) == wh.get_waveforms(CHANNELS, START_TIME + 2.5, START_TIME + 10.5)
+
+
+@pytest.mark.parametrize("address", ["socket", "localhost:0"])
+def test_waveform_server(tmp_path, address):
+    _write_asdf_files(tmp_path / "asdf", n_files=3)
+    wh = _get_handler(tmp_path)
+    if address == "socket":
+        address = str(tmp_path / "waveforms.sock")
+    server = WaveformServer(waveforms=wh, address=address, authkey=b"secret")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    if isinstance(server.address, tuple):
+        address = f"{server.address[0]}:{server.address[1]}"
+
+    try:
+        client = WaveformClient(address=address, authkey=b"secret")
+        assert client.receivers == wh.receivers
+        assert client.time_ranges == wh.time_ranges
+        assert len(client._files) == 3
+
+        st = client.get_waveforms(CHANNELS[:2], START_TIME + 0.5, START_TIME + 1.5)
+        assert st == wh.get_waveforms(CHANNELS[:2], START_TIME + 0.5, START_TIME + 1.5)
+        # Served from the server's cache.
+        hits = wh.trace_cache.stats["hits"]
+        client.get_waveforms(CHANNELS[:2], START_TIME + 0.5, START_TIME + 1.5)
+        assert wh.trace_cache.stats["hits"] == hits + 4
+
+        # Each thread has its own connection.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+            arrays = list(
+                ex.map(
+                    lambda c: client.get_waveform_array(
+                        [c], START_TIME, START_TIME + 2
+                    ),
+                    CHANNELS,
+                )
+            )
+        for c, a in zip(CHANNELS, arrays):
+            np.testing.assert_array_equal(
+                a.data, wh.get_waveform_array([c], START_TIME, START_TIME + 2).data
+            )
+
+        intervals = list(
+            client.iter_intervals(
+                channel_ids=CHANNELS[:1],
+                interval_length_in_seconds=1.0,
+                interval_overlap_in_seconds=0.0,
+                start_time=START_TIME,
+            )
+        )
+        assert [s - START_TIME for s, _, _ in intervals] == [0.0, 1.0, 2.0]
+        assert client.get_noise_levels(CHANNELS) == wh.get_noise_levels(CHANNELS)
+        quiet = client.iter_intervals(
+            channel_ids=CHANNELS[:1],
+            interval_length_in_seconds=1.0,
+            interval_overlap_in_seconds=0.0,
+            start_time=START_TIME,
+            quiet_thresholds={CHANNELS[0]: 1e6},
+        )
+        assert not list(quiet)
+
+        # Errors are raised in the client.
+        with pytest.raises(ValueError, match="Could not find data"):
+            client.get_waveforms(["XX.C.00.001"], START_TIME, START_TIME + 1)
+        with pytest.raises(AttributeError):
+            client._call("_build_cache")
+        assert client.refresh() == {"added": [], "updated": [], "removed": []}
+        # Indexed by one of the server's threads.
+        _write_asdf_files(tmp_path / "asdf", n_files=1, start_time=START_TIME + 3.0)
+        changes = client.refresh()
+        assert len(changes["added"]) == 1
+        assert changes["updated"] == changes["removed"] == []
+        assert len(client._files) == 4
+        client.close()
+
+        with pytest.raises(multiprocessing.AuthenticationError):
+            WaveformClient(address=address, authkey=b"wrong")
+    finally:
+        server.close()
+
+
+def test_waveform_server_refuses_insecure_settings(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=1)
+    wh = _get_handler(tmp_path)
+    with pytest.raises(ValueError, match="requires an authkey"):
+        WaveformServer(waveforms=wh, address="localhost:0", authkey=None)
+    with pytest.raises(ValueError, match="not a loopback address"):
+        WaveformServer(waveforms=wh, address="0.0.0.0:0", authkey=b"secret")
+    server = WaveformServer(
+        waveforms=wh, address="0.0.0.0:0", authkey=b"secret", allow_remote=True
+    )
+    server.close()
+
+
+def _summarize_trace(tr, scale):
+    assert not tr.data.flags.writeable
+    return tr.id, tr.stats.starttime, tr.stats.npts, float(tr.data.sum()) * scale
+
+
+def test_shared_waveform_block(tmp_path):
+    _write_asdf_files(tmp_path / "asdf", n_files=2)
+    wh = _get_handler(tmp_path)
+    st = wh.get_waveforms(CHANNELS, START_TIME + 0.1, START_TIME + 1.2)
+    st[1].data = st[1].data[:500]
+
+    with SharedWaveformBlock.from_stream(st) as block:
+        assert block.data.shape == (len(CHANNELS), 1101)
+        assert [t.npts for t in block.traces] == [1101, 500, 1101]
+        assert block.to_stream() == st
+        # Workers only receive the small descriptors.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as ex:
+            results = list(
+                ex.map(
+                    call_with_shared_trace,
+                    [_summarize_trace] * len(st),
+                    block.traces,
+                    [2.0] * len(st),
+                )
+            )
+        assert results == [
+            (tr.id, tr.stats.starttime, tr.stats.npts, float(tr.data.sum()) * 2.0)
+            for tr in st
+        ]
+        name = block.name
+    with pytest.raises(FileNotFoundError):
+        multiprocessing.shared_memory.SharedMemory(name=name)
+
+    a = wh.get_waveform_array(CHANNELS, START_TIME, START_TIME + 1.5)
+    with SharedWaveformBlock.from_waveform_array(a) as block:
+        np.testing.assert_array_equal(block.data, a.data)
+        assert [tr.id for tr in block.to_stream()] == CHANNELS
@@ -17,11 +17,18 @@
 """
 Test suite for the waveform indexing.
 """
+
 import numpy as np
 import obspy
 import pytest
 
-from dug_seis.waveform_handler.indexing import index_trace
+from dug_seis.waveform_handler.index_store import IndexStore
+from dug_seis.waveform_handler.indexing import (
+    compute_pyramid_dts,
+    decimate_min_max,
+    energy_to_rms,
+    index_trace,
+)
 
 
 def test_index_trace():
@@ -34,6 +41,7 @@ def test_index_trace():
     out = index_trace(trace=tr, index_sampling_rate_in_hz=2)
     assert sorted(out.keys()) == [
         "data_sampling_rate_in_hz",
+        "energy",
         "index_sampling_rate_in_hz",
         "max_values",
         "min_values",
@@ -44,10 +52,19 @@ def test_index_trace():
 
     np.testing.assert_allclose(out["max_values"], [2.0, 0.5, 3.0, 4.0])
     np.testing.assert_allclose(out["min_values"], [1.0, 0.5, 1.0, 4.0])
+    # Number of samples, sum, and sum of squares per bin.
+    np.testing.assert_allclose(
+        out["energy"],
+        [[2.0, 3.0, 5.0], [2.0, 1.0, 0.5], [2.0, 4.0, 10.0], [1.0, 4.0, 16.0]],
+    )
+    np.testing.assert_allclose(
+        energy_to_rms(out["energy"]), [0.5, 0.0, 1.0, 0.0], atol=1e-7
+    )
 
     out = index_trace(trace=tr, index_sampling_rate_in_hz=1)
     assert sorted(out.keys()) == [
         "data_sampling_rate_in_hz",
+        "energy",
         "index_sampling_rate_in_hz",
         "max_values",
         "min_values",
@@ -75,6 +92,7 @@ def test_index_trace_first_one_on_boundary():
     out = index_trace(trace=tr, index_sampling_rate_in_hz=2)
     assert sorted(out.keys()) == [
         "data_sampling_rate_in_hz",
+        "energy",
         "index_sampling_rate_in_hz",
         "max_values",
         "min_values",
@@ -89,6 +107,7 @@ def test_index_trace_first_one_on_boundary():
     out = index_trace(trace=tr, index_sampling_rate_in_hz=1)
     assert sorted(out.keys()) == [
         "data_sampling_rate_in_hz",
+        "energy",
         "index_sampling_rate_in_hz",
         "max_values",
         "min_values",
@@ -108,6 +127,7 @@ def test_index_trace_first_one_on_boundary():
     out = index_trace(trace=tr, index_sampling_rate_in_hz=2)
     assert sorted(out.keys()) == [
         "data_sampling_rate_in_hz",
+        "energy",
         "index_sampling_rate_in_hz",
         "max_values",
         "min_values",
@@ -127,6 +147,7 @@ def test_index_trace_first_one_on_boundary():
     out = index_trace(trace=tr, index_sampling_rate_in_hz=2)
     assert sorted(out.keys()) == [
         "data_sampling_rate_in_hz",
+        "energy",
         "index_sampling_rate_in_hz",
         "max_values",
         "min_values",
@@ -170,6 +191,7 @@ def test_index_trace_dtypes_are_preserved(dtype):
     out = index_trace(trace=tr, index_sampling_rate_in_hz=2)
     assert sorted(out.keys()) == [
         "data_sampling_rate_in_hz",
+        "energy",
         "index_sampling_rate_in_hz",
         "max_values",
         "min_values",
@@ -183,3 +205,301 @@ def test_index_trace_dtypes_are_preserved(dtype):
 
     np.testing.assert_allclose(out["max_values"], [2, 0, 3, 40])
     np.testing.assert_allclose(out["min_values"], [-1, 0, 1, 40])
+
+
+def test_index_trace_pyramid():
+    assert compute_pyramid_dts(sampling_rate_in_hz=1000.0, finest_decimation=4) == [
+        4_000_000,
+        16_000_000,
+        64_000_000,
+        256_000_000,
+    ]
+
+    # Does not start on a bin boundary.
+    data = np.random.default_rng(1).integers(-100, 100, 1000, dtype=np.int32)
+    tr = obspy.Trace(
+        data=data,
+        header={"starttime": obspy.UTCDateTime(2021, 1, 1, 0, 0, 0, 6000)},
+    )
+    tr.stats.sampling_rate = 1000.0
+    out = index_trace(
+        trace=tr,
+        index_sampling_rate_in_hz=100,
+        pyramid_level_dts=[4_000_000, 16_000_000],
+    )
+    # Same regular index as without the pyramid.
+    regular = index_trace(trace=tr, index_sampling_rate_in_hz=100)
+    np.testing.assert_array_equal(out["min_values"], regular["min_values"])
+    np.testing.assert_array_equal(out["max_values"], regular["max_values"])
+    np.testing.assert_array_equal(out["energy"], regular["energy"])
+    assert "pyramid" not in regular
+
+    levels = out["pyramid"]
+    assert [i["index_dt_ns"] for i in levels] == [4_000_000, 16_000_000]
+
+    for level, decimation in zip(levels, [4, 16]):
+        # Bins are aligned to the epoch and contain [start, end).
+        assert level["start_time_stamp_in_ns"] % level["index_dt_ns"] == 0
+        offset = 6 % decimation
+        padded = np.concatenate(
+            [
+                np.full(offset, data[0]),
+                data,
+                np.full(-(len(data) + offset) % decimation, data[-1]),
+            ]
+        ).reshape(-1, decimation)
+        np.testing.assert_array_equal(level["min_values"], padded.min(axis=1))
+        np.testing.assert_array_equal(level["max_values"], padded.max(axis=1))
+        assert level["min_values"].dtype == np.int32
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.float32])
+def test_decimate_min_max(dtype):
+    data = np.random.default_rng(1).integers(-100, 100, 1003).astype(dtype)
+    values, times = decimate_min_max(data=data, factor=10, first_time=5.0, dt=2.0)
+    assert values.dtype == dtype
+    assert values.shape == times.shape == (202,)
+    # The last bin only has 3 samples.
+    padded = np.concatenate([data, np.full(7, data[-1])]).reshape(-1, 10)
+    np.testing.assert_array_equal(values[0::2], padded.min(axis=1))
+    np.testing.assert_array_equal(values[1::2], padded.max(axis=1))
+    np.testing.assert_array_equal(times[0::2], 5.0 + 2.0 * np.arange(101))
+    np.testing.assert_array_equal(times[1::2], times[0::2])
+
+    # Into larger buffers.
+    v_buf = np.zeros(500, dtype=dtype)
+    t_buf = np.zeros(500)
+    v, t = decimate_min_max(
+        data=data, factor=10, first_time=5.0, dt=2.0, values=v_buf, times=t_buf
+    )
+    assert np.shares_memory(v, v_buf) and np.shares_memory(t, t_buf)
+    np.testing.assert_array_equal(v, values)
+    np.testing.assert_array_equal(t, times)
+
+
+def _chunk(start_time_ns, receivers, values, dtype=np.int32):
+    """
+    Helper creating the index of a single file where min and max are
+    `-values` and `values`.
+    """
+    values = np.array(values, dtype=dtype)
+    data = np.empty((len(receivers), 2, values.shape[-1]), dtype=dtype)
+    data[:, 0] = -values
+    data[:, 1] = values
+    return {
+        "start_time_stamp_in_ns": start_time_ns,
+        "index_dt_ns": 100_000_000,
+        "data_sampling_rate_in_hz": 1000.0,
+        "receivers": receivers,
+        "data": data,
+    }
+
+
+def test_index_store(tmp_path):
+    store = IndexStore(folder=tmp_path / "index", dt_ns=100_000_000)
+    assert store.is_empty
+    assert store.dt_ns == 100_000_000
+
+    s = 10_000_000_000
+    store.add(
+        filename=tmp_path / "a.h5",
+        mtime_ns=1,
+        size=2,
+        filehash="abc",
+        index=_chunk(s, ["A", "B"], [1, 2, 3]),
+    )
+    assert store.receivers == ["A", "B"]
+    (segment,) = store.segments
+    assert segment.start_time_ns == s
+    assert segment.npts == 3
+    np.testing.assert_array_equal(segment.data[0, :, 1], [1, 2, 3])
+
+    # Append - the shared bin at the boundary is merged.
+    store.add(
+        filename=tmp_path / "b.h5",
+        mtime_ns=1,
+        size=2,
+        filehash="abc",
+        index=_chunk(s + 200_000_000, ["A", "B"], [1, 5, 6]),
+    )
+    (segment,) = store.segments
+    assert segment.npts == 5
+    np.testing.assert_array_equal(segment.data[0, :, 1], [1, 2, 3, 5, 6])
+    np.testing.assert_array_equal(segment.data[1, :, 0], [-1, -2, -3, -5, -6])
+
+    # Earlier start time and a new receiver.
+    store.add(
+        filename=tmp_path / "c.h5",
+        mtime_ns=1,
+        size=2,
+        filehash="abc",
+        index=_chunk(s - 200_000_000, ["C"], [7, 8]),
+    )
+    assert store.receivers == ["A", "B", "C"]
+    (segment,) = store.segments
+    assert segment.start_time_ns == s - 200_000_000
+    assert segment.npts == 7
+    np.testing.assert_array_equal(segment.data[0, :, 1], [0, 0, 1, 2, 3, 5, 6])
+    np.testing.assert_array_equal(segment.data[2, :, 1], [7, 8, 0, 0, 0, 0, 0])
+    assert store.get_receivers_for_file(tmp_path / "c.h5") == ["C"]
+
+    # Adding a file again replaces its values, also in the bins shared with
+    # its neighbors.
+    for mtime_ns, values in [(2, [9, 5, 6]), (3, [1, 4])]:
+        store.add(
+            filename=tmp_path / "b.h5",
+            mtime_ns=mtime_ns,
+            size=2,
+            filehash="abc",
+            index=_chunk(s + 200_000_000, ["A", "B"], values),
+        )
+        if mtime_ns == 2:
+            np.testing.assert_array_equal(
+                store.segments[0].data[0, :, 1], [0, 0, 1, 2, 9, 5, 6]
+            )
+    np.testing.assert_array_equal(
+        store.segments[0].data[0, :, 1], [0, 0, 1, 2, 3, 4, 0]
+    )
+    np.testing.assert_array_equal(
+        store.segments[0].data[1, :, 0], [0, 0, -1, -2, -3, -4, 0]
+    )
+    store.add(
+        filename=tmp_path / "b.h5",
+        mtime_ns=1,
+        size=2,
+        filehash="abc",
+        index=_chunk(s + 200_000_000, ["A", "B"], [1, 5, 6]),
+    )
+    store.close()
+
+    # Everything is persistent and nothing has to be recomputed.
+    store = IndexStore(folder=tmp_path / "index", dt_ns=100_000_000)
+    assert store.receivers == ["A", "B", "C"]
+    assert store.segments[0].npts == 7
+    assert store.is_indexed(tmp_path / "a.h5", mtime_ns=1, size=2)
+    assert not store.is_indexed(tmp_path / "a.h5", mtime_ns=2, size=2)
+    assert not store.is_indexed(tmp_path / "d.h5", mtime_ns=1, size=2)
+    np.testing.assert_array_equal(
+        store.segments[0].data[0, :, 1], [0, 0, 1, 2, 3, 5, 6]
+    )
+    # Only the files of a single segment exist.
+    assert len(list((tmp_path / "index").glob("minmax_*.bin"))) == 1
+    store.close()
+
+
+def test_index_store_energy(tmp_path):
+    def _with_energy(chunk, energy):
+        chunk["energy"] = np.array(energy, dtype=np.float64)
+        return chunk
+
+    a_energy = [[[1, 2, 3], [1, 1, 1], [1, 4, 9]]]
+    b_energy = [[[1, 5], [1, 1], [1, 25]]]
+    b_energy_2 = [[[2, 5], [2, 1], [4, 25]]]
+
+    store = IndexStore(folder=tmp_path / "index", dt_ns=100_000_000, with_energy=True)
+    s = 10_000_000_000
+    store.add(
+        filename=tmp_path / "a.h5",
+        mtime_ns=1,
+        size=2,
+        filehash="abc",
+        index=_with_energy(_chunk(s, ["A"], [1, 2, 3]), a_energy),
+    )
+    # Shares a bin with the first file - those sums are added up.
+    store.add(
+        filename=tmp_path / "b.h5",
+        mtime_ns=1,
+        size=2,
+        filehash="abc",
+        index=_with_energy(_chunk(s + 200_000_000, ["A"], [1, 5]), b_energy),
+    )
+    ((start, energy),) = store.get_energy("A", s, s + 10_000_000_000)
+    assert start == s
+    np.testing.assert_array_equal(energy[:, 0], [1, 2, 4, 5])
+    np.testing.assert_array_equal(energy[:, 2], [1, 4, 10, 25])
+    assert store.get_energy("B", s, s + 10_000_000_000) == []
+
+    # Adding a file again replaces its part of the shared bin.
+    for filename, mtime_ns, chunk in [
+        ("b.h5", 1, _with_energy(_chunk(s + 200_000_000, ["A"], [1, 5]), b_energy)),
+        ("b.h5", 2, _with_energy(_chunk(s + 200_000_000, ["A"], [2, 5]), b_energy_2)),
+        ("a.h5", 2, _with_energy(_chunk(s, ["A"], [1, 2, 3]), a_energy)),
+    ]:
+        store.add(
+            filename=tmp_path / filename,
+            mtime_ns=mtime_ns,
+            size=2,
+            filehash="abc",
+            index=chunk,
+        )
+    ((_, energy),) = store.get_energy("A", s, s + 10_000_000_000)
+    np.testing.assert_array_equal(energy[:, 0], [1, 2, 5, 5])
+    np.testing.assert_array_equal(energy[:, 2], [1, 4, 13, 25])
+    store.close()
+
+    # Opening it without energy discards it.
+    store = IndexStore(folder=tmp_path / "index", dt_ns=100_000_000)
+    assert store.is_empty
+    with pytest.raises(ValueError, match="has no energy"):
+        store.get_energy("A", s, s + 1)
+    store.close()
+    assert not list((tmp_path / "index").glob("energy_*.bin"))
+
+
+def test_index_store_segments(tmp_path):
+    store = IndexStore(
+        folder=tmp_path / "index", dt_ns=100_000_000, max_gap_ns=1_000_000_000
+    )
+    s = 10_000_000_000
+    # Two chunks with a large gap in between and a small gap after the
+    # second one.
+    for name, start, values in [
+        ("a", s, [1, 2]),
+        ("b", s + 3_600_000_000_000, [3, 4]),
+        ("c", s + 3_601_000_000_000, [5, 6]),
+    ]:
+        store.add(
+            filename=tmp_path / f"{name}.h5",
+            mtime_ns=1,
+            size=2,
+            filehash="abc",
+            index=_chunk(start, ["A"], values),
+        )
+
+    # The large gap does not take up any space.
+    assert [(i.start_time_ns, i.npts) for i in store.segments] == [
+        (s, 2),
+        (s + 3_600_000_000_000, 12),
+    ]
+    np.testing.assert_array_equal(
+        store.segments[1].data[0, :, 1], [3, 4] + [0] * 8 + [5, 6]
+    )
+
+    # Clipped to the window, one piece per segment.
+    pieces = store.get_data(
+        receiver="A", start_time_ns=s + 100_000_000, end_time_ns=s + 3_600_100_000_000
+    )
+    assert [(t, p[:, 1].tolist()) for t, p in pieces] == [
+        (s + 100_000_000, [2]),
+        (s + 3_600_000_000_000, [3, 4]),
+    ]
+    assert store.get_data(receiver="B", start_time_ns=0, end_time_ns=s * 2) == []
+
+    # Filling the gap merges the segments.
+    store.close()
+    store = IndexStore(
+        folder=tmp_path / "index", dt_ns=100_000_000, max_gap_ns=3_600_000_000_000
+    )
+    store.add(
+        filename=tmp_path / "d.h5",
+        mtime_ns=1,
+        size=2,
+        filehash="abc",
+        index=_chunk(s + 1_800_000_000_000, ["A"], [7]),
+    )
+    (segment,) = store.segments
+    assert segment.start_time_ns == s
+    assert segment.npts == 36012
+    assert segment.data[0, [0, 1, 18000, 36000, 36011], 1].tolist() == [1, 2, 7, 3, 6]
+    assert len(list((tmp_path / "index").glob("minmax_*.bin"))) == 1
+    store.close()
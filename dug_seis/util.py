@@ -28,6 +28,8 @@ import obspy
 import schema
 import tqdm
 
+from .waveform_handler.filtering import ButterworthFilter
+
 
 class _TqdmLoggingHandler(logging.StreamHandler):
     """
@@ -135,32 +137,13 @@ def filter_settings_to_function(
             f"Available filter types: {filter_types}"
         )
 
-    def f(tr: obspy.Trace):
-        if filter_settings["filter_type"] == "butterworth_bandpass":
-            tr.filter(
-                "bandpass",
-                freqmin=filter_settings["highpass_frequency_in_hz"],
-                freqmax=filter_settings["lowpass_frequency_in_hz"],
-                corners=filter_settings["filter_corners"],
-                zerophase=filter_settings["zerophase"],
-            )
-        elif filter_settings["filter_type"] == "butterworth_highpass":
-            tr.filter(
-                "highpass",
-                freq=filter_settings["frequency_in_hz"],
-                corners=filter_settings["filter_corners"],
-                zerophase=filter_settings["zerophase"],
-            )
-        elif filter_settings["filter_type"] == "butterworth_lowpass":
-            tr.filter(
-                "lowpass",
-                freq=filter_settings["frequency_in_hz"],
-                corners=filter_settings["filter_corners"],
-                zerophase=filter_settings["zerophase"],
-            )
-        else:
-            raise NotImplementedError
+    # Designed once per sampling rate and not on every call.
+    butterworth_filter = ButterworthFilter(filter_settings)
 
+    def f(tr: obspy.Trace):
+        tr.data = butterworth_filter.apply(
+            data=tr.data, sampling_rate=tr.stats.sampling_rate
+        )[0]
         return tr
 
     return f
@@ -184,8 +167,29 @@ def compute_intervals(
     Returns:
         A list of (start time, end time) `obspy.UTCDateTime` tuples.
     """
-    start_time = project.config["temporal_range"]["start_time"]
-    end_time = project.config["temporal_range"]["end_time"]
+    return _compute_intervals(
+        start_time=project.config["temporal_range"]["start_time"],
+        end_time=project.config["temporal_range"]["end_time"],
+        time_ranges=project.waveforms.time_ranges,
+        interval_length_in_seconds=interval_length_in_seconds,
+        interval_overlap_in_seconds=interval_overlap_in_seconds,
+    )
+
+
+def _compute_intervals(
+    start_time: obspy.UTCDateTime,
+    end_time: obspy.UTCDateTime,
+    time_ranges: typing.List[typing.Tuple[obspy.UTCDateTime, obspy.UTCDateTime]],
+    interval_length_in_seconds: float,
+    interval_overlap_in_seconds: float,
+) -> typing.List[typing.Tuple[obspy.UTCDateTime, obspy.UTCDateTime]]:
+    """
+    Compute intervals between start and end time overlapping any of the
+    given time ranges with data.
+    """
+    # Only intervals overlapping any of the time ranges with data are used.
+    time_ranges = list(time_ranges)
+    step = interval_length_in_seconds - interval_overlap_in_seconds
 
     # Just make all of them - cannot be that many and each in the end is a fancy
     # float.
@@ -193,12 +197,17 @@ def compute_intervals(
     interval_start = copy.deepcopy(start_time)
     while interval_start < end_time:
         interval_end = interval_start + interval_length_in_seconds
-        # Nothing to do if not covered by the data.
-        if (
-            interval_start > project.waveforms.endtime
-            or interval_end < project.waveforms.starttime
-        ):
-            interval_start = interval_end - interval_overlap_in_seconds
+        # Drop time ranges that lie completely before the interval.
+        while time_ranges and time_ranges[0][1] < interval_start:
+            time_ranges.pop(0)
+        if not time_ranges:
+            break
+        # Nothing to do if not covered by the data - directly skip to the
+        # first interval overlapping the next time range.
+        if interval_end < time_ranges[0][0]:
+            interval_start += (
+                max(int((time_ranges[0][0] - interval_end) // step), 1) * step
+            )
             continue
         intervals.append([interval_start, interval_end])
         # Prep for next iteration.
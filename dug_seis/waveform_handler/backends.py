@@ -0,0 +1,553 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Backends reading the different waveform file formats.
+
+A backend knows how to find the start and end time of a file, how to iterate
+over all traces of a file to index it, and how to read a range of samples of
+a single channel. Everything else (catalog, index, caches, ...) is shared by
+all backends.
+"""
+
+import bz2
+import functools
+import json
+import logging
+import lzma
+import os
+import pathlib
+import typing
+import zlib
+
+import numpy as np
+import obspy
+import tqdm
+
+from .catalog import parse_filename
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    import h5py
+
+logger = logging.getLogger(__name__)
+
+#: Lossless compressors of the chunked store. All part of the standard library.
+CHUNK_COMPRESSORS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+CHUNKED_STORE_MANIFEST = "manifest.json"
+CHUNKED_STORE_VERSION = 1
+
+
+class WaveformBackend:
+    """
+    Base class of all waveform backends.
+
+    Backends must be stateless so they can be sent to worker processes.
+    """
+
+    #: Name of the backend.
+    name: str = None
+    #: Glob pattern the waveform files must satisfy.
+    pattern: str = None
+    #: Whether all files must have about the same duration.
+    equal_file_durations: bool = True
+
+    @property
+    def catalog_filename(self) -> str:
+        """
+        Name of the file catalog in the cache folder.
+        """
+        return f"waveform_catalog_{self.name}.sqlite"
+
+    def parse_filename(
+        self, filename: pathlib.Path
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        """
+        Start and end time of a file as nanosecond timestamps or `None` if
+        it is not a valid waveform file.
+        """
+        return parse_filename(filename)
+
+    def iter_traces(self, filename: pathlib.Path) -> typing.Iterator[obspy.Trace]:
+        """
+        Iterate over all traces in a file.
+        """
+        raise NotImplementedError
+
+    def open(self, filename: pathlib.Path) -> typing.Any:
+        """
+        Open a file for reading. The returned handle is kept open and passed
+        to `get_channel_info()` and `read()`.
+        """
+        raise NotImplementedError
+
+    def close(self, handle: typing.Any):
+        """
+        Close a handle returned by `open()`. Handles without any open
+        resources, e.g. in-memory data or memory maps that are released once
+        nothing refers to them, do not have to do anything.
+        """
+        pass
+
+    def get_channel_info(self, handle: typing.Any, channel_id: str) -> typing.Dict:
+        """
+        Information about a channel in an open file without reading its data.
+
+        Returns:
+            A dictionary with at least ``"start_time_ns"``,
+            ``"sampling_rate"``, ``"npts"``, and ``"dtype"``. Backends can add
+            whatever else they need to read the data.
+        """
+        raise NotImplementedError
+
+    def read(
+        self, handle: typing.Any, info: typing.Dict, i0: int, i1: int
+    ) -> np.ndarray:
+        """
+        Read samples ``[i0, i1)`` of a channel.
+        """
+        raise NotImplementedError
+
+
+class ASDFBackend(WaveformBackend):
+    """
+    ASDF files following the DUGSeis filename convention.
+    """
+
+    name = "asdf"
+    pattern = "*__*__*.h5"
+
+    @property
+    def catalog_filename(self) -> str:
+        # Kept for backwards compatibility.
+        return "waveform_catalog.sqlite"
+
+    def iter_traces(self, filename: pathlib.Path) -> typing.Iterator[obspy.Trace]:
+        # Only needed for indexing - pyasdf is slow to import.
+        import pyasdf
+
+        with pyasdf.ASDFDataSet(filename, mode="r") as ds:
+            for station in ds.waveforms:
+                tags = station.get_waveform_tags()
+                assert len(tags) == 1
+                tag = tags[0]
+                st = station[tag]
+                for tr in st:
+                    yield tr
+
+    def open(self, filename: pathlib.Path) -> "h5py.File":
+        import h5py
+
+        # Files are opened directly with h5py - reading only parts of a trace
+        # is not possible through pyasdf.
+        return h5py.File(str(filename), mode="r")
+
+    def close(self, handle: "h5py.File"):
+        handle.close()
+
+    def get_channel_info(self, handle: "h5py.File", channel_id: str) -> typing.Dict:
+        station = ".".join(channel_id.split(".")[:2])
+        try:
+            group = handle["Waveforms"][station]
+        except KeyError:
+            raise ValueError(f"Could not find data for channel '{channel_id}'")
+        items = [i for i in group.keys() if i.startswith(channel_id + "__")]
+        if not len(items):
+            raise ValueError(f"Could not find data for channel '{channel_id}'")
+        assert len(items) == 1, f"{items}"
+        ds = group[items[0]]
+        return {
+            "name": ds.name,
+            "start_time_ns": int(ds.attrs["starttime"]),
+            "sampling_rate": float(ds.attrs["sampling_rate"]),
+            "npts": int(ds.shape[0]),
+            "dtype": ds.dtype,
+        }
+
+    def read(
+        self, handle: "h5py.File", info: typing.Dict, i0: int, i1: int
+    ) -> np.ndarray:
+        return handle[info["name"]][i0:i1]
+
+
+class RawBinaryBackend(WaveformBackend):
+    """
+    Flat binary files with a JSON header sidecar.
+
+    Each ``.bin`` file stores the samples of all channels as a C-ordered
+    array with shape ``(channels, npts)``. The sidecar with the same name and
+    a ``.json`` extension contains ``"start_time_ns"``, ``"sampling_rate"``,
+    ``"dtype"``, ``"channels"``, and ``"npts"``. The data is memory-mapped so
+    reading a short window only touches the required pages. Use
+    `write_raw_binary_file()` to create such files.
+    """
+
+    name = "raw_binary"
+    pattern = "*.bin"
+
+    @staticmethod
+    def _read_header(filename: pathlib.Path) -> typing.Dict:
+        with open(pathlib.Path(filename).with_suffix(".json"), "r") as fh:
+            return json.load(fh)
+
+    def parse_filename(
+        self, filename: pathlib.Path
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        try:
+            header = self._read_header(filename)
+        except FileNotFoundError:
+            return None
+        start = int(header["start_time_ns"])
+        end = start + int(
+            round((int(header["npts"]) - 1) * 1e9 / float(header["sampling_rate"]))
+        )
+        return start, end
+
+    def open(self, filename: pathlib.Path) -> typing.Tuple[typing.Dict, np.ndarray]:
+        header = self._read_header(filename)
+        data = np.memmap(
+            filename,
+            dtype=np.dtype(header["dtype"]),
+            mode="r",
+            shape=(len(header["channels"]), int(header["npts"])),
+        )
+        return header, data
+
+    def get_channel_info(
+        self, handle: typing.Tuple[typing.Dict, np.ndarray], channel_id: str
+    ) -> typing.Dict:
+        header, data = handle
+        try:
+            row = header["channels"].index(channel_id)
+        except ValueError:
+            raise ValueError(f"Could not find data for channel '{channel_id}'")
+        return {
+            "row": row,
+            "start_time_ns": int(header["start_time_ns"]),
+            "sampling_rate": float(header["sampling_rate"]),
+            "npts": int(header["npts"]),
+            "dtype": data.dtype,
+        }
+
+    def read(
+        self,
+        handle: typing.Tuple[typing.Dict, np.ndarray],
+        info: typing.Dict,
+        i0: int,
+        i1: int,
+    ) -> np.ndarray:
+        # Copy so nothing refers to the memory map anymore.
+        return np.array(handle[1][info["row"], i0:i1])
+
+    def iter_traces(self, filename: pathlib.Path) -> typing.Iterator[obspy.Trace]:
+        header, data = self.open(filename)
+        for row, channel_id in enumerate(header["channels"]):
+            net, sta, loc, cha = channel_id.split(".")
+            yield obspy.Trace(
+                data=np.asarray(data[row]),
+                header={
+                    "network": net,
+                    "station": sta,
+                    "location": loc,
+                    "channel": cha,
+                    "sampling_rate": float(header["sampling_rate"]),
+                    "starttime": obspy.UTCDateTime(ns=int(header["start_time_ns"])),
+                },
+            )
+
+
+class MiniSEEDBackend(WaveformBackend):
+    """
+    MiniSEED files following the DUGSeis filename convention.
+
+    MiniSEED records can only be decoded as a whole, so each file is read
+    completely when it is opened. The most recently used files are kept in
+    memory. Gaps within a file are filled by linear interpolation as
+    everything else expects a single continuous trace per channel and file.
+    """
+
+    name = "mseed"
+    pattern = "*__*__*.mseed"
+
+    def iter_traces(self, filename: pathlib.Path) -> typing.Iterator[obspy.Trace]:
+        st = obspy.read(str(filename), format="MSEED")
+        gaps = st.get_gaps()
+        if gaps:
+            logger.warning(
+                f"Filling {len(gaps)} gap(s) in '{filename}' by linear "
+                "interpolation."
+            )
+        # Without a fill value, gaps result in masked arrays.
+        st.merge(fill_value="interpolate")
+        yield from st
+
+    def open(self, filename: pathlib.Path) -> typing.Dict[str, obspy.Trace]:
+        return {tr.id: tr for tr in self.iter_traces(filename)}
+
+    def get_channel_info(
+        self, handle: typing.Dict[str, obspy.Trace], channel_id: str
+    ) -> typing.Dict:
+        try:
+            tr = handle[channel_id]
+        except KeyError:
+            raise ValueError(f"Could not find data for channel '{channel_id}'")
+        return {
+            "channel_id": channel_id,
+            "start_time_ns": tr.stats.starttime.ns,
+            "sampling_rate": float(tr.stats.sampling_rate),
+            "npts": int(tr.stats.npts),
+            "dtype": tr.data.dtype,
+        }
+
+    def read(
+        self,
+        handle: typing.Dict[str, obspy.Trace],
+        info: typing.Dict,
+        i0: int,
+        i1: int,
+    ) -> np.ndarray:
+        return handle[info["channel_id"]].data[i0:i1]
+
+
+class ChunkedStoreBackend(WaveformBackend):
+    """
+    Folders written by `write_chunked_store()`.
+
+    The data is split into chunks of a fixed duration. Each chunk file holds
+    a C-ordered ``(channels, npts)`` array of all channels, optionally
+    compressed. A manifest in the same folder lists the channels, the dtype,
+    the sampling rate, the compression, and the start time and number of
+    samples of every chunk. Reading a window of many channels thus only
+    touches a few files. Uncompressed chunks are memory-mapped, compressed
+    ones are decompressed as a whole when opened.
+    """
+
+    name = "chunked"
+    pattern = "*.chunk"
+    # The last chunk of each continuous time range is shorter.
+    equal_file_durations = False
+
+    @staticmethod
+    def _read_manifest(filename: pathlib.Path) -> typing.Dict:
+        manifest = pathlib.Path(filename).parent / CHUNKED_STORE_MANIFEST
+        return _load_manifest(str(manifest), manifest.stat().st_mtime_ns)
+
+    def parse_filename(
+        self, filename: pathlib.Path
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        try:
+            manifest = self._read_manifest(filename)
+        except FileNotFoundError:
+            return None
+        chunk = manifest["chunks"].get(pathlib.Path(filename).name)
+        if chunk is None:
+            return None
+        start = int(chunk["start_time_ns"])
+        end = start + int(
+            round((chunk["npts"] - 1) * 1e9 / float(manifest["sampling_rate"]))
+        )
+        return start, end
+
+    def open(self, filename: pathlib.Path) -> typing.Tuple[typing.Dict, np.ndarray]:
+        manifest = self._read_manifest(filename)
+        chunk = manifest["chunks"][pathlib.Path(filename).name]
+        dtype = np.dtype(manifest["dtype"])
+        shape = (len(manifest["channels"]), int(chunk["npts"]))
+        header = {
+            "start_time_ns": int(chunk["start_time_ns"]),
+            "sampling_rate": float(manifest["sampling_rate"]),
+            "channels": manifest["channels"],
+            "npts": shape[1],
+        }
+        if manifest["compression"] is None:
+            return header, np.memmap(filename, dtype=dtype, mode="r", shape=shape)
+        with open(filename, "rb") as fh:
+            data = CHUNK_COMPRESSORS[manifest["compression"]][1](fh.read())
+        return header, np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    # The handles look exactly like the ones of the raw binary backend.
+    get_channel_info = RawBinaryBackend.get_channel_info
+    read = RawBinaryBackend.read
+    iter_traces = RawBinaryBackend.iter_traces
+
+
+@functools.lru_cache(maxsize=16)
+def _load_manifest(filename: str, mtime_ns: int) -> typing.Dict:
+    """
+    Parsed manifest of a chunked store. Cached as it is needed for every
+    single chunk - the modification time is part of the key so changes are
+    picked up.
+    """
+    with open(filename, "r") as fh:
+        return json.load(fh)
+
+
+def write_chunked_store(
+    waveforms: typing.Any,
+    folder: pathlib.Path,
+    chunk_duration_in_seconds: float = 60.0,
+    compression: typing.Optional[str] = None,
+    channel_ids: typing.Optional[typing.List[str]] = None,
+    progress: bool = False,
+):
+    """
+    Transcode all data of a waveform handler into a chunked store.
+
+    Chunks start at the beginning of each continuous time range, so gaps are
+    not stored. Read the result with the ``"chunked"`` backend.
+
+    Args:
+        waveforms: The `WaveformHandler` to read the data from.
+        folder: The output folder. Must be empty or not exist.
+        chunk_duration_in_seconds: Duration of each chunk.
+        compression: One of ``"zlib"``, ``"bz2"``, and ``"lzma"`` or `None`
+            to store the samples uncompressed.
+        channel_ids: The channels to write. Defaults to all channels.
+        progress: Show a progress bar.
+    """
+    if compression is not None and compression not in CHUNK_COMPRESSORS:
+        raise ValueError(
+            f"Unknown compression '{compression}'. Available: "
+            f"{', '.join(CHUNK_COMPRESSORS)}"
+        )
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    if any(folder.iterdir()):
+        raise ValueError(f"Folder '{folder}' is not empty.")
+    if channel_ids is None:
+        channel_ids = waveforms.receivers
+
+    sampling_rate = float(waveforms.sampling_rate)
+    chunk_npts = max(int(round(chunk_duration_in_seconds * sampling_rate)), 1)
+    windows = []
+    for start, end in waveforms.time_ranges:
+        npts = int(round((end - start) * sampling_rate)) + 1
+        for i in range(0, npts, chunk_npts):
+            windows.append(
+                (
+                    start.ns + int(round(i * 1e9 / sampling_rate)),
+                    start.ns
+                    + int(round((min(i + chunk_npts, npts) - 1) * 1e9 / sampling_rate)),
+                )
+            )
+
+    chunks = {}
+    dtype = None
+    for start_ns, end_ns in tqdm.tqdm(windows, disable=not progress):
+        a = waveforms.get_waveform_array(
+            channel_ids=channel_ids,
+            start_time=obspy.UTCDateTime(ns=start_ns),
+            end_time=obspy.UTCDateTime(ns=end_ns),
+        )
+        if dtype is None:
+            dtype = a.data.dtype
+        data = np.ascontiguousarray(a.data, dtype=dtype)
+        name = (
+            f"{obspy.UTCDateTime(ns=start_ns).strftime('%Y_%m_%dT%H_%M_%S_%f')}__"
+            f"{obspy.UTCDateTime(ns=end_ns).strftime('%Y_%m_%dT%H_%M_%S_%f')}__"
+            f"{len(chunks):06d}.chunk"
+        )
+        raw = data.tobytes()
+        if compression is not None:
+            raw = CHUNK_COMPRESSORS[compression][0](raw)
+        (folder / name).write_bytes(raw)
+        chunks[name] = {"start_time_ns": a.start_time_ns, "npts": data.shape[1]}
+
+    manifest = {
+        "version": CHUNKED_STORE_VERSION,
+        "channels": list(channel_ids),
+        "dtype": np.dtype(dtype or np.float64).str,
+        "sampling_rate": sampling_rate,
+        "chunk_duration_in_seconds": float(chunk_duration_in_seconds),
+        "compression": compression,
+        "chunks": chunks,
+    }
+    # Written last and atomically - an interrupted run is never picked up.
+    tmp = folder / (CHUNKED_STORE_MANIFEST + ".tmp")
+    with open(tmp, "w") as fh:
+        json.dump(manifest, fh, indent=1)
+    os.replace(tmp, folder / CHUNKED_STORE_MANIFEST)
+
+
+BACKENDS = {
+    b.name: b
+    for b in [
+        ASDFBackend(),
+        RawBinaryBackend(),
+        MiniSEEDBackend(),
+        ChunkedStoreBackend(),
+    ]
+}
+
+
+def get_backend(name: str) -> WaveformBackend:
+    """
+    Get a waveform backend by name.
+    """
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown waveform backend '{name}'. Available: {', '.join(BACKENDS)}"
+        )
+
+
+def write_raw_binary_file(
+    filename: pathlib.Path,
+    data: np.ndarray,
+    channels: typing.List[str],
+    start_time: obspy.UTCDateTime,
+    sampling_rate: float,
+):
+    """
+    Write a raw binary waveform file together with its JSON header.
+
+    Both are written to temporary files first and then renamed, the header
+    last. Files are thus only picked up once they are complete.
+
+    Args:
+        filename: The binary file. The header is written next to it with a
+            ``.json`` extension.
+        data: The samples, one row per channel.
+        channels: The SEED ids of the rows.
+        start_time: Time of the first sample.
+        sampling_rate: The sampling rate in Hz.
+    """
+    filename = pathlib.Path(filename)
+    data = np.ascontiguousarray(data)
+    if data.ndim != 2 or data.shape[0] != len(channels):
+        raise ValueError("Data must have shape (len(channels), npts).")
+    header = {
+        "start_time_ns": int(obspy.UTCDateTime(start_time).ns),
+        "sampling_rate": float(sampling_rate),
+        "dtype": data.dtype.str,
+        "channels": list(channels),
+        "npts": int(data.shape[1]),
+    }
+    # The temporary names do not match the pattern of the backend. Files
+    # without a header are not picked up, so write it last.
+    tmp = filename.with_name(filename.name + ".tmp")
+    data.tofile(tmp)
+    os.replace(tmp, filename)
+    header_filename = filename.with_suffix(".json")
+    tmp = header_filename.with_name(header_filename.name + ".tmp")
+    with open(tmp, "w") as fh:
+        json.dump(header, fh)
+    os.replace(tmp, header_filename)
@@ -0,0 +1,408 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Manifest of everything the waveform handler keeps in its cache folder.
+
+Each entry is a file catalog or an index store. The manifest records its
+kind, format version, the waveform folders it belongs to, its size, and when
+it has last been used. This allows
+
+* discarding entries with an outdated format without opening them,
+* removing orphans, i.e. leftovers the manifest does not know about such
+  as the per-file ``.npz`` caches of earlier DUGSeis versions, and
+* bounding the total size of the cache folder by removing the least
+  recently used entries.
+
+Like the other caches it is a small SQLite database so multiple processes
+can safely share a cache folder. Entries that are open in any process hold a
+shared lock (see `lock_cache_entry()`) and are never removed.
+"""
+
+import contextlib
+import fnmatch
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sqlite3
+import time
+import typing
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows. Files that are open or memory-mapped cannot be removed there
+    # anyway.
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Bump if the layout of the manifest changes.
+CACHE_MANIFEST_VERSION = 1
+
+CACHE_MANIFEST_FILENAME = "cache_manifest.sqlite"
+
+# Names of the things in a cache folder the manifest is responsible for and
+# their kind. Everything else is never touched.
+_MANAGED_PATTERNS = {
+    "waveform_catalog*.sqlite": "catalog",
+    "minmax_index_*": "index_store",
+    "minmax_pyramid_*": "index_store",
+    # Per-file caches of earlier versions.
+    "*.npz": "orphan",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    sources TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+"""
+
+
+def _get_kind(name: str) -> typing.Optional[str]:
+    for pattern, kind in _MANAGED_PATTERNS.items():
+        if fnmatch.fnmatch(name, pattern):
+            return kind
+    return None
+
+
+def _get_lock_filename(path: pathlib.Path, is_folder: bool) -> pathlib.Path:
+    # Within folders, so it goes away with them. Next to files, where it is
+    # never removed and not managed by the manifest.
+    return path / "in_use.lock" if is_folder else path.with_name(path.name + ".lock")
+
+
+def lock_cache_entry(path: pathlib.Path, is_folder: bool) -> typing.Optional[typing.IO]:
+    """
+    Mark an entry of the cache folder as in use until the returned file is
+    closed. The manifest of no process removes it in the meanwhile.
+
+    Args:
+        path: The file or folder of the entry. Folders are created if
+            necessary.
+        is_folder: Whether the entry is a folder.
+
+    Returns:
+        The open lock file or None if locking is not supported.
+    """
+    if fcntl is None:  # pragma: no cover
+        return None
+    lock_filename = _get_lock_filename(path, is_folder=is_folder)
+    while True:
+        if is_folder:
+            path.mkdir(parents=True, exist_ok=True)
+        try:
+            f = open(lock_filename, "ab")
+        # Removed in the meanwhile.
+        except FileNotFoundError:  # pragma: no cover
+            continue
+        fcntl.flock(f, fcntl.LOCK_SH)
+        # The folder might have been removed while waiting for the lock.
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(lock_filename)):
+                return f
+        except FileNotFoundError:  # pragma: no cover
+            pass
+        f.close()  # pragma: no cover
+
+
+@contextlib.contextmanager
+def _lock_exclusively(path: pathlib.Path) -> typing.Iterator[bool]:
+    """
+    Lock an entry of the cache folder to remove it. Yields False if it is in
+    use.
+    """
+    lock_filename = _get_lock_filename(path, is_folder=path.is_dir())
+    if fcntl is None or not lock_filename.exists():
+        yield True
+        return
+    with open(lock_filename, "ab") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def _get_size(path: pathlib.Path) -> int:
+    """
+    Size of a file or of all files in a folder in bytes.
+    """
+    if path.is_file():
+        return path.stat().st_size
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.stat(os.path.join(root, f)).st_size
+            # Removed in the meanwhile.
+            except FileNotFoundError:  # pragma: no cover
+                pass
+    return size
+
+
+def _read_version(path: pathlib.Path, kind: str) -> int:
+    """
+    Format version of an entry not yet in the manifest. Catalogs and index
+    stores both record it in the meta table of their SQLite database.
+    """
+    filename = path / "index.sqlite" if kind == "index_store" else path
+    if not filename.is_file():
+        return 0
+    try:
+        c = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+        try:
+            row = c.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        finally:
+            c.close()
+    except sqlite3.Error:
+        return 0
+    return 0 if row is None else int(row[0])
+
+
+class CacheManifest:
+    """
+    Manifest of the catalogs and index stores in a cache folder.
+
+    Args:
+        folder: The cache folder.
+    """
+
+    def __init__(self, folder: pathlib.Path):
+        self._folder = pathlib.Path(folder)
+        self._folder.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(
+            str(self._folder / CACHE_MANIFEST_FILENAME), timeout=60.0
+        )
+        self._init_schema()
+
+    def _init_schema(self):
+        c = self._connection
+        c.executescript(_SCHEMA)
+        row = c.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and int(row[0]) == CACHE_MANIFEST_VERSION:
+            return
+        with c:
+            # The entries themselves are still fine - they will be adopted
+            # again.
+            c.execute("DELETE FROM entries")
+            c.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                (str(CACHE_MANIFEST_VERSION),),
+            )
+
+    def close(self):
+        self._connection.close()
+
+    @property
+    def entries(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        All entries, least recently used first.
+        """
+        return [
+            {
+                "name": name,
+                "kind": kind,
+                "version": version,
+                "sources": json.loads(sources),
+                "size": size,
+                "last_used": last_used,
+            }
+            for name, kind, version, sources, size, last_used in self._connection.execute(
+                "SELECT name, kind, version, sources, size, last_used FROM entries "
+                "ORDER BY last_used, name"
+            )
+        ]
+
+    @property
+    def total_size(self) -> int:
+        """
+        Size of all entries in bytes as of the last time they were used.
+        """
+        (size,) = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        return int(size)
+
+    def validate(self, name: str, kind: str, version: int) -> bool:
+        """
+        Check an entry before using it. Entries with a different kind or
+        format version are removed.
+
+        Returns:
+            True if the entry exists and can be used.
+        """
+        row = self._connection.execute(
+            "SELECT kind, version FROM entries WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return False
+        if row == (kind, version):
+            return True
+        logger.warning(
+            f"Cache entry '{name}' has version {row[1]}. Expected version "
+            f"{version}. Will rebuild it."
+        )
+        self._remove(name)
+        return False
+
+    def touch(
+        self, name: str, kind: str, version: int, sources: typing.List[pathlib.Path]
+    ):
+        """
+        Record that an entry has been created or used and update its size.
+
+        Args:
+            name: Name of the file or folder within the cache folder.
+            kind: ``"catalog"`` or ``"index_store"``.
+            version: Format version of the entry.
+            sources: The waveform folders the entry belongs to.
+        """
+        path = self._folder / name
+        with self._connection as c:
+            c.execute(
+                "INSERT OR REPLACE INTO entries (name, kind, version, sources, "
+                "size, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    name,
+                    kind,
+                    int(version),
+                    json.dumps(
+                        sorted(str(pathlib.Path(s).absolute()) for s in sources)
+                    ),
+                    _get_size(path) if path.exists() else 0,
+                    time.time(),
+                ),
+            )
+
+    def collect_garbage(self) -> typing.List[str]:
+        """
+        Remove orphans from the cache folder and forget about entries that
+        no longer exist.
+
+        Catalogs and index stores that are not yet in the manifest, e.g.
+        because they predate it, are adopted. Legacy ``.npz`` caches are
+        removed.
+
+        Returns:
+            The names of the removed files and folders.
+        """
+        known = {
+            name for (name,) in self._connection.execute("SELECT name FROM entries")
+        }
+        removed = []
+        with self._connection as c:
+            for name in known:
+                if not (self._folder / name).exists():
+                    c.execute("DELETE FROM entries WHERE name = ?", (name,))
+
+        for path in sorted(self._folder.iterdir()):
+            if path.name in known:
+                continue
+            kind = _get_kind(path.name)
+            if kind is None:
+                continue
+            if kind == "orphan":
+                self._remove(path.name)
+                removed.append(path.name)
+                continue
+            with self._connection as c:
+                c.execute(
+                    "INSERT OR REPLACE INTO entries (name, kind, version, sources, "
+                    "size, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        path.name,
+                        kind,
+                        _read_version(path, kind),
+                        "[]",
+                        _get_size(path),
+                        path.stat().st_mtime,
+                    ),
+                )
+
+        if removed:
+            logger.info(f"Removed {len(removed)} orphaned cache file(s).")
+        return removed
+
+    def evict(self, max_size: int, keep: typing.Iterable[str] = ()) -> typing.List[str]:
+        """
+        Remove the least recently used entries until the total size is
+        within the budget. Entries that are in use by any process are kept.
+
+        Args:
+            max_size: The budget in bytes.
+            keep: Names of further entries that must not be removed.
+
+        Returns:
+            The names of the removed entries.
+        """
+        keep = set(keep)
+        total_size = self.total_size
+        removed = []
+        for entry in self.entries:
+            if total_size <= max_size:
+                break
+            if entry["name"] in keep:
+                continue
+            if not self._remove(entry["name"]):
+                continue
+            total_size -= entry["size"]
+            removed.append(entry["name"])
+        if removed:
+            logger.info(
+                f"Removed {len(removed)} least recently used cache entries to "
+                f"stay within {max_size / 1024**2:.1f} MB."
+            )
+        return removed
+
+    def _remove(self, name: str) -> bool:
+        """
+        Remove an entry unless it is in use.
+
+        Returns:
+            True if it has been removed.
+        """
+        path = self._folder / name
+        with _lock_exclusively(path) as unused:
+            if not unused:
+                logger.info(f"Not removing cache entry '{path}' - it is in use.")
+                return False
+            try:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                elif path.exists():
+                    path.unlink()
+            # Might still be memory-mapped by another process on Windows. Will
+            # be retried by the next garbage collection.
+            except PermissionError:  # pragma: no cover
+                logger.warning(f"Could not remove cache entry '{path}'.")
+                return False
+        with self._connection as c:
+            c.execute("DELETE FROM entries WHERE name = ?", (name,))
+        return True
@@ -0,0 +1,293 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+In-memory caches used by the waveform handler.
+"""
+
+import collections
+import contextlib
+import threading
+import typing
+
+
+def _nbytes(value: typing.Any) -> int:
+    """
+    Memory used by the data of a trace or array.
+    """
+    if hasattr(value, "data") and hasattr(value.data, "nbytes"):
+        return int(value.data.nbytes)
+    return int(value.nbytes)
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a size budget.
+
+    The size of each entry is determined by a function, e.g. the number of
+    bytes of a trace. Entries are evicted, oldest first, until everything
+    fits into the budget again. Entries larger than the whole budget are not
+    cached at all.
+
+    Args:
+        max_size: The budget, in whatever unit `get_size` returns.
+        get_size: Function returning the size of a single value. Defaults to
+            the number of bytes of the data of a trace or of an array.
+        on_evict: Optionally called with every evicted value, e.g. to close
+            files.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        get_size: typing.Callable[[typing.Any], int] = _nbytes,
+        on_evict: typing.Optional[typing.Callable[[typing.Any], None]] = None,
+    ):
+        self._max_size = int(max_size)
+        self._get_size = get_size
+        self._on_evict = on_evict
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+        # Keys currently being created by `get_or_create()`.
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._entries
+
+    @property
+    def size(self) -> int:
+        """
+        Current size of all entries.
+        """
+        return self._size
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        """
+        Usage statistics of the cache.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size": self._size,
+                "max_size": self._max_size,
+            }
+
+    def get(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        with self._lock:
+            try:
+                value = self._entries[key][0]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: typing.Hashable, value: typing.Any):
+        size = self._get_size(value)
+        with self._lock:
+            if key in self._entries:
+                old, old_size = self._entries.pop(key)
+                self._size -= old_size
+                if self._on_evict is not None and old is not value:
+                    self._on_evict(old)
+            if size > self._max_size:
+                # Never part of the cache, thus evicted right away.
+                if self._on_evict is not None:
+                    self._on_evict(value)
+                return
+            self._entries[key] = (value, size)
+            self._size += size
+            self._evict()
+
+    def get_or_create(
+        self, key: typing.Hashable, create: typing.Callable[[], typing.Any]
+    ) -> typing.Any:
+        """
+        Get a value or create and cache it if it does not yet exist.
+
+        Concurrent calls for the same key only create the value once - the
+        other threads wait for it.
+        """
+        sentinel = object()
+        value = self.get(key, default=sentinel)
+        if value is not sentinel:
+            return value
+
+        with self._lock:
+            event = self._pending.get(key)
+            owner = event is None
+            if owner:
+                event = self._pending[key] = threading.Event()
+
+        if not owner:
+            event.wait()
+            value = self.get(key, default=sentinel)
+            # Creating it failed or it has already been evicted again.
+            if value is sentinel:
+                value = create()
+                self.put(key, value)
+            return value
+
+        try:
+            value = create()
+            self.put(key, value)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+        return value
+
+    def resize(self, max_size: int):
+        """
+        Change the budget, evicting entries if necessary.
+        """
+        with self._lock:
+            self._max_size = int(max_size)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._pop_oldest()
+            self._size = 0
+
+    def _pop_oldest(self):
+        _, (value, size) = self._entries.popitem(last=False)
+        self._size -= size
+        if self._on_evict is not None:
+            self._on_evict(value)
+
+    def _evict(self):
+        while self._size > self._max_size and self._entries:
+            self._pop_oldest()
+            self.evictions += 1
+
+
+class SharedHandle:
+    """
+    An open file (or any other resource) shared by multiple threads.
+
+    Users `acquire()` the handle before using it and `release()` it
+    afterwards. Once the handle has been evicted from its cache it is closed
+    as soon as the last user released it. Evicted handles cannot be acquired
+    anymore - open the file again instead.
+
+    Args:
+        handle: The open handle.
+        close: Function closing the handle.
+    """
+
+    def __init__(self, handle: typing.Any, close: typing.Callable[[typing.Any], None]):
+        self.handle = handle
+        self._close = close
+        self._lock = threading.Lock()
+        self._users = 0
+        self._evicted = False
+        self.closed = False
+
+    def acquire(self) -> bool:
+        """
+        Start using the handle.
+
+        Returns:
+            False if the handle has already been evicted.
+        """
+        with self._lock:
+            if self._evicted:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            close = self._evicted and not self._users
+        if close:
+            self._do_close()
+
+    def evict(self):
+        """
+        Close the handle once nobody uses it anymore.
+        """
+        with self._lock:
+            self._evicted = True
+            close = not self._users
+        if close:
+            self._do_close()
+
+    def _do_close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self._close(self.handle)
+
+
+class ReadWriteLock:
+    """
+    Lock allowing many concurrent readers or a single writer.
+
+    Readers are preferred so a thread can safely read again while already
+    reading, even if a writer is waiting.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+
+    @contextlib.contextmanager
+    def read(self) -> typing.Iterator[None]:
+        with self._condition:
+            while self._writing:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self) -> typing.Iterator[None]:
+        with self._condition:
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
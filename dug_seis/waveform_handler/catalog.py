@@ -0,0 +1,535 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent catalog of the waveform files in a set of folders.
+
+Listing, stat'ing, and parsing the filenames of a large archive each time a
+project is opened is slow. The catalog stores the result in a small SQLite
+database and usually only looks at folders whose modification time changed
+and, within them, at new or removed files. Occasional full scans pick up
+files that changed in place.
+
+Every change of the catalog increments its generation. Files record the
+generation they have been added or updated in, and removed files are
+remembered, so users of the catalog can cheaply ask what changed since they
+last looked.
+"""
+
+import calendar
+import fnmatch
+import logging
+import os
+import pathlib
+import re
+import sqlite3
+import time
+import typing
+
+from .cache_manifest import lock_cache_entry
+
+logger = logging.getLogger(__name__)
+
+FILENAME_REGEX = re.compile(
+    r"""
+^                                                              # Beginning of string
+(\d{4})_(\d{2})_(\d{2})T(\d{2})_(\d{2})_(\d{2})[_\.](\d{6})Z?  # Start time as capture groups
+__                                                             #
+(\d{4})_(\d{2})_(\d{2})T(\d{2})_(\d{2})_(\d{2})[_\.](\d{6})Z?  # End time as capture groups
+__
+.*                                                             # Rest of name
+$                                                              # End of string.
+""",
+    re.VERBOSE,
+)
+
+# Bump if the layout of the catalog changes. Catalogs with a different version
+# are discarded and rebuilt.
+CATALOG_VERSION = 4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    start_time_ns INTEGER NOT NULL,
+    end_time_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    generation INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+CREATE INDEX IF NOT EXISTS files_start_time ON files (start_time_ns);
+CREATE INDEX IF NOT EXISTS files_generation ON files (generation);
+CREATE TABLE IF NOT EXISTS removed_files (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    generation INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS removed_files_generation ON removed_files (generation);
+"""
+
+
+# Folders modified more recently than this are always listed again.
+_MTIME_RESOLUTION_NS = 2_000_000_000
+
+
+def _groups_to_timestamp_ns(groups: typing.Sequence[str]) -> int:
+    """
+    Convert the 7 regex groups of a single time in a filename to a nanosecond
+    timestamp. Much cheaper than going through `obspy.UTCDateTime`.
+    """
+    seconds = calendar.timegm(tuple(int(i) for i in groups[:6]))
+    return seconds * 1_000_000_000 + int(groups[6]) * 1000
+
+
+def parse_filename(
+    filename: typing.Union[str, pathlib.Path],
+) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Parse start and end time from a waveform filename.
+
+    Args:
+        filename: The filename. Only the stem is used.
+
+    Returns:
+        Start and end time as nanosecond timestamps or `None` if the filename
+        does not satisfy the DUGSeis filename convention.
+    """
+    m = re.match(FILENAME_REGEX, pathlib.Path(filename).stem)
+    if not m:
+        return None
+    g = m.groups()
+    return _groups_to_timestamp_ns(g[:7]), _groups_to_timestamp_ns(g[7:])
+
+
+class FileCatalog:
+    """
+    On-disk catalog of waveform files.
+
+    Stores path, start and end time in nanoseconds, size and modification
+    time of each file. Folders whose modification time did not change since
+    the last update are not listed again - adding or removing files always
+    changes the modification time of the containing folder. Within a changed
+    folder only new files are stat'ed and parsed.
+
+    Files modified in place do not change the modification time of their
+    folder. Full scans stat every file and parse the ones with a different
+    size or modification time again.
+
+    Args:
+        filename: The SQLite file storing the catalog.
+        pattern: Glob pattern the files in each folder must satisfy.
+        parse: Function returning start and end time of a file as nanosecond
+            timestamps or `None` if it is not a valid waveform file.
+            Defaults to parsing the DUGSeis filename convention.
+    """
+
+    def __init__(
+        self,
+        filename: pathlib.Path,
+        pattern: str = "*__*__*.h5",
+        parse: typing.Callable[
+            [pathlib.Path], typing.Optional[typing.Tuple[int, int]]
+        ] = parse_filename,
+    ):
+        self._filename = pathlib.Path(filename)
+        self._pattern = pattern
+        self._parse = parse
+        self._filename.parent.mkdir(parents=True, exist_ok=True)
+        # Keeps the cache manifest of other processes from removing it.
+        self._in_use = lock_cache_entry(self._filename, is_folder=False)
+        self._connection = sqlite3.connect(str(self._filename), timeout=60.0)
+        self._init_schema()
+
+    def _init_schema(self):
+        c = self._connection
+        c.executescript(_SCHEMA)
+        row = c.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and int(row[0]) == CATALOG_VERSION:
+            return
+        if row is not None:
+            logger.warning(
+                f"Waveform file catalog '{self._filename}' has version {row[0]}. "
+                f"Expected version {CATALOG_VERSION}. Will rebuild it."
+            )
+        # Older versions have a different layout of the tables.
+        c.executescript(
+            "DROP TABLE IF EXISTS folders; DROP TABLE IF EXISTS files; "
+            "DROP TABLE IF EXISTS removed_files; DELETE FROM meta;"
+        )
+        c.executescript(_SCHEMA)
+        with c:
+            c.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                (str(CATALOG_VERSION),),
+            )
+
+    def close(self):
+        self._connection.close()
+        if self._in_use is not None:
+            self._in_use.close()
+
+    @property
+    def generation(self) -> int:
+        """
+        Incremented by every change of the catalog.
+        """
+        return int(self._get_meta_value("generation") or 0)
+
+    def _get_meta_value(self, key: str) -> typing.Optional[str]:
+        row = self._connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _begin_change(self) -> int:
+        """
+        Lock the catalog for writing and get the generation of the changes.
+        """
+        self._connection.execute("BEGIN IMMEDIATE")
+        return self.generation + 1
+
+    def _end_change(self, generation: int, changed: bool):
+        if changed:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)",
+                (str(generation),),
+            )
+
+    def _put_file(
+        self,
+        path: str,
+        folder: str,
+        times: typing.Tuple[int, int],
+        size: int,
+        mtime_ns: int,
+        generation: int,
+    ):
+        c = self._connection
+        c.execute(
+            "INSERT OR REPLACE INTO files (path, folder, start_time_ns, "
+            "end_time_ns, size, mtime_ns, generation) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, folder, times[0], times[1], size, mtime_ns, generation),
+        )
+        c.execute("DELETE FROM removed_files WHERE path = ?", (path,))
+
+    def _remove_file(self, path: str, folder: str, generation: int):
+        c = self._connection
+        c.execute("DELETE FROM files WHERE path = ?", (path,))
+        c.execute(
+            "INSERT OR REPLACE INTO removed_files (path, folder, generation) "
+            "VALUES (?, ?, ?)",
+            (path, folder, generation),
+        )
+
+    @property
+    def last_full_scan(self) -> typing.Optional[float]:
+        """
+        Time of the last full scan as a UNIX timestamp.
+        """
+        value = self._get_meta_value("last_full_scan")
+        return None if value is None else float(value)
+
+    def update(
+        self,
+        folders: typing.List[pathlib.Path],
+        changes: typing.Optional[typing.Dict[str, typing.List[pathlib.Path]]] = None,
+        min_file_age_in_seconds: float = 0.0,
+        full_scan: bool = False,
+    ) -> typing.Dict[str, int]:
+        """
+        Bring the catalog up-to-date with the given folders.
+
+        Args:
+            folders: The folders to scan.
+            changes: If given, the paths of all added, updated, and removed
+                files are stored in it.
+            min_file_age_in_seconds: New or changed files modified more
+                recently than this are left alone until a later update, e.g.
+                because they are still being copied.
+            full_scan: List every folder and stat every file, even if the
+                folder's modification time did not change. Picks up files
+                modified in place.
+
+        Returns:
+            The number of added, updated, and removed files.
+        """
+        if changes is None:
+            changes = {}
+        for key in ["added", "updated", "removed"]:
+            changes[key] = []
+        c = self._connection
+        min_mtime_ns = None
+        if min_file_age_in_seconds > 0:
+            min_mtime_ns = time.time_ns() - int(min_file_age_in_seconds * 1e9)
+        with c:
+            generation = self._begin_change()
+            for folder in folders:
+                folder = pathlib.Path(folder).absolute()
+                self._update_folder(
+                    folder=folder,
+                    changes=changes,
+                    min_mtime_ns=min_mtime_ns,
+                    full_scan=full_scan,
+                    generation=generation,
+                )
+            if full_scan:
+                c.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES "
+                    "('last_full_scan', ?)",
+                    (repr(time.time()),),
+                )
+
+            # Forget about folders that are no longer part of the catalog.
+            known = {str(pathlib.Path(f).absolute()) for f in folders}
+            for (f,) in c.execute("SELECT path FROM folders").fetchall():
+                if f in known:
+                    continue
+                for (path,) in c.execute(
+                    "SELECT path FROM files WHERE folder = ?", (f,)
+                ).fetchall():
+                    self._remove_file(path=path, folder=f, generation=generation)
+                    changes["removed"].append(pathlib.Path(path))
+                c.execute("DELETE FROM folders WHERE path = ?", (f,))
+            self._end_change(generation=generation, changed=any(changes.values()))
+
+        stats = {key: len(value) for key, value in changes.items()}
+        if any(stats.values()):
+            logger.info(
+                f"Updated waveform file catalog: {stats['added']} new, "
+                f"{stats['updated']} changed, {stats['removed']} removed file(s)."
+            )
+        return stats
+
+    def _update_folder(
+        self,
+        folder: pathlib.Path,
+        changes: typing.Dict[str, typing.List[pathlib.Path]],
+        min_mtime_ns: typing.Optional[int],
+        full_scan: bool,
+        generation: int,
+    ):
+        c = self._connection
+        # Before listing it, so files added in the meanwhile are not missed.
+        folder_mtime_ns = folder.stat().st_mtime_ns
+        row = c.execute(
+            "SELECT mtime_ns FROM folders WHERE path = ?", (str(folder),)
+        ).fetchone()
+        if not full_scan and row is not None and row[0] == folder_mtime_ns:
+            return
+
+        existing = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in c.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE folder = ?",
+                (str(folder),),
+            )
+        }
+
+        seen = set()
+        # Files left for later - the folder has to be listed again.
+        deferred = False
+        # Plain strings - this loop runs for every file of large folders.
+        prefix = os.path.join(str(folder), "")
+        with os.scandir(folder) as it:
+            for entry in it:
+                path = prefix + entry.name
+                # Only new files are looked at unless scanning everything.
+                if not full_scan and path in existing:
+                    seen.add(path)
+                    continue
+                if not fnmatch.fnmatch(entry.name, self._pattern):
+                    continue
+                if not entry.is_file():
+                    continue
+                s = entry.stat()
+                seen.add(path)
+                if existing.get(path) == (s.st_size, s.st_mtime_ns):
+                    continue
+                # Possibly still being written.
+                if min_mtime_ns is not None and s.st_mtime_ns > min_mtime_ns:
+                    deferred = True
+                    continue
+                times = self._parse(folder / entry.name)
+                if times is None:
+                    continue
+                self._put_file(
+                    path=path,
+                    folder=str(folder),
+                    times=times,
+                    size=s.st_size,
+                    mtime_ns=s.st_mtime_ns,
+                    generation=generation,
+                )
+                changes["updated" if path in existing else "added"].append(
+                    pathlib.Path(path)
+                )
+
+        for path in sorted(set(existing.keys()).difference(seen)):
+            self._remove_file(path=path, folder=str(folder), generation=generation)
+            changes["removed"].append(pathlib.Path(path))
+
+        # Modification times of some file systems only have a resolution of a
+        # second or worse. Files added in the same tick would go unnoticed.
+        if deferred or folder_mtime_ns > time.time_ns() - _MTIME_RESOLUTION_NS:
+            folder_mtime_ns = None
+        c.execute(
+            "INSERT OR REPLACE INTO folders (path, mtime_ns) VALUES (?, ?)",
+            (str(folder), folder_mtime_ns),
+        )
+
+    def describe_files(
+        self, paths: typing.List[pathlib.Path]
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Describe single files without scanning their folders or adding them
+        to the catalog.
+
+        Args:
+            paths: The files. Files that cannot be parsed are ignored.
+
+        Returns:
+            The files in the same format as `get_files()`, sorted by start
+            time.
+        """
+        files = []
+        for path in paths:
+            path = pathlib.Path(path).absolute()
+            times = self._parse(path)
+            if times is None:
+                continue
+            s = path.stat()
+            files.append(
+                {
+                    "path": path,
+                    "start_time_ns": times[0],
+                    "end_time_ns": times[1],
+                    "size": s.st_size,
+                    "mtime_ns": s.st_mtime_ns,
+                }
+            )
+        return sorted(files, key=lambda x: (x["start_time_ns"], str(x["path"])))
+
+    def add_files(self, files: typing.List[typing.Dict[str, typing.Any]]):
+        """
+        Add or update single files without scanning their folders.
+
+        Args:
+            files: The files as returned by `describe_files()`.
+        """
+        with self._connection:
+            generation = self._begin_change()
+            for f in files:
+                self._put_file(
+                    path=str(f["path"]),
+                    folder=str(f["path"].parent),
+                    times=(f["start_time_ns"], f["end_time_ns"]),
+                    size=f["size"],
+                    mtime_ns=f["mtime_ns"],
+                    generation=generation,
+                )
+            self._end_change(generation=generation, changed=bool(files))
+
+    def get_files(
+        self,
+        folders: typing.Optional[typing.List[pathlib.Path]] = None,
+        start_time_ns: typing.Optional[int] = None,
+        end_time_ns: typing.Optional[int] = None,
+        since_generation: typing.Optional[int] = None,
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Get all files in the catalog, sorted by start time.
+
+        Args:
+            folders: Only return files in these folders.
+            start_time_ns: Only return files ending at or after this time.
+            end_time_ns: Only return files starting at or before this time.
+            since_generation: Only return files added or updated after this
+                generation of the catalog.
+        """
+        query = "SELECT path, start_time_ns, end_time_ns, size, mtime_ns FROM files"
+        conditions, params = self._get_conditions(
+            folders=folders, since_generation=since_generation
+        )
+        if start_time_ns is not None:
+            conditions.append("end_time_ns >= ?")
+            params.append(int(start_time_ns))
+        if end_time_ns is not None:
+            conditions.append("start_time_ns <= ?")
+            params.append(int(end_time_ns))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY start_time_ns, path"
+
+        return [
+            {
+                "path": pathlib.Path(path),
+                "start_time_ns": s,
+                "end_time_ns": e,
+                "size": size,
+                "mtime_ns": mtime_ns,
+            }
+            for path, s, e, size, mtime_ns in self._connection.execute(query, params)
+        ]
+
+    def get_removed_files(
+        self,
+        folders: typing.Optional[typing.List[pathlib.Path]] = None,
+        since_generation: int = 0,
+    ) -> typing.List[pathlib.Path]:
+        """
+        Get the files removed after a certain generation of the catalog.
+
+        Args:
+            folders: Only return files in these folders.
+            since_generation: Only return files removed after this generation.
+        """
+        conditions, params = self._get_conditions(
+            folders=folders, since_generation=since_generation
+        )
+        return [
+            pathlib.Path(path)
+            for (path,) in self._connection.execute(
+                "SELECT path FROM removed_files WHERE "
+                + " AND ".join(conditions)
+                + " ORDER BY path",
+                params,
+            )
+        ]
+
+    def _get_conditions(
+        self,
+        folders: typing.Optional[typing.List[pathlib.Path]],
+        since_generation: typing.Optional[int],
+    ) -> typing.Tuple[typing.List[str], typing.List[typing.Any]]:
+        conditions = []
+        params = []
+        if folders is not None:
+            folders = [str(pathlib.Path(f).absolute()) for f in folders]
+            conditions.append(f"folder IN ({', '.join('?' * len(folders))})")
+            params.extend(folders)
+        if since_generation is not None:
+            conditions.append("generation > ?")
+            params.append(int(since_generation))
+        return conditions, params
@@ -0,0 +1,124 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Butterworth filters of the project configuration.
+
+Designing a filter is a lot more expensive than applying it to a short
+window. The filters here design their second-order sections once per
+sampling rate and can optionally carry their state from one chunk of data to
+the next one.
+"""
+
+import typing
+import warnings
+
+import numpy as np
+
+
+class ButterworthFilter:
+    """
+    A filter as given in the ``filters`` section of a DUGSeis project.
+
+    Gives the same results as the corresponding `obspy.Trace.filter()` call.
+
+    Args:
+        filter_settings: The filter settings of a single filter.
+    """
+
+    def __init__(self, filter_settings: typing.Dict[str, typing.Any]):
+        self.filter_settings = dict(filter_settings)
+        self.zerophase = bool(filter_settings["zerophase"])
+        self._sos = {}
+
+    def get_sos(self, sampling_rate: float) -> np.ndarray:
+        """
+        Second-order sections of the filter for a given sampling rate.
+        """
+        if sampling_rate not in self._sos:
+            self._sos[sampling_rate] = self._design(sampling_rate)
+        return self._sos[sampling_rate]
+
+    def _design(self, sampling_rate: float) -> np.ndarray:
+        s = self.filter_settings
+        fe = 0.5 * sampling_rate
+        if s["filter_type"] == "butterworth_bandpass":
+            low = s["highpass_frequency_in_hz"] / fe
+            high = s["lowpass_frequency_in_hz"] / fe
+            if high - 1.0 > -1e-6:
+                warnings.warn(
+                    f"Selected high corner frequency "
+                    f"({s['lowpass_frequency_in_hz']}) of bandpass is at or "
+                    f"above Nyquist ({fe}). Applying a high-pass instead."
+                )
+                freqs, btype = low, "highpass"
+            else:
+                freqs, btype = [low, high], "band"
+            if low > 1:
+                raise ValueError("Selected low corner frequency is above Nyquist.")
+        elif s["filter_type"] == "butterworth_highpass":
+            freqs, btype = s["frequency_in_hz"] / fe, "highpass"
+            if freqs > 1:
+                raise ValueError("Selected corner frequency is above Nyquist.")
+        elif s["filter_type"] == "butterworth_lowpass":
+            freqs, btype = s["frequency_in_hz"] / fe, "lowpass"
+            if freqs > 1:
+                warnings.warn(
+                    "Selected corner frequency is above Nyquist. Setting "
+                    "Nyquist as high corner."
+                )
+                freqs = 1.0
+        else:
+            raise NotImplementedError
+        # scipy.signal is slow to import and only needed once filtering.
+        from scipy.signal import iirfilter
+
+        return iirfilter(
+            s["filter_corners"], freqs, btype=btype, ftype="butter", output="sos"
+        )
+
+    def apply(
+        self,
+        data: np.ndarray,
+        sampling_rate: float,
+        zi: typing.Optional[np.ndarray] = None,
+    ) -> typing.Tuple[np.ndarray, typing.Optional[np.ndarray]]:
+        """
+        Filter a chunk of data.
+
+        Args:
+            data: The samples.
+            sampling_rate: Their sampling rate in Hz.
+            zi: State of a causal filter at the end of the previous chunk.
+                Filtering starts at rest if not given.
+
+        Returns:
+            The filtered data and, for causal filters, the state at the end
+            of the chunk to pass on to the next one. Zero-phase filters run
+            forwards and backwards and thus cannot carry any state.
+        """
+        from scipy.signal import sosfilt
+
+        sos = self.get_sos(sampling_rate)
+        if self.zerophase:
+            if zi is not None:
+                raise ValueError("Zero-phase filters cannot carry any state.")
+            first_pass = np.flip(sosfilt(sos, data))
+            return np.flip(sosfilt(sos, first_pass)), None
+        if zi is None:
+            # Start at rest - the same as not passing any initial state.
+            zi = np.zeros((sos.shape[0], 2))
+        return sosfilt(sos, data, zi=zi)
@@ -0,0 +1,778 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent, memory-mapped min/max index of all waveform files of a project.
+
+The index consists of segments - one per continuous stretch of data. Each
+segment is a binary file with shape ``(receivers, capacity, 2)`` that is
+memory-mapped, so opening it costs no memory, and receiver-major, so the
+min/max values of a single receiver are contiguous and can be handed out
+without copying. Some spare capacity is kept at the end of each segment so
+new files can be appended without rewriting it. Gaps in the data larger than
+``max_gap_ns`` start a new segment and thus do not take up any space.
+
+Everything else (receivers, segments, which files have been indexed, ...)
+is stored in a small SQLite database next to it. A store can be used from
+multiple threads, e.g. files can be added in a worker thread while others
+read from it.
+
+Stores can optionally keep the number of samples, the sum, and the sum of
+squares of each bin in a second memory-mapped file per segment. This allows
+computing the RMS amplitude of any time window without reading the data.
+
+Whenever the layout of a segment has to change (more capacity, new
+receivers, an earlier start time, a different dtype, merging with another
+segment) the data is copied to a new segment file. Files that are still
+memory-mapped elsewhere are never resized which keeps this safe on Windows.
+"""
+
+import json
+import logging
+import pathlib
+import sqlite3
+import threading
+import typing
+
+import numpy as np
+
+from .cache_manifest import lock_cache_entry
+from .indexing import _add_energy_to_index, _add_to_index
+
+logger = logging.getLogger(__name__)
+
+# Bump if the layout of the store changes. Stores with a different version
+# are discarded.
+INDEX_STORE_VERSION = 4
+
+# The min/max and energy of the first and last bin of each file are stored as
+# well. These bins are shared with the neighboring files, so they have to be
+# rebuilt from the neighbors before a file is indexed anew.
+_FILES_TABLE = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    filehash TEXT NOT NULL,
+    receiver_set INTEGER NOT NULL,
+    start_time_ns INTEGER NOT NULL,
+    npts INTEGER NOT NULL,
+    edge_data BLOB NOT NULL,
+    edge_energy BLOB
+)"""
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS receiver_sets (
+    id INTEGER PRIMARY KEY,
+    receivers TEXT NOT NULL UNIQUE
+);
+{_FILES_TABLE};
+"""
+
+# Fraction of extra capacity to allocate every time a segment has to grow.
+_GROWTH_FACTOR = 0.25
+
+
+def _get_edges(values: np.ndarray) -> bytes:
+    """
+    The first and last bin of the index of a single file with shape
+    ``(receivers, n, npts)`` as ``(receivers, n, 2)`` float64 bytes.
+    """
+    return np.ascontiguousarray(
+        np.asarray(values)[:, :, [0, -1]], dtype=np.float64
+    ).tobytes()
+
+
+class IndexSegment(typing.NamedTuple):
+    """
+    A continuous part of the index.
+    """
+
+    # Start time of the first bin as a nanosecond timestamp.
+    start_time_ns: int
+    # Number of bins.
+    npts: int
+    # View of the memory-mapped data with shape ``(receivers, npts, 2)``. The
+    # last axis is min and max values.
+    data: np.ndarray
+
+
+class IndexStore:
+    """
+    Appendable, memory-mapped min/max index.
+
+    Args:
+        folder: Folder for this store. One store per project and bin width.
+        dt_ns: Bin width of the index in nanoseconds.
+        max_gap_ns: Gaps in the data up to this length are stored within a
+            segment. Larger gaps split the index into separate segments.
+        with_energy: Also store the number of samples, the sum, and the sum
+            of squares of each bin. Every added index must then contain them.
+    """
+
+    def __init__(
+        self,
+        folder: pathlib.Path,
+        dt_ns: int,
+        max_gap_ns: int = 60_000_000_000,
+        with_energy: bool = False,
+    ):
+        self._folder = pathlib.Path(folder)
+        # Keeps the cache manifest of other processes from removing it.
+        self._in_use = lock_cache_entry(self._folder, is_folder=True)
+        self._dt_ns = int(dt_ns)
+        self._max_gap_ns = int(max_gap_ns)
+        self._with_energy = bool(with_energy)
+
+        # Transactions are handled manually to be able to lock the store for
+        # writing. The connection is shared by all threads and guarded by the
+        # lock, which also protects the in-memory state.
+        self._connection = sqlite3.connect(
+            str(self._folder / "index.sqlite"),
+            timeout=600.0,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._lock = threading.RLock()
+        self._connection.executescript(_SCHEMA)
+
+        self._meta = {}
+        self._receivers = []
+        self._segments = []
+        # Memory-mapped data, has_data, and energy arrays per segment id. The
+        # latter is None for stores without energy.
+        self._maps = {}
+        self._receiver_sets = {}
+        self._files = {}
+
+        version = self._get_meta_value("version")
+        if version is not None and int(version) != INDEX_STORE_VERSION:
+            logger.warning(
+                f"Index store '{self._folder}' has version {version}. Expected "
+                f"version {INDEX_STORE_VERSION}. Will rebuild it."
+            )
+            self._clear()
+        elif version is not None and self._get_meta_value("with_energy") != str(
+            int(self._with_energy)
+        ):
+            logger.warning(
+                f"Index store '{self._folder}' "
+                f"{'lacks' if self._with_energy else 'has'} the energy of each "
+                f"bin. Will rebuild it."
+            )
+            self._clear()
+        self._reload()
+
+    def _get_meta_value(self, key: str) -> typing.Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def _clear(self):
+        c = self._connection
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("DELETE FROM meta")
+            c.execute("DELETE FROM receiver_sets")
+            # The columns might have changed as well.
+            c.execute("DROP TABLE files")
+            c.execute(_FILES_TABLE)
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        self._remove_stale_files()
+
+    def _reload(self):
+        """
+        (Re-)read the meta information and memory-map all segments.
+        """
+        meta = dict(self._connection.execute("SELECT key, value FROM meta"))
+        if meta == self._meta:
+            return
+
+        self._meta = meta
+        if not meta:
+            self._receivers = []
+            self._segments = []
+            self._maps = {}
+            self._receiver_sets = {}
+            self._files = {}
+            return
+
+        self._receivers = json.loads(meta["receivers"])
+        self._segments = json.loads(meta["segments"])
+        # Only map segments that are new.
+        maps = {}
+        for s in self._segments:
+            if s["id"] in self._maps:
+                maps[s["id"]] = self._maps[s["id"]]
+                continue
+            maps[s["id"]] = (
+                np.memmap(
+                    self._data_filename(s["id"]),
+                    dtype=np.dtype(meta["dtype"]),
+                    mode="r+",
+                    shape=(len(self._receivers), s["capacity"], 2),
+                ),
+                np.memmap(
+                    self._has_data_filename(s["id"]),
+                    dtype=np.uint8,
+                    mode="r+",
+                    shape=(len(self._receivers), s["capacity"]),
+                ),
+                (
+                    np.memmap(
+                        self._energy_filename(s["id"]),
+                        dtype=np.float64,
+                        mode="r+",
+                        shape=(len(self._receivers), s["capacity"], 3),
+                    )
+                    if self._with_energy
+                    else None
+                ),
+            )
+        self._maps = maps
+
+    def _data_filename(self, segment_id: int) -> pathlib.Path:
+        return self._folder / f"minmax_{segment_id}.bin"
+
+    def _has_data_filename(self, segment_id: int) -> pathlib.Path:
+        return self._folder / f"has_data_{segment_id}.bin"
+
+    def _energy_filename(self, segment_id: int) -> pathlib.Path:
+        return self._folder / f"energy_{segment_id}.bin"
+
+    def _remove_stale_files(self):
+        """
+        Remove the files of all segments that are no longer in use.
+
+        Locks the store so no other process creates new segment files in the
+        meanwhile. Those would not be known yet.
+        """
+        c = self._connection
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            self._reload()
+            keep = set()
+            for s in self._segments:
+                keep.add(self._data_filename(s["id"]))
+                keep.add(self._has_data_filename(s["id"]))
+                keep.add(self._energy_filename(s["id"]))
+            for f in (
+                list(self._folder.glob("minmax_*.bin"))
+                + list(self._folder.glob("has_data_*.bin"))
+                + list(self._folder.glob("energy_*.bin"))
+            ):
+                if f in keep:
+                    continue
+                try:
+                    f.unlink()
+                # Might still be memory-mapped by another process on Windows.
+                # Will be deleted the next time around.
+                except PermissionError:  # pragma: no cover
+                    pass
+        finally:
+            c.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._maps = {}
+            self._connection.close()
+            if self._in_use is not None:
+                self._in_use.close()
+
+    @property
+    def folder(self) -> pathlib.Path:
+        return self._folder
+
+    @property
+    def is_empty(self) -> bool:
+        return not self._meta
+
+    @property
+    def receivers(self) -> typing.List[str]:
+        return self._receivers
+
+    @property
+    def with_energy(self) -> bool:
+        return self._with_energy
+
+    @property
+    def dt_ns(self) -> int:
+        """
+        Bin width in nanoseconds.
+        """
+        return self._dt_ns
+
+    @property
+    def data_sampling_rate_in_hz(self) -> float:
+        return float(self._meta["data_sampling_rate_in_hz"])
+
+    @property
+    def segments(self) -> typing.List[IndexSegment]:
+        """
+        All segments of the index, sorted by time.
+        """
+        with self._lock:
+            return [
+                IndexSegment(
+                    start_time_ns=s["start_time_ns"],
+                    npts=s["npts"],
+                    data=self._maps[s["id"]][0][:, : s["npts"]],
+                )
+                for s in self._segments
+            ]
+
+    def get_data(
+        self, receiver: str, start_time_ns: int, end_time_ns: int
+    ) -> typing.List[typing.Tuple[int, np.ndarray]]:
+        """
+        Get the bins of a receiver in a time window without copying.
+
+        Args:
+            receiver: The receiver.
+            start_time_ns: Start of the time window.
+            end_time_ns: End of the time window. The bin containing it is
+                still part of the returned data.
+
+        Returns:
+            One ``(start time of the first bin in ns, bins)`` tuple per
+            segment overlapping the window. Each bins array has shape
+            ``(npts, 2)``.
+        """
+        return self._get_pieces(
+            receiver=receiver,
+            start_time_ns=start_time_ns,
+            end_time_ns=end_time_ns,
+            which=0,
+        )
+
+    def get_energy(
+        self, receiver: str, start_time_ns: int, end_time_ns: int
+    ) -> typing.List[typing.Tuple[int, np.ndarray]]:
+        """
+        Get the energy bins of a receiver in a time window without copying.
+
+        Same as `get_data()` but each bins array has shape ``(npts, 3)``: the
+        number of samples, the sum, and the sum of squares of each bin. Bins
+        without data are all zero.
+        """
+        if not self._with_energy:
+            raise ValueError(f"Index store '{self._folder}' has no energy.")
+        return self._get_pieces(
+            receiver=receiver,
+            start_time_ns=start_time_ns,
+            end_time_ns=end_time_ns,
+            which=2,
+        )
+
+    def _get_pieces(
+        self, receiver: str, start_time_ns: int, end_time_ns: int, which: int
+    ) -> typing.List[typing.Tuple[int, np.ndarray]]:
+        with self._lock:
+            if receiver not in self._receivers:
+                return []
+            r = self._receivers.index(receiver)
+            out = []
+            for s in self._segments:
+                i0 = max((start_time_ns - s["start_time_ns"]) // self._dt_ns, 0)
+                i1 = min(
+                    (end_time_ns - s["start_time_ns"]) // self._dt_ns + 1, s["npts"]
+                )
+                if i1 > i0:
+                    out.append(
+                        (
+                            s["start_time_ns"] + i0 * self._dt_ns,
+                            self._maps[s["id"]][which][r, i0:i1],
+                        )
+                    )
+            return out
+
+    def _load_files(self):
+        if self._files:
+            return
+        self._receiver_sets = {
+            i: json.loads(r)
+            for i, r in self._connection.execute(
+                "SELECT id, receivers FROM receiver_sets"
+            )
+        }
+        self._files = {
+            path: (mtime_ns, size, receiver_set)
+            for path, mtime_ns, size, receiver_set in self._connection.execute(
+                "SELECT path, mtime_ns, size, receiver_set FROM files"
+            )
+        }
+
+    def is_indexed(self, filename: pathlib.Path, mtime_ns: int, size: int) -> bool:
+        """
+        Check if a file has already been indexed and did not change since.
+        """
+        with self._lock:
+            self._load_files()
+            f = self._files.get(str(filename))
+            return f is not None and f[0] == mtime_ns and f[1] == size
+
+    def get_receivers_for_file(self, filename: pathlib.Path) -> typing.List[str]:
+        """
+        Get all receivers that have been indexed for a certain file.
+        """
+        with self._lock:
+            self._load_files()
+            return self._receiver_sets[self._files[str(filename)][2]]
+
+    def get_files_without_hash(self) -> typing.List[typing.Tuple[str, int, int]]:
+        """
+        Path, modification time, and size of all files whose hash has not
+        yet been set.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT path, mtime_ns, size FROM files WHERE filehash = ''"
+            ).fetchall()
+
+    def set_filehash(
+        self, filename: pathlib.Path, mtime_ns: int, size: int, filehash: str
+    ) -> bool:
+        """
+        Set the hash of an indexed file. Nothing happens if the file changed
+        in the meanwhile.
+
+        Returns:
+            True if the hash has been set.
+        """
+        with self._lock:
+            return bool(
+                self._connection.execute(
+                    "UPDATE files SET filehash = ? WHERE path = ? AND "
+                    "mtime_ns = ? AND size = ?",
+                    (filehash, str(filename), mtime_ns, size),
+                ).rowcount
+            )
+
+    def add(
+        self,
+        filename: pathlib.Path,
+        mtime_ns: int,
+        size: int,
+        filehash: str,
+        index: typing.Dict,
+    ):
+        """
+        Add the index of a single file to the store.
+
+        Args:
+            filename: The indexed file.
+            mtime_ns: Modification time of the file in nanoseconds.
+            size: Size of the file in bytes.
+            filehash: Fingerprint of the file. Pass an empty string to set
+                it later with `set_filehash()`.
+            index: The index of all traces in the file. Must contain
+                ``"start_time_stamp_in_ns"``, ``"index_dt_ns"``,
+                ``"data_sampling_rate_in_hz"``, ``"receivers"``, and
+                ``"data"`` with shape ``(receivers, 2, npts)``. Stores with
+                energy also need ``"energy"`` with shape
+                ``(receivers, 3, npts)``.
+        """
+        with self._lock:
+            assert index["index_dt_ns"] == self._dt_ns
+            c = self._connection
+            # Lock the store so only one process at a time writes to it.
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                self._reload()
+                self._remove_file(filename=filename)
+                self._add(index=index)
+
+                receivers = json.dumps(index["receivers"])
+                c.execute(
+                    "INSERT OR IGNORE INTO receiver_sets (receivers) VALUES (?)",
+                    (receivers,),
+                )
+                (receiver_set,) = c.execute(
+                    "SELECT id FROM receiver_sets WHERE receivers = ?", (receivers,)
+                ).fetchone()
+                c.execute(
+                    "INSERT OR REPLACE INTO files (path, mtime_ns, size, filehash, "
+                    "receiver_set, start_time_ns, npts, edge_data, edge_energy) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        str(filename),
+                        mtime_ns,
+                        size,
+                        filehash,
+                        receiver_set,
+                        int(index["start_time_stamp_in_ns"]),
+                        int(index["data"].shape[-1]),
+                        _get_edges(index["data"]),
+                        (_get_edges(index["energy"]) if self._with_energy else None),
+                    ),
+                )
+                self._meta["segments"] = json.dumps(self._segments)
+                for key, value in self._meta.items():
+                    c.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                        (key, value),
+                    )
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                raise
+            self._remove_stale_files()
+
+            # Keep the in-memory list of files current if it has been loaded.
+            if self._files:
+                self._receiver_sets[receiver_set] = list(index["receivers"])
+                self._files[str(filename)] = (mtime_ns, size, receiver_set)
+
+    def _remove_file(self, filename: pathlib.Path):
+        """
+        Remove an already indexed file before it is added again.
+
+        Its bins are cleared. The first and last bin are shared with the
+        neighboring files and are rebuilt from their stored edges.
+        """
+        c = self._connection
+        row = c.execute(
+            "SELECT receivers, start_time_ns, npts FROM files "
+            "JOIN receiver_sets ON files.receiver_set = receiver_sets.id "
+            "WHERE path = ?",
+            (str(filename),),
+        ).fetchone()
+        if row is None:
+            return
+        receivers = json.loads(row[0])
+        start_time_ns, npts = row[1], row[2]
+        for s in self._segments:
+            if s["start_time_ns"] <= start_time_ns < self._segment_end(s):
+                break
+        else:
+            return
+        data, has_data, energy = self._maps[s["id"]]
+        indices = [self.receivers.index(r) for r in receivers]
+        b0 = (start_time_ns - s["start_time_ns"]) // self._dt_ns
+        b1 = min(b0 + npts, s["npts"])
+        has_data[indices, b0:b1] = 0
+        data[indices, b0:b1] = 0
+        if energy is not None:
+            energy[indices, b0:b1] = 0.0
+
+        for b in {b0, b1 - 1}:
+            t = s["start_time_ns"] + b * self._dt_ns
+            neighbors = c.execute(
+                "SELECT receivers, start_time_ns, edge_data, edge_energy FROM files "
+                "JOIN receiver_sets ON files.receiver_set = receiver_sets.id "
+                "WHERE path != ? AND (start_time_ns = ? OR "
+                "start_time_ns + (npts - 1) * ? = ?)",
+                (str(filename), t, self._dt_ns, t),
+            ).fetchall()
+            for n_receivers, n_start_time_ns, edge_data, edge_energy in neighbors:
+                n_receivers = json.loads(n_receivers)
+                shape = (len(n_receivers), -1, 2)
+                column = 0 if n_start_time_ns == t else 1
+                edge_data = np.frombuffer(edge_data, dtype=np.float64).reshape(shape)
+                if edge_energy is not None and energy is not None:
+                    edge_energy = np.frombuffer(edge_energy, dtype=np.float64).reshape(
+                        shape
+                    )
+                for j, receiver in enumerate(n_receivers):
+                    if receiver not in receivers:
+                        continue
+                    r = self.receivers.index(receiver)
+                    min_value, max_value = edge_data[j, :, column]
+                    if has_data[r, b]:
+                        data[r, b, 0] = min(data[r, b, 0], min_value)
+                        data[r, b, 1] = max(data[r, b, 1], max_value)
+                    else:
+                        data[r, b] = (min_value, max_value)
+                    if energy is not None:
+                        energy[r, b] += edge_energy[j, :, column]
+                    has_data[r, b] = 1
+        data.flush()
+        has_data.flush()
+        if energy is not None:
+            energy.flush()
+
+    def _add(self, index: typing.Dict):
+        chunk = index["data"]
+        chunk_start = int(index["start_time_stamp_in_ns"])
+        chunk_end = chunk_start + chunk.shape[-1] * self._dt_ns
+
+        if self.is_empty:
+            self._receivers = sorted(index["receivers"])
+            self._meta.update(
+                {
+                    "version": str(INDEX_STORE_VERSION),
+                    "receivers": json.dumps(self._receivers),
+                    "dtype": np.dtype(chunk.dtype).str,
+                    "data_sampling_rate_in_hz": repr(
+                        float(index["data_sampling_rate_in_hz"])
+                    ),
+                    "with_energy": str(int(self._with_energy)),
+                    "next_segment_id": "0",
+                }
+            )
+        elif index["data_sampling_rate_in_hz"] != self.data_sampling_rate_in_hz:
+            raise ValueError(
+                f"Data sampling rate of {index['data_sampling_rate_in_hz']} Hz does "
+                f"not match the sampling rate of the remaining data "
+                f"({self.data_sampling_rate_in_hz} Hz)."
+            )
+
+        # New receivers or a different dtype require rewriting all segments.
+        receivers = sorted(set(self.receivers).union(index["receivers"]))
+        dtype = np.result_type(np.dtype(self._meta["dtype"]), chunk.dtype)
+        if receivers != self.receivers or dtype != np.dtype(self._meta["dtype"]):
+            old_receivers = self.receivers
+            self._receivers = receivers
+            self._meta["receivers"] = json.dumps(receivers)
+            self._meta["dtype"] = np.dtype(dtype).str
+            for s in list(self._segments):
+                self._new_segment(
+                    start_time_ns=s["start_time_ns"],
+                    npts=s["npts"],
+                    sources=[s],
+                    source_receivers=old_receivers,
+                )
+
+        # All segments the chunk overlaps with or is close enough to.
+        sources = [
+            s
+            for s in self._segments
+            if s["start_time_ns"] - self._max_gap_ns <= chunk_end
+            and chunk_start <= self._segment_end(s) + self._max_gap_ns
+        ]
+        start_time_ns = min([chunk_start] + [s["start_time_ns"] for s in sources])
+        end_time_ns = max([chunk_end] + [self._segment_end(s) for s in sources])
+        npts = (end_time_ns - start_time_ns) // self._dt_ns
+
+        # Appending to a single segment can be done in place.
+        if (
+            len(sources) == 1
+            and sources[0]["start_time_ns"] == start_time_ns
+            and npts <= sources[0]["capacity"]
+        ):
+            segment = sources[0]
+            segment["npts"] = npts
+        else:
+            segment = self._new_segment(
+                start_time_ns=start_time_ns,
+                npts=npts,
+                sources=sources,
+                source_receivers=self.receivers,
+            )
+
+        data, has_data, energy = self._maps[segment["id"]]
+        indices = np.array(
+            [self.receivers.index(r) for r in index["receivers"]], dtype=np.int64
+        )
+        idx = (chunk_start - start_time_ns) // self._dt_ns
+        if energy is not None:
+            _add_energy_to_index(
+                energy=np.asarray(energy),
+                has_data=np.asarray(has_data),
+                indices=indices,
+                idx=idx,
+                energy_chunk=np.asarray(index["energy"], dtype=np.float64),
+            )
+            energy.flush()
+        _add_to_index(
+            data=np.asarray(data),
+            has_data=np.asarray(has_data),
+            indices=indices,
+            idx=idx,
+            data_chunk=chunk,
+        )
+        data.flush()
+        has_data.flush()
+
+    def _segment_end(self, segment: typing.Dict) -> int:
+        return segment["start_time_ns"] + segment["npts"] * self._dt_ns
+
+    def _new_segment(
+        self,
+        start_time_ns: int,
+        npts: int,
+        sources: typing.List[typing.Dict],
+        source_receivers: typing.List[str],
+    ) -> typing.Dict:
+        """
+        Create a new segment, copying the data of all source segments into it
+        and replacing them.
+        """
+        capacity = npts + int(npts * _GROWTH_FACTOR) + 1
+        segment_id = int(self._meta["next_segment_id"])
+        self._meta["next_segment_id"] = str(segment_id + 1)
+
+        data = np.memmap(
+            self._data_filename(segment_id),
+            dtype=np.dtype(self._meta["dtype"]),
+            mode="w+",
+            shape=(len(self.receivers), capacity, 2),
+        )
+        has_data = np.memmap(
+            self._has_data_filename(segment_id),
+            dtype=np.uint8,
+            mode="w+",
+            shape=(len(self.receivers), capacity),
+        )
+        energy = None
+        if self._with_energy:
+            energy = np.memmap(
+                self._energy_filename(segment_id),
+                dtype=np.float64,
+                mode="w+",
+                shape=(len(self.receivers), capacity, 3),
+            )
+
+        if sources:
+            logger.info(
+                f"Rewriting waveform index '{self._folder}' with a segment of "
+                f"{capacity} samples."
+            )
+        for s in sources:
+            offset = (s["start_time_ns"] - start_time_ns) // self._dt_ns
+            old_data, old_has_data, old_energy = self._maps.pop(s["id"])
+            n = s["npts"]
+            for i, r in enumerate(source_receivers):
+                j = self.receivers.index(r)
+                data[j, offset : offset + n] = old_data[i, :n]
+                has_data[j, offset : offset + n] = old_has_data[i, :n]
+                if energy is not None:
+                    energy[j, offset : offset + n] = old_energy[i, :n]
+            self._segments.remove(s)
+        data.flush()
+        has_data.flush()
+        if energy is not None:
+            energy.flush()
+
+        segment = {
+            "id": segment_id,
+            "start_time_ns": start_time_ns,
+            "npts": npts,
+            "capacity": capacity,
+        }
+        self._maps[segment_id] = (data, has_data, energy)
+        self._segments.append(segment)
+        self._segments.sort(key=lambda x: x["start_time_ns"])
+        return segment
@@ -26,24 +26,79 @@ import numpy as np
 import obspy
 
 
-def index_trace(trace: obspy.Trace, index_sampling_rate_in_hz: int):
+def index_trace(
+    trace: obspy.Trace,
+    index_sampling_rate_in_hz: int,
+    pyramid_level_dts: typing.Optional[typing.List[int]] = None,
+):
+    """
+    Compute the min/max and energy index of a trace.
+
+    Args:
+        trace: The trace to index.
+        index_sampling_rate_in_hz: The desired sampling rate of the index.
+        pyramid_level_dts: If given, also compute a min/max pyramid with
+            these bin widths in nanoseconds in the same pass over the data.
+            See `compute_pyramid_dts()`. It is stored under ``"pyramid"``
+            with one dictionary per level.
+    """
     # Must be an integer because it internally bins and the bins are per
     # second.
     assert isinstance(index_sampling_rate_in_hz, int)
-    start_time_in_ns, min_values, max_values = _internal_index_trace(
+    (
+        start_time_in_ns,
+        min_values,
+        max_values,
+        energy,
+        pyramid_start_bin,
+        pyramid_min_values,
+        pyramid_max_values,
+    ) = _internal_index_trace(
         data=trace.data,
         starttime_in_ns=trace.stats.starttime.ns,
         sampling_rate_in_hz=trace.stats.sampling_rate,
         index_sampling_rate_in_hz=index_sampling_rate_in_hz,
+        pyramid_dt_ns=pyramid_level_dts[0] if pyramid_level_dts else 0,
     )
 
-    return {
+    out = {
         "start_time_stamp_in_ns": start_time_in_ns,
         "data_sampling_rate_in_hz": trace.stats.sampling_rate,
         "index_sampling_rate_in_hz": index_sampling_rate_in_hz,
         "min_values": min_values,
         "max_values": max_values,
+        # Number of samples, sum, and sum of squares per bin.
+        "energy": energy,
     }
+    if pyramid_level_dts:
+        out["pyramid"] = _build_pyramid(
+            start_bin=pyramid_start_bin,
+            min_values=pyramid_min_values,
+            max_values=pyramid_max_values,
+            level_dts=pyramid_level_dts,
+        )
+    return out
+
+
+def energy_to_rms(energy: np.ndarray) -> np.ndarray:
+    """
+    RMS amplitude around the mean of each bin of an energy index.
+
+    Removing the mean makes it independent of any DC offset of the sensor.
+
+    Args:
+        energy: Number of samples, sum, and sum of squares of each bin along
+            the last axis.
+
+    Returns:
+        The RMS of each bin. Bins without any samples are zero.
+    """
+    n = energy[..., 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = energy[..., 1] / n
+        variance = energy[..., 2] / n - mean**2
+    # Rounding errors can make it slightly negative.
+    return np.sqrt(np.clip(np.nan_to_num(variance, nan=0.0), 0.0, None))
 
 
 @numba.jit(nopython=True, cache=True)
@@ -52,7 +107,13 @@ def _internal_index_trace(
     starttime_in_ns: int,
     sampling_rate_in_hz: float,
     index_sampling_rate_in_hz: float,
+    pyramid_dt_ns: int,
 ):
+    """
+    Compute the index of a trace and, if ``pyramid_dt_ns`` is larger than
+    zero, the finest level of its min/max pyramid in a single pass over the
+    data. The pyramid arrays are empty otherwise.
+    """
     # Sample spacing in nanoseconds for the actual time array and the desired
     # indexing.
     dt_ns = int(round((1.0 / sampling_rate_in_hz) * 1e9))
@@ -78,13 +139,48 @@ def _internal_index_trace(
 
     min_values = np.empty(size, dtype=data.dtype)
     max_values = np.empty(size, dtype=data.dtype)
+    # Number of samples, sum, and sum of squares - accumulated in the same
+    # pass so the RMS of each bin is available without reading the data
+    # again.
+    energy = np.zeros((size, 3), dtype=np.float64)
 
     current_min_value = data[0]
     current_max_value = data[0]
 
+    # The pyramid is aligned to multiples of its bin width since the epoch and
+    # each bin contains the samples in [bin start, bin end).
+    with_pyramid = pyramid_dt_ns > 0
+    pyramid_start_bin = 0
+    pyramid_size = 0
+    if with_pyramid:
+        pyramid_start_bin = starttime_in_ns // pyramid_dt_ns
+        pyramid_size = (
+            time_of_last_sample_in_ns // pyramid_dt_ns - pyramid_start_bin + 1
+        )
+    pyramid_min_values = np.empty(pyramid_size, dtype=data.dtype)
+    pyramid_max_values = np.empty(pyramid_size, dtype=data.dtype)
+    pyramid_idx = 0
+    pyramid_next_boundary = (pyramid_start_bin + 1) * pyramid_dt_ns
+    pyramid_min_value = data[0]
+    pyramid_max_value = data[0]
+
     idx = 0
     current_sample_time = starttime_in_ns
     for t in data:
+        if with_pyramid:
+            if current_sample_time >= pyramid_next_boundary:
+                # Possibly more than one bin if the bins are smaller than the
+                # sample spacing.
+                while current_sample_time >= pyramid_next_boundary:
+                    pyramid_min_values[pyramid_idx] = pyramid_min_value
+                    pyramid_max_values[pyramid_idx] = pyramid_max_value
+                    pyramid_idx += 1
+                    pyramid_next_boundary += pyramid_dt_ns
+                pyramid_min_value = t
+                pyramid_max_value = t
+            pyramid_min_value = min(pyramid_min_value, t)
+            pyramid_max_value = max(pyramid_max_value, t)
+
         # Add to lists and continue.
         if current_sample_time > current_end_time:
             min_values[idx] = current_min_value
@@ -101,98 +197,108 @@ def _internal_index_trace(
         elif t < current_min_value:
             current_min_value = t
 
+        v = float(t)
+        energy[idx, 0] += 1.0
+        energy[idx, 1] += v
+        energy[idx, 2] += v * v
+
         # Increment the time of the current array sample.
         current_sample_time += dt_ns
 
     min_values[idx] = current_min_value
     max_values[idx] = current_max_value
+    if with_pyramid:
+        pyramid_min_values[pyramid_idx] = pyramid_min_value
+        pyramid_max_values[pyramid_idx] = pyramid_max_value
+
+    return (
+        start_time_in_ns,
+        min_values,
+        max_values,
+        energy,
+        pyramid_start_bin,
+        pyramid_min_values,
+        pyramid_max_values,
+    )
 
-    return (start_time_in_ns, min_values, max_values)
-
-
-def _compute_times(cache: typing.Dict):
-    starttime = cache["start_time_stamp_in_ns"]
-    # Do integer maths here to not accumulate rounding errors.
-    # At some earlier stage we made sure it divides nicely.
-    dt_ns = int(round(1.0 / cache["index_sampling_rate_in_hz"] * 1e9))
-    endtime = starttime + (cache["data"].shape[-1] - 1) * dt_ns
-    return starttime, endtime, dt_ns
-
-
-def combine_caches(caches: typing.List[typing.Dict]):
-    # Sort by time.
-    caches = sorted(caches, key=lambda x: x["start_time_stamp_in_ns"])
-
-    receivers = set()
-
-    # First loop to get all as well as the smallest start and largest endtime.
-    starttime, endtime, dt_ns = _compute_times(caches[0])
-    for c in caches:
-        s, e, dt = _compute_times(c)
-        if s < starttime:
-            starttime = s
-        if e > endtime:
-            endtime = e
-        receivers = receivers.union(set(c["receivers"]))
-        assert dt_ns == dt
-
-    receiver_list = sorted(receivers)
-    npts = int(round((endtime - starttime) / dt_ns)) + 1
-
-    data = np.zeros((len(receiver_list), 2, npts), dtype=caches[0]["data"].dtype)
-    has_data_mask = np.zeros(npts, dtype=bool)
 
-    for _i, cache in enumerate(caches):
-        # Map to the receiver indices.
-        indices = np.array(
-            [receiver_list.index(i) for i in cache["receivers"]], dtype=np.int32
-        )
-        _add_to_combined_data(
-            dt_ns=dt_ns,
-            start_time_in_ns=starttime,
-            indices=indices,
-            data=data,
-            has_data_mask=has_data_mask,
-            start_time_in_ns_chunk=cache["start_time_stamp_in_ns"],
-            data_chunk=cache["data"],
-        )
+@numba.jit(nopython=True, cache=True)
+def _add_to_index(
+    data: np.ndarray,
+    has_data: np.ndarray,
+    indices: np.ndarray,
+    idx: int,
+    data_chunk: np.ndarray,
+):
+    """
+    Write the index of a single file into a larger index.
 
-    return {
-        "receivers": receiver_list,
-        "data": data,
-        "start_time_stamp_in_ns": starttime,
-        "cache_dt_ns": dt_ns,
-        "data_sampling_rate_in_hz": caches[0]["data_sampling_rate_in_hz"],
-    }
+    Args:
+        data: The large index with shape ``(receivers, npts, 2)``.
+        has_data: Whether or not each bin of the large index already has data,
+            shape ``(receivers, npts)``.
+        indices: The receiver index in the large index for each receiver in
+            the chunk.
+        idx: Index of the first bin of the chunk in the large index.
+        data_chunk: The index of a single file with shape
+            ``(receivers, 2, chunk_npts)``.
+    """
+    n = data_chunk.shape[-1]
+    for _i in range(n):
+        # The first and last bins are shared with the neighboring files.
+        edge = _i == 0 or _i == n - 1
+        for _j in range(data_chunk.shape[0]):
+            r = indices[_j]
+            min_value = data_chunk[_j, 0, _i]
+            max_value = data_chunk[_j, 1, _i]
+            if edge and has_data[r, idx]:
+                if min_value < data[r, idx, 0]:
+                    data[r, idx, 0] = min_value
+                if max_value > data[r, idx, 1]:
+                    data[r, idx, 1] = max_value
+            else:
+                data[r, idx, 0] = min_value
+                data[r, idx, 1] = max_value
+            has_data[r, idx] = 1
+        idx += 1
 
 
 @numba.jit(nopython=True, cache=True)
-def _add_to_combined_data(
-    dt_ns: int,
-    start_time_in_ns: int,
+def _add_energy_to_index(
+    energy: np.ndarray,
+    has_data: np.ndarray,
     indices: np.ndarray,
-    data: np.ndarray,
-    has_data_mask: np.ndarray,
-    start_time_in_ns_chunk: int,
-    data_chunk: np.ndarray,
+    idx: int,
+    energy_chunk: np.ndarray,
 ):
-    idx = int(round((start_time_in_ns_chunk - start_time_in_ns) / dt_ns))
-
-    for _i in range(data_chunk.shape[-1]):
-        if has_data_mask[idx] is False:
-            for _j in range(data_chunk.shape[0]):
-                data[indices[_j], :, idx] = data_chunk[_j, :, _i]
-                has_data_mask[idx] = True
-        else:
-            for _j in range(data_chunk.shape[0]):
-                min_value = data_chunk[_j, 0, _i]
-                max_value = data_chunk[_j, 1, _i]
-
-                if min_value < data[indices[_j], 0, idx]:
-                    data[indices[_j], 0, idx] = min_value
-
-                if max_value > data[indices[_j], 1, idx]:
-                    data[indices[_j], 1, idx] = max_value
+    """
+    Write the energy index of a single file into a larger index. Must be
+    called before `_add_to_index()` as it relies on ``has_data`` not yet
+    being set for the file.
+
+    Args:
+        energy: The large energy index with shape ``(receivers, npts, 3)``.
+        has_data: Whether or not each bin of the large index already has data,
+            shape ``(receivers, npts)``.
+        indices: The receiver index in the large index for each receiver in
+            the chunk.
+        idx: Index of the first bin of the chunk in the large index.
+        energy_chunk: The energy index of a single file with shape
+            ``(receivers, 3, chunk_npts)``.
+    """
+    n = energy_chunk.shape[-1]
+    for _i in range(n):
+        # The first and last bins are shared with the neighboring files. Their
+        # sums are added up - all other bins are replaced.
+        edge = _i == 0 or _i == n - 1
+        for _j in range(energy_chunk.shape[0]):
+            r = indices[_j]
+            accumulate = edge and has_data[r, idx]
+            for _k in range(3):
+                if accumulate:
+                    energy[r, idx, _k] += energy_chunk[_j, _k, _i]
+                else:
+                    energy[r, idx, _k] = energy_chunk[_j, _k, _i]
         idx += 1
 
 
@@ -214,3 +320,169 @@ def _interweave_arrays(a: np.ndarray, b: np.ndarray) -> np.ndarray:
     values[0::2] = a
     values[1::2] = b
     return values
+
+
+def decimate_min_max(
+    data: np.ndarray,
+    factor: int,
+    first_time: float,
+    dt: float,
+    values: typing.Optional[np.ndarray] = None,
+    times: typing.Optional[np.ndarray] = None,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Min and max of consecutive bins of ``factor`` samples in a single pass.
+
+    The last bin holds the remaining samples if the length of the data is
+    not a multiple of the factor.
+
+    Args:
+        data: The samples.
+        factor: Number of samples per bin.
+        first_time: Time of the first bin.
+        dt: Spacing of the bins.
+        values: Optional output buffer for the values, e.g. reused across
+            calls. Must have at least twice as many elements as there are
+            bins and the same dtype as the data.
+        times: Optional output buffer for the times, ``float64``.
+
+    Returns:
+        Interleaved min and max values and their times, i.e.
+        ``[min_0, max_0, min_1, max_1, ...]`` and ``[t_0, t_0, t_1, t_1, ...]``.
+    """
+    n_bins = -(-data.shape[0] // factor)
+    if values is None:
+        values = np.empty(2 * n_bins, dtype=data.dtype)
+    if times is None:
+        times = np.empty(2 * n_bins, dtype=np.float64)
+    values = values[: 2 * n_bins]
+    times = times[: 2 * n_bins]
+    _decimate_min_max(data, factor, first_time, dt, values, times)
+    return values, times
+
+
+@numba.jit(nopython=True, cache=True)
+def _decimate_min_max(
+    data: np.ndarray,
+    factor: int,
+    first_time: float,
+    dt: float,
+    values: np.ndarray,
+    times: np.ndarray,
+):
+    n = data.shape[0]
+    for i in range(values.shape[0] // 2):
+        start = i * factor
+        end = min(start + factor, n)
+        min_value = data[start]
+        max_value = data[start]
+        for j in range(start + 1, end):
+            # Branch-free so it can be vectorized.
+            min_value = min(min_value, data[j])
+            max_value = max(max_value, data[j])
+        values[2 * i] = min_value
+        values[2 * i + 1] = max_value
+        t = first_time + i * dt
+        times[2 * i] = t
+        times[2 * i + 1] = t
+
+
+def compute_pyramid_dts(
+    sampling_rate_in_hz: float,
+    finest_decimation: int,
+    factor: int = 4,
+    coarsest_dt_ns: int = 1_000_000_000,
+) -> typing.List[int]:
+    """
+    Bin widths of all levels of a min/max pyramid.
+
+    Args:
+        sampling_rate_in_hz: Sampling rate of the raw data.
+        finest_decimation: Decimation factor of the finest level relative to
+            the raw data.
+        factor: Each level is coarser than the previous one by this factor.
+        coarsest_dt_ns: No level has bins larger than this.
+
+    Returns:
+        Bin widths in nanoseconds, from fine to coarse.
+    """
+    dt_ns = int(round(1e9 / sampling_rate_in_hz)) * finest_decimation
+    dts = []
+    while dt_ns <= coarsest_dt_ns:
+        dts.append(dt_ns)
+        dt_ns *= factor
+    return dts
+
+
+def _build_pyramid(
+    start_bin: int,
+    min_values: np.ndarray,
+    max_values: np.ndarray,
+    level_dts: typing.List[int],
+) -> typing.List[typing.Dict]:
+    """
+    Compute all levels of a min/max pyramid from its finest level.
+
+    Unlike the bins of `index_trace()` the bins of each level are aligned to
+    multiples of the bin width since the epoch and each bin contains the
+    samples in ``[bin start, bin end)``. Thus any bin width in nanoseconds
+    works and the bins of adjacent files line up.
+
+    Args:
+        start_bin: Number of the first bin of the finest level since the epoch.
+        min_values: Minimum of each bin of the finest level.
+        max_values: Maximum of each bin of the finest level.
+        level_dts: Bin width of each level in nanoseconds. Each level must be
+            an integer multiple of the previous one.
+
+    Returns:
+        One dictionary per level.
+    """
+    levels = []
+    for i, dt_ns in enumerate(level_dts):
+        # Only the finest level is computed from the data - all others are
+        # reduced from the previous level.
+        if i:
+            start_bin, min_values, max_values = _reduce_min_max(
+                start_bin=start_bin,
+                min_values=min_values,
+                max_values=max_values,
+                factor=dt_ns // level_dts[i - 1],
+            )
+        levels.append(
+            {
+                "start_time_stamp_in_ns": start_bin * dt_ns,
+                "index_dt_ns": dt_ns,
+                "min_values": min_values,
+                "max_values": max_values,
+            }
+        )
+    return levels
+
+
+@numba.jit(nopython=True, cache=True)
+def _reduce_min_max(
+    start_bin: int, min_values: np.ndarray, max_values: np.ndarray, factor: int
+):
+    """
+    Compute the next coarser level of an epoch aligned min/max index.
+    """
+    new_start_bin = start_bin // factor
+    new_end_bin = (start_bin + min_values.shape[0] - 1) // factor
+    size = new_end_bin - new_start_bin + 1
+
+    new_min_values = np.empty(size, dtype=min_values.dtype)
+    new_max_values = np.empty(size, dtype=max_values.dtype)
+
+    for i in range(min_values.shape[0]):
+        idx = (start_bin + i) // factor - new_start_bin
+        if i == 0 or (start_bin + i) % factor == 0:
+            new_min_values[idx] = min_values[i]
+            new_max_values[idx] = max_values[i]
+            continue
+        if min_values[i] < new_min_values[idx]:
+            new_min_values[idx] = min_values[i]
+        if max_values[i] > new_max_values[idx]:
+            new_max_values[idx] = max_values[i]
+
+    return new_start_bin, new_min_values, new_max_values
@@ -0,0 +1,277 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Share a single waveform handler between multiple processes.
+
+The GUI, the live processing, and ad-hoc scripts all need the same
+waveforms. Instead of each of them keeping its own index, open files, and
+trace cache, a `WaveformServer` owns a `WaveformHandler` and serves requests
+over a Unix socket or a localhost TCP port. `WaveformClient` offers the same
+interface as the handler and forwards every call to the server.
+
+Requests and responses are pickled, so only clients knowing the shared
+secret of the server can connect and the server only listens on loopback
+addresses unless explicitly told otherwise.
+"""
+
+import ipaddress
+import logging
+import multiprocessing.connection
+import socket
+import threading
+import typing
+
+import obspy
+
+from .waveform_handler import WaveformHandler
+
+logger = logging.getLogger(__name__)
+
+# Methods that can be called remotely.
+_METHODS = {
+    "get_waveforms",
+    "get_filtered_waveforms",
+    "get_waveform_array",
+    "get_waveform_data",
+    "get_binned_index_data",
+    "get_rms_envelope",
+    "get_noise_levels",
+    "refresh",
+    "add_files",
+}
+# Methods changing the state of the handler. Never run concurrently.
+_MUTATING_METHODS = {"refresh", "add_files"}
+# Attributes that can be queried remotely.
+_ATTRIBUTES = {
+    "receivers",
+    "channel_list",
+    "sampling_rate",
+    "dt",
+    "starttime",
+    "endtime",
+    "time_ranges",
+    "gaps",
+    "_start_time",
+    "_end_time",
+    "_files",
+    "_waveform_folders",
+    "_pretty_total_size",
+}
+
+
+def parse_address(
+    address: str,
+) -> typing.Union[str, typing.Tuple[str, int]]:
+    """
+    Convert an address to what `multiprocessing.connection` expects.
+
+    ``"host:port"`` is a TCP address, everything else is the path of a Unix
+    socket.
+    """
+    host, sep, port = address.rpartition(":")
+    if sep and host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def _is_loopback(host: str) -> bool:
+    """
+    True if all addresses of the host are loopback addresses.
+    """
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return bool(infos) and all(
+        ipaddress.ip_address(info[4][0].split("%")[0]).is_loopback for info in infos
+    )
+
+
+class WaveformServer:
+    """
+    Serve a waveform handler to other processes.
+
+    Each connection is handled in its own thread. Reads run concurrently -
+    the handler's caches are thread-safe. Refreshing blocks other refreshes.
+    Reads wait while the handler reopens everything after files changed.
+
+    Args:
+        waveforms: The handler to serve.
+        address: ``"host:port"`` or the path of a Unix socket.
+        authkey: Shared secret clients must know.
+        allow_remote: Also allow hosts that are not loopback addresses. Only
+            do this in trusted networks - requests are pickled.
+    """
+
+    def __init__(
+        self,
+        waveforms: WaveformHandler,
+        address: str,
+        authkey: bytes,
+        allow_remote: bool = False,
+    ):
+        if not authkey:
+            raise ValueError("The waveform server requires an authkey.")
+        address = parse_address(address)
+        if isinstance(address, tuple) and not allow_remote:
+            if not _is_loopback(address[0]):
+                raise ValueError(
+                    f"Refusing to serve waveforms on '{address[0]}' which is not "
+                    "a loopback address. Pass allow_remote=True to do it anyway."
+                )
+        self.waveforms = waveforms
+        self._listener = multiprocessing.connection.Listener(address, authkey=authkey)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def address(self) -> typing.Union[str, typing.Tuple[str, int]]:
+        return self._listener.address
+
+    def serve_forever(self):
+        """
+        Accept and serve connections until `close()` is called.
+        """
+        logger.info(f"Serving waveforms on {self.address}.")
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+                if self._closed:
+                    break
+                logger.warning(f"Failed to accept connection: {e}")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self._closed = True
+        self._listener.close()
+
+    def _serve(self, conn: multiprocessing.connection.Connection):
+        with conn:
+            while True:
+                try:
+                    name, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = ("ok", self._handle(name, args, kwargs))
+                except Exception as e:
+                    response = ("error", e)
+                try:
+                    conn.send(response)
+                except (EOFError, OSError):
+                    return
+                except Exception as e:
+                    # Not picklable.
+                    conn.send(("error", RuntimeError(repr(e))))
+
+    def _handle(self, name: str, args: typing.Tuple, kwargs: typing.Dict):
+        if name in _ATTRIBUTES:
+            return getattr(self.waveforms, name)
+        if name not in _METHODS:
+            raise AttributeError(f"Cannot call '{name}' remotely.")
+        method = getattr(self.waveforms, name)
+        if name in _MUTATING_METHODS:
+            with self._lock:
+                return method(*args, **kwargs)
+        return method(*args, **kwargs)
+
+
+class WaveformClient:
+    """
+    Access the waveform handler of a `WaveformServer`.
+
+    Offers the same interface as `WaveformHandler`. Each thread uses its own
+    connection, so the client can be shared between threads.
+
+    Args:
+        address: Address of the server. See `WaveformServer`.
+        authkey: The shared secret of the server.
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self._address = parse_address(address)
+        self._authkey = authkey
+        self._local = threading.local()
+        # Fixed for the lifetime of the server.
+        self._start_time = self._call("_start_time")
+        self._end_time = self._call("_end_time")
+
+    def _get_connection(self) -> multiprocessing.connection.Connection:
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = self._local.connection = multiprocessing.connection.Client(
+                self._address, authkey=self._authkey
+            )
+        return conn
+
+    def _call(self, name: str, *args, **kwargs) -> typing.Any:
+        conn = self._get_connection()
+        try:
+            conn.send((name, args, kwargs))
+            status, value = conn.recv()
+        except (EOFError, OSError):
+            # Do not reuse a broken connection.
+            self._local.connection = None
+            raise
+        if status == "error":
+            raise value
+        return value
+
+    def close(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    def get_waveforms(self, *args, **kwargs) -> obspy.Stream:
+        return self._call("get_waveforms", *args, **kwargs)
+
+    def get_filtered_waveforms(self, *args, **kwargs) -> obspy.Stream:
+        return self._call("get_filtered_waveforms", *args, **kwargs)
+
+    def get_waveform_array(self, *args, **kwargs):
+        return self._call("get_waveform_array", *args, **kwargs)
+
+    def get_waveform_data(self, *args, **kwargs) -> typing.Dict:
+        return self._call("get_waveform_data", *args, **kwargs)
+
+    def get_binned_index_data(self, *args, **kwargs):
+        return self._call("get_binned_index_data", *args, **kwargs)
+
+    def get_rms_envelope(self, *args, **kwargs):
+        return self._call("get_rms_envelope", *args, **kwargs)
+
+    def get_noise_levels(self, *args, **kwargs) -> typing.Dict[str, float]:
+        return self._call("get_noise_levels", *args, **kwargs)
+
+    def refresh(self, *args, **kwargs) -> typing.Dict:
+        return self._call("refresh", *args, **kwargs)
+
+    def add_files(self, *args, **kwargs) -> typing.List:
+        return self._call("add_files", *args, **kwargs)
+
+    # Runs locally on top of `get_waveforms()` and `get_rms_envelope()`.
+    iter_intervals = WaveformHandler.iter_intervals
+    _drop_quiet_intervals = WaveformHandler._drop_quiet_intervals
+
+    def __getattr__(self, name: str) -> typing.Any:
+        # Only called for attributes not found the usual way.
+        if name in _ATTRIBUTES:
+            return self._call(name)
+        raise AttributeError(name)
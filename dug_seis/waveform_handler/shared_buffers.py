@@ -0,0 +1,249 @@
+# DUGSeis
+# Copyright (C) 2021 DUGSeis Authors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Waveforms in shared memory for multi-process pickers.
+
+Sending traces to worker processes pickles and copies their data for every
+single task. A `SharedWaveformBlock` instead stores the data of all traces
+in one `multiprocessing.shared_memory` block. Workers only receive a small
+`SharedTrace` descriptor and map the data without copying it.
+"""
+
+import typing
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import obspy
+
+from .waveform_handler import WaveformArray
+
+
+class SharedTrace(typing.NamedTuple):
+    """
+    Everything a worker process needs to map a single trace of a block.
+    """
+
+    #: Name of the shared memory block.
+    block_name: str
+    #: Shape of the whole block.
+    shape: typing.Tuple[int, int]
+    #: The dtype of the block as a string.
+    dtype: str
+    #: The row of the trace in the block.
+    row: int
+    #: Number of samples of the trace.
+    npts: int
+    #: Network, station, location, channel, sampling rate, and start time in
+    #: nanoseconds.
+    header: typing.Dict[str, typing.Any]
+    #: Resource tracker process of the process that created the block.
+    tracker_pid: typing.Optional[int]
+
+
+class SharedWaveformBlock:
+    """
+    A ``(traces, npts)`` array in shared memory plus the headers of each
+    trace.
+
+    The creating process owns the block and must `close()` it - best use it
+    as a context manager. Traces of different lengths are padded with zeros.
+
+    Args:
+        shape: Number of traces and maximum number of samples.
+        dtype: The dtype of the data.
+        headers: Header of each trace, see `SharedTrace.header`.
+        npts: Number of samples of each trace. Defaults to all of them.
+    """
+
+    def __init__(
+        self,
+        shape: typing.Tuple[int, int],
+        dtype: np.dtype,
+        headers: typing.List[typing.Dict[str, typing.Any]],
+        npts: typing.Optional[typing.List[int]] = None,
+    ):
+        if len(headers) != shape[0]:
+            raise ValueError("Need one header per trace.")
+        self._dtype = np.dtype(dtype)
+        self._shape = (int(shape[0]), int(shape[1]))
+        self._headers = list(headers)
+        self._npts = list(npts) if npts is not None else [self._shape[1]] * shape[0]
+        # Zero sized blocks are not possible.
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=max(self._dtype.itemsize * shape[0] * shape[1], 1)
+        )
+        self.data = np.ndarray(self._shape, dtype=self._dtype, buffer=self._shm.buf)
+
+    @classmethod
+    def from_stream(cls, st: obspy.Stream) -> "SharedWaveformBlock":
+        """
+        Copy the data of all traces of a stream into a new block.
+        """
+        npts = [tr.stats.npts for tr in st]
+        block = cls(
+            shape=(len(st), max(npts, default=0)),
+            dtype=(
+                np.result_type(*[tr.data.dtype for tr in st]) if len(st) else np.float64
+            ),
+            headers=[
+                {
+                    "network": tr.stats.network,
+                    "station": tr.stats.station,
+                    "location": tr.stats.location,
+                    "channel": tr.stats.channel,
+                    "sampling_rate": tr.stats.sampling_rate,
+                    "starttime_ns": tr.stats.starttime.ns,
+                }
+                for tr in st
+            ],
+            npts=npts,
+        )
+        block.data[:] = 0
+        for row, tr in enumerate(st):
+            block.data[row, : tr.stats.npts] = tr.data
+        return block
+
+    @classmethod
+    def from_waveform_array(cls, array: WaveformArray) -> "SharedWaveformBlock":
+        """
+        Copy a `WaveformArray` into a new block.
+        """
+        headers = []
+        for channel_id in array.channel_ids:
+            net, sta, loc, cha = channel_id.split(".")
+            headers.append(
+                {
+                    "network": net,
+                    "station": sta,
+                    "location": loc,
+                    "channel": cha,
+                    "sampling_rate": array.sampling_rate,
+                    "starttime_ns": array.start_time_ns,
+                }
+            )
+        block = cls(shape=array.data.shape, dtype=array.data.dtype, headers=headers)
+        block.data[:] = array.data
+        return block
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def traces(self) -> typing.List[SharedTrace]:
+        """
+        Descriptors of all traces, to be sent to worker processes.
+        """
+        return [
+            SharedTrace(
+                block_name=self.name,
+                shape=self._shape,
+                dtype=self._dtype.str,
+                row=row,
+                npts=npts,
+                header=header,
+                tracker_pid=_get_tracker_pid(),
+            )
+            for row, (npts, header) in enumerate(zip(self._npts, self._headers))
+        ]
+
+    def to_stream(self) -> obspy.Stream:
+        """
+        All traces as a stream. The data are views into the block and only
+        valid until it is closed.
+        """
+        return obspy.Stream(
+            [_to_trace(t, self.data) for t in self.traces],
+        )
+
+    def close(self):
+        """
+        Release and remove the block.
+        """
+        if self._shm is None:
+            return
+        self.data = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # Views handed out by `to_stream()` are still alive.
+            pass
+        self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self) -> "SharedWaveformBlock":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _to_trace(shared: SharedTrace, data: np.ndarray) -> obspy.Trace:
+    header = dict(shared.header)
+    header["starttime"] = obspy.UTCDateTime(ns=header.pop("starttime_ns"))
+    view = data[shared.row, : shared.npts]
+    # Shared with other processes - make sure nobody modifies it.
+    view.flags.writeable = False
+    return obspy.Trace(data=view, header=header)
+
+
+def _get_tracker_pid() -> typing.Optional[int]:
+    return getattr(resource_tracker._resource_tracker, "_pid", None)
+
+
+def _attach(shared: SharedTrace) -> shared_memory.SharedMemory:
+    """
+    Map an existing block.
+    """
+    try:
+        return shared_memory.SharedMemory(name=shared.block_name, track=False)
+    except TypeError:
+        # Python < 3.13 always tracks the block. A worker with its own
+        # resource tracker would remove the block as soon as it exits, so
+        # undo that. Forked and spawned workers share the tracker of their
+        # parent and must leave its registration alone.
+        shm = shared_memory.SharedMemory(name=shared.block_name)
+        tracker_pid = _get_tracker_pid()
+        if tracker_pid is not None and tracker_pid != shared.tracker_pid:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def call_with_shared_trace(
+    func: typing.Callable[..., typing.Any],
+    shared: SharedTrace,
+    *args,
+    **kwargs,
+) -> typing.Any:
+    """
+    Call ``func(trace, *args, **kwargs)`` with a trace mapped from shared
+    memory. Meant to be run in worker processes.
+
+    The trace data is read-only and only valid during the call.
+    """
+    shm = _attach(shared)
+    try:
+        data = np.ndarray(shared.shape, dtype=np.dtype(shared.dtype), buffer=shm.buf)
+        return func(_to_trace(shared, data), *args, **kwargs)
+    finally:
+        data = None
+        try:
+            shm.close()
+        except BufferError:
+            # Something still refers to the data. The mapping is released
+            # once that is garbage collected.
+            pass
@@ -49,3 +49,62 @@ def compute_sha256_hash_for_file(
             if max_bytes is not None and checked_bytes >= max_bytes:
                 break
     return str(h.hexdigest())
+
+
+#: Available strategies to fingerprint waveform files.
+FINGERPRINT_STRATEGIES = ("size_mtime", "sampled", "full")
+
+
+def compute_file_fingerprint(
+    filename: pathlib.Path,
+    strategy: str = "sampled",
+    block_size: int = 1024 * 1024,
+    num_blocks: int = 8,
+) -> str:
+    """
+    Compute a fingerprint identifying the contents of a file.
+
+    Args:
+        filename: Path to the file.
+        strategy: One of
+
+            * ``"size_mtime"``: Only the size and the modification time. Does
+              not read the file at all.
+            * ``"sampled"``: sha256 hash of the size, the first and last block,
+              and a few evenly spaced blocks in between. The data chunks of
+              the traces are thus sampled without reading the whole file.
+            * ``"full"``: sha256 hash of the whole file.
+        block_size: Size of each sampled block in bytes.
+        num_blocks: Number of blocks between the first and the last one
+            for the ``"sampled"`` strategy.
+
+    Returns:
+        The fingerprint, prefixed by the strategy.
+    """
+    filename = pathlib.Path(filename)
+    if strategy == "size_mtime":
+        s = filename.stat()
+        return f"size_mtime:{s.st_size}:{s.st_mtime_ns}"
+    elif strategy == "full":
+        return f"full:{compute_sha256_hash_for_file(filename=filename)}"
+    elif strategy != "sampled":
+        raise ValueError(
+            f"Unknown fingerprint strategy '{strategy}'. Available strategies: "
+            f"{', '.join(FINGERPRINT_STRATEGIES)}."
+        )
+
+    h = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        size = fh.seek(0, 2)
+        h.update(str(size).encode())
+        # Small files are hashed completely.
+        if size <= block_size * (num_blocks + 2):
+            offsets = [0]
+            block_size = size
+        else:
+            step = (size - block_size) // (num_blocks + 1)
+            offsets = [i * step for i in range(num_blocks + 1)] + [size - block_size]
+        for offset in offsets:
+            fh.seek(offset)
+            h.update(fh.read(block_size))
+    return f"sampled:{h.hexdigest()}"
@@ -19,66 +19,345 @@ Object used to orchestrate, cache, and facilitate waveform access within
 DUGSeis.
 """
 
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import functools
-import hashlib
+import itertools
 import logging
-import re
 import pathlib
+import threading
+import time
 import typing
 
 import numpy as np
 import obspy
-import pyasdf
 import tqdm
 
-from ..util import pretty_filesize
-from .indexing import index_trace, combine_caches, _interweave_arrays
-from .utils import compute_sha256_hash_for_file
+from ..util import _compute_intervals, pretty_filesize
+from .backends import get_backend
+from .caching import LRUCache, ReadWriteLock, SharedHandle
+from .filtering import ButterworthFilter
+from .cache_manifest import CacheManifest
+from .catalog import CATALOG_VERSION, FILENAME_REGEX, FileCatalog  # noqa: F401
+from .index_store import INDEX_STORE_VERSION, IndexStore
+from .indexing import (
+    compute_pyramid_dts,
+    decimate_min_max,
+    energy_to_rms,
+    index_trace,
+    _interweave_arrays,
+)
+from .utils import FINGERPRINT_STRATEGIES, compute_file_fingerprint
 
 logger = logging.getLogger(__name__)
 
-FILENAME_REGEX = re.compile(
-    r"""
-^                                                              # Beginning of string
-(\d{4})_(\d{2})_(\d{2})T(\d{2})_(\d{2})_(\d{2})[_\.](\d{6})Z?  # Start time as capture groups
-__                                                             #
-(\d{4})_(\d{2})_(\d{2})T(\d{2})_(\d{2})_(\d{2})[_\.](\d{6})Z?  # End time as capture groups
-__
-.*                                                             # Rest of name
-$                                                              # End of string.
-""",
-    re.VERBOSE,
-)
+
+def _get_sample_range(
+    info: typing.Dict, start_time_ns: int, end_time_ns: int
+) -> typing.Tuple[int, int]:
+    """
+    Indices of the first and one past the last sample of a channel within a
+    time window. Like `obspy.Trace.trim()` it selects the nearest samples.
+    """
+    # Integer maths as far as possible to not accumulate rounding errors.
+    sr = info["sampling_rate"]
+    i0 = int(round((start_time_ns - info["start_time_ns"]) * sr / 1e9))
+    i1 = int(round((end_time_ns - info["start_time_ns"]) * sr / 1e9)) + 1
+    return max(i0, 0), min(i1, info["npts"])
+
+
+def _assemble_index(
+    cache: typing.Dict[str, typing.Dict], receivers: typing.List[str]
+) -> np.ndarray:
+    """
+    Assemble the min and max values of all traces in a file into a single
+    array with shape ``(receivers, 2, npts)``.
+    """
+    # Every trace in the file must have the same length.
+    assert len(set(len(i["min_values"]) for i in cache.values())) == 1
+    assert len(set(len(i["max_values"]) for i in cache.values())) == 1
+
+    data = np.empty(
+        (len(cache), 2, cache[receivers[0]]["min_values"].shape[0]),
+        # Make sure the dtype is the same as the data.
+        dtype=cache[receivers[0]]["min_values"].dtype,
+    )
+    for _i, r in enumerate(receivers):
+        data[_i, 0, :] = cache[r]["min_values"]
+        data[_i, 1, :] = cache[r]["max_values"]
+    return data
+
+
+def _assemble_energy(
+    cache: typing.Dict[str, typing.Dict], receivers: typing.List[str]
+) -> np.ndarray:
+    """
+    Assemble the per-bin energy of all traces in a file into a single array
+    with shape ``(receivers, 3, npts)``.
+    """
+    return np.stack([cache[r]["energy"].T for r in receivers])
 
 
-@functools.lru_cache(maxsize=20)
-def _get_open_asdf_file(filename: pathlib.Path) -> pyasdf.ASDFDataSet:
+def index_waveform_file(
+    filename: pathlib.Path,
+    index_sampling_rate_in_hz: int,
+    pyramid_finest_decimation: typing.Optional[int] = None,
+    backend: str = "asdf",
+) -> typing.Dict:
     """
-    Get an open ASDF file.
+    Compute the min/max and energy index for all traces in a single waveform
+    file.
 
-    Use a LRU cache to get fast repeated file accesses.
+    Args:
+        filename: The waveform file.
+        index_sampling_rate_in_hz: The desired sampling rate of the index.
+        pyramid_finest_decimation: If given, also compute a min/max pyramid
+            in the same pass over the data. This is the decimation factor of
+            the finest level relative to the raw data. See
+            `compute_pyramid_dts()` for the other levels.
+        backend: Name of the backend able to read the file.
     """
-    return pyasdf.ASDFDataSet(filename=str(filename), mode="r")
+    cache = {}
+    pyramid_cache = {}
+    # Open file and index each trace.
+    for tr in get_backend(backend).iter_traces(filename):
+        level_dts = None
+        if pyramid_finest_decimation:
+            level_dts = compute_pyramid_dts(
+                sampling_rate_in_hz=tr.stats.sampling_rate,
+                finest_decimation=pyramid_finest_decimation,
+            )
+        cache[tr.id] = index_trace(
+            trace=tr,
+            index_sampling_rate_in_hz=index_sampling_rate_in_hz,
+            pyramid_level_dts=level_dts,
+        )
+        if level_dts:
+            pyramid_cache[tr.id] = cache[tr.id]["pyramid"]
+
+    # Some sanity checks to make sure every trace is idencial.
+    sr = set(i["index_sampling_rate_in_hz"] for i in cache.values())
+    sr_d = set(i["data_sampling_rate_in_hz"] for i in cache.values())
+    st = set(i["start_time_stamp_in_ns"] for i in cache.values())
+    assert len(sr) == 1
+    assert len(st) == 1
+
+    index_sampling_rate_in_hz = list(sr)[0]
+    data_sampling_rate_in_hz = list(sr_d)[0]
+    start_time_stamp_in_ns = list(st)[0]
+
+    # Assemble into large dataset.
+    receivers = sorted(cache.keys())
+    data = _assemble_index(cache=cache, receivers=receivers)
+
+    pyramid = []
+    if pyramid_cache:
+        for i in range(len(pyramid_cache[receivers[0]])):
+            level = {r: pyramid_cache[r][i] for r in receivers}
+            assert len(set(v["start_time_stamp_in_ns"] for v in level.values())) == 1
+            pyramid.append(
+                {
+                    "start_time_stamp_in_ns": level[receivers[0]][
+                        "start_time_stamp_in_ns"
+                    ],
+                    "index_dt_ns": level[receivers[0]]["index_dt_ns"],
+                    "data_sampling_rate_in_hz": data_sampling_rate_in_hz,
+                    "receivers": receivers,
+                    "data": _assemble_index(cache=level, receivers=receivers),
+                }
+            )
 
+    return {
+        "start_time_stamp_in_ns": start_time_stamp_in_ns,
+        "index_sampling_rate_in_hz": index_sampling_rate_in_hz,
+        "index_dt_ns": int(round(1.0 / index_sampling_rate_in_hz * 1e9)),
+        "data_sampling_rate_in_hz": data_sampling_rate_in_hz,
+        "receivers": receivers,
+        "data": data,
+        "energy": _assemble_energy(cache=cache, receivers=receivers),
+        "pyramid": pyramid,
+    }
+
+
+def _hash_and_index_waveform_file(
+    filename: pathlib.Path, fingerprint: str, **kwargs
+) -> typing.Tuple[str, typing.Dict]:
+    """
+    Everything needed to add a file to the index. Top-level function so it
+    can be sent to worker processes.
 
-@functools.lru_cache(maxsize=200)
-def _get_channel_from_file(filename: pathlib.Path, channel_id: str) -> obspy.Trace:
+    Args:
+        filename: The waveform file.
+        fingerprint: The fingerprint strategy. Full hashes are not computed
+            here but later on in the background.
+        kwargs: Passed on to `index_waveform_file()`.
     """
-    Get an open ASDF file.
+    filehash = ""
+    if fingerprint != "full":
+        filehash = compute_file_fingerprint(filename=filename, strategy=fingerprint)
+    return filehash, index_waveform_file(filename=filename, **kwargs)
+
 
-    Use a LRU cache to get fast repeated file accesses.
+def _compute_full_hashes(folder: pathlib.Path, dt_ns: int, with_energy: bool):
+    """
+    Compute the full hash of all files in an index store that do not yet
+    have one. Runs in a background thread so it uses its own connection to
+    the store.
     """
-    # Get files - already cached.
-    ds = _get_open_asdf_file(filename)
+    store = IndexStore(folder=folder, dt_ns=dt_ns, with_energy=with_energy)
+    try:
+        files = store.get_files_without_hash()
+        for path, mtime_ns, size in files:
+            try:
+                filehash = compute_file_fingerprint(filename=path, strategy="full")
+            except OSError as e:
+                logger.warning(f"Could not hash file '{path}': {e}")
+                continue
+            store.set_filehash(
+                filename=path, mtime_ns=mtime_ns, size=size, filehash=filehash
+            )
+        logger.info(f"Computed the full hash of {len(files)} waveform file(s).")
+    finally:
+        store.close()
 
-    sta = ds.waveforms[".".join(channel_id.split(".")[:2])]
-    items = [i for i in sta.list() if i.startswith(channel_id)]
-    if not len(items):
-        raise ValueError(f"Could not find data for channel '{channel_id}'")
-    assert len(items) == 1, f"{items}"
-    st = sta[items[0]]
 
-    return st[0]
+_TimeRange = typing.Tuple[obspy.UTCDateTime, obspy.UTCDateTime]
+
+
+def _merge_time_ranges(
+    times: typing.List[typing.Tuple[int, int]], threshold_ns: int
+) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Merge (start, end) nanosecond timestamps to continuous time ranges.
+
+    Args:
+        times: The (start, end) timestamps, e.g. of files or of already
+            merged time ranges.
+        threshold_ns: Gaps up to this length do not split a time range.
+    """
+    time_ranges = []
+    for s, e in sorted(times):
+        # First time in the loop.
+        if not time_ranges:
+            time_ranges.append([s, e])
+            continue
+
+        # Latest time range.
+        lr = time_ranges[-1]
+
+        # New time range.
+        if s > (lr[1] + threshold_ns):
+            time_ranges.append([s, e])
+            continue
+
+        if e > lr[1]:
+            lr[1] = e
+    return [(s, e) for s, e in time_ranges]
+
+
+def _reading(method: typing.Callable) -> typing.Callable:
+    """
+    Run a method of the waveform handler while holding the read lock of its
+    state, so it never sees a half rebuilt handler. See
+    `WaveformHandler.refresh()`.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._state_lock.read():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _get_file_info(f: typing.Dict[str, typing.Any]) -> typing.Dict[str, int]:
+    """
+    What the handler keeps about a file of the catalog.
+    """
+    return {
+        "start_time_ns": f["start_time_ns"],
+        "end_time_ns": f["end_time_ns"],
+        "mtime_ns": f["mtime_ns"],
+        "size": f["size"],
+    }
+
+
+class _FileLookup(typing.NamedTuple):
+    """
+    Data structures to quickly find the files overlapping a time window.
+    """
+
+    # Files sorted by start time.
+    names: typing.List[pathlib.Path]
+    start_ns: np.ndarray
+    end_ns: np.ndarray
+    # Files might overlap so the end times are not necessarily sorted - the
+    # running maximum is and can be binary searched.
+    max_end_ns: np.ndarray
+    receiver_ids: typing.Dict[str, int]
+    # Receivers x files membership bitmap.
+    mask: np.ndarray
+
+    @classmethod
+    def create(
+        cls,
+        files: typing.Dict[pathlib.Path, typing.Dict],
+        receivers: typing.List[str],
+        filename_receivers_map: typing.Dict[pathlib.Path, typing.Set[str]],
+    ) -> "_FileLookup":
+        names = sorted(files.keys(), key=lambda x: (files[x]["start_time_ns"], str(x)))
+        end_ns = np.array([files[n]["end_time_ns"] for n in names], dtype=np.int64)
+        receiver_ids = {r: i for i, r in enumerate(receivers)}
+        mask = np.zeros((len(receivers), len(names)), dtype=bool)
+        for j, n in enumerate(names):
+            for r in filename_receivers_map[n]:
+                mask[receiver_ids[r], j] = True
+        return cls(
+            names=names,
+            start_ns=np.array(
+                [files[n]["start_time_ns"] for n in names], dtype=np.int64
+            ),
+            end_ns=end_ns,
+            max_end_ns=np.maximum.accumulate(end_ns),
+            receiver_ids=receiver_ids,
+            mask=mask,
+        )
+
+    def extend(self, other: "_FileLookup") -> "_FileLookup":
+        """
+        Append the files of another lookup with the same receivers that all
+        start after the files of this one.
+        """
+        return _FileLookup(
+            names=self.names + other.names,
+            start_ns=np.concatenate([self.start_ns, other.start_ns]),
+            end_ns=np.concatenate([self.end_ns, other.end_ns]),
+            max_end_ns=np.concatenate(
+                [
+                    self.max_end_ns,
+                    np.maximum(other.max_end_ns, self.max_end_ns[-1]),
+                ]
+            ),
+            receiver_ids=self.receiver_ids,
+            mask=np.concatenate([self.mask, other.mask], axis=1),
+        )
+
+
+class WaveformArray(typing.NamedTuple):
+    """
+    Waveform data of multiple channels as a single array.
+    """
+
+    #: Samples with shape ``(channels, samples)``.
+    data: np.ndarray
+    #: The channel of each row of the data.
+    channel_ids: typing.List[str]
+    #: Time of the first sample as a nanosecond timestamp.
+    start_time_ns: int
+    #: Sampling rate in Hz.
+    sampling_rate: float
 
 
 class WaveformHandler:
@@ -86,14 +365,47 @@ class WaveformHandler:
     Central class handling waveform access for DUGseis.
 
     Args:
-        waveform_folders: Folders containing the waveforms as ASDF files.
+        waveform_folders: Folders containing the waveform files.
         cache_folder: Some information about the files must be cached. Store
             that information here.
         index_sampling_rate_in_hz: The desired sampling rate of the waveform
             index.
         start_time: Limit temporal range.
         end_time: Limit temporal range.
-        existing_caches: List of already read caches.
+        num_workers: Number of processes used to index new files. Files are
+            indexed serially if this is 1.
+        trace_cache_size_in_bytes: Memory budget of the cache of decoded
+            waveform data.
+        trace_cache_chunk_size_in_samples: Waveform data is read and cached
+            in chunks of this many samples per channel, so overlapping and
+            adjacent time windows are served from the same chunks.
+        max_open_files: Maximum number of files kept open at any time.
+        pyramid_finest_decimation: Also keep a pyramid of min/max indices
+            with levels coarser by factors of 4 down to about 1 Hz. This is
+            the decimation factor of the finest level relative to the raw
+            data. Zoomed views are served from the closest level instead of
+            decoding raw data. No pyramid is kept if not given.
+        fingerprint: How newly indexed files are fingerprinted. One of
+            ``"size_mtime"``, ``"sampled"``, and ``"full"``. Full hashes
+            require reading every file a second time and are thus computed
+            in a background thread after indexing. See
+            `compute_file_fingerprint()` for details.
+        async_max_workers: Maximum number of threads used by the async
+            waveform access methods.
+        backend: Format of the waveform files. One of ``"asdf"``,
+            ``"raw_binary"``, and ``"mseed"``. See
+            `dug_seis.waveform_handler.backends` for details.
+        filters: The ``filters`` of the project configuration. Needed for
+            `get_filtered_waveforms()`.
+        filtered_cache_size_in_bytes: Memory budget of the cache of filtered
+            waveform data.
+        max_cache_folder_size_in_bytes: If given, the least recently used
+            catalogs and indices in the cache folder that are not open in
+            any process are removed once the cache folder grows larger.
+        full_scan_interval_in_seconds: Usually only new and removed files are
+            picked up when opening or refreshing the waveforms. Every this
+            many seconds all files are checked for changes, e.g. because they
+            have been modified in place. Only on request if None.
     """
 
     def __init__(
@@ -103,15 +415,185 @@ class WaveformHandler:
         index_sampling_rate_in_hz: int,
         start_time: obspy.UTCDateTime,
         end_time: obspy.UTCDateTime,
-        existing_caches: typing.Optional[typing.Dict] = None,
+        num_workers: int = 1,
+        trace_cache_size_in_bytes: int = 2 * 1024**3,
+        trace_cache_chunk_size_in_samples: int = 2**16,
+        max_open_files: int = 20,
+        pyramid_finest_decimation: typing.Optional[int] = None,
+        fingerprint: str = "sampled",
+        async_max_workers: int = 4,
+        backend: str = "asdf",
+        filters: typing.Optional[typing.List[typing.Dict]] = None,
+        filtered_cache_size_in_bytes: int = 256 * 1024**2,
+        max_cache_folder_size_in_bytes: typing.Optional[int] = None,
+        full_scan_interval_in_seconds: typing.Optional[float] = 24 * 3600.0,
     ):
         self._start_time = start_time
         self._end_time = end_time
         self._index_sampling_rate_in_hz = index_sampling_rate_in_hz
         self._waveform_folders = [pathlib.Path(i) for i in waveform_folders]
         self._cache_folder = pathlib.Path(cache_folder)
+        self._max_cache_folder_size_in_bytes = max_cache_folder_size_in_bytes
+        self._full_scan_interval_in_seconds = full_scan_interval_in_seconds
+        self._num_workers = max(int(num_workers), 1)
+        self._pyramid_finest_decimation = pyramid_finest_decimation
+        if fingerprint not in FINGERPRINT_STRATEGIES:
+            raise ValueError(
+                f"Unknown fingerprint strategy '{fingerprint}'. Available "
+                f"strategies: {', '.join(FINGERPRINT_STRATEGIES)}."
+            )
+        self._fingerprint = fingerprint
+        self._backend = get_backend(backend)
+        self._hash_thread = None
+        self._async_max_workers = max(int(async_max_workers), 1)
+        self._async_executor = None
+        # In-flight async reads shared by identical concurrent requests.
+        self._async_reads = {}
+        # Decoded traces, evicted by size. Use `.trace_cache.stats` to
+        # inspect it.
+        self.trace_cache = LRUCache(max_size=trace_cache_size_in_bytes)
+        self._trace_cache_chunk_size = max(int(trace_cache_chunk_size_in_samples), 1)
+        # Filtered traces, keyed by channel, time window, and filter id.
+        self.filtered_cache = LRUCache(max_size=filtered_cache_size_in_bytes)
+        self._filters = {
+            f["filter_id"]: ButterworthFilter(f["filter_settings"])
+            for f in (filters or [])
+        }
+        # State of causal filters at the end of each filtered window, keyed
+        # by the time of the next sample.
+        self._filter_states = LRUCache(max_size=10_000, get_size=lambda _: 1)
+        # Evicted files are closed as soon as no thread is reading from them.
+        self._open_files = LRUCache(
+            max_size=max_open_files,
+            get_size=lambda _: 1,
+            on_evict=lambda f: f.evict(),
+        )
+        self._channel_infos = LRUCache(max_size=100_000, get_size=lambda _: 1)
+        # Reads hold it shared, reopening everything holds it exclusively.
+        self._state_lock = ReadWriteLock()
         self._open_folder()
-        self._build_cache(existing_caches=existing_caches)
+        self._build_cache()
+
+    @contextlib.contextmanager
+    def _get_open_file(self, filename: pathlib.Path) -> typing.Iterator[typing.Any]:
+        """
+        Get an open waveform file. The most recently used files are kept open,
+        all others are closed.
+        """
+        while True:
+            f = self._open_files.get_or_create(
+                filename,
+                lambda: SharedHandle(
+                    handle=self._backend.open(filename), close=self._backend.close
+                ),
+            )
+            # Otherwise it has just been evicted by another thread.
+            if f.acquire():
+                break
+        try:
+            yield f.handle
+        finally:
+            f.release()
+
+    def _get_channel_info(self, filename: pathlib.Path, channel_id: str) -> typing.Dict:
+        """
+        Start time, sampling rate, and number of samples of a channel in a
+        file.
+        """
+
+        def _get():
+            with self._get_open_file(filename) as handle:
+                return self._backend.get_channel_info(handle, channel_id=channel_id)
+
+        return self._channel_infos.get_or_create((filename, channel_id), _get)
+
+    def _read_samples(
+        self,
+        filename: pathlib.Path,
+        channel_id: str,
+        info: typing.Dict,
+        i0: int,
+        i1: int,
+    ) -> np.ndarray:
+        """
+        Read samples ``[i0, i1)`` of a channel in a file. The returned array is
+        shared with the trace cache and thus read-only.
+
+        Whole chunks of ``trace_cache_chunk_size_in_samples`` samples are read
+        and cached so other windows overlapping them are cache hits.
+        """
+        n = self._trace_cache_chunk_size
+
+        def _read(c0, c1):
+            with self._get_open_file(filename) as handle:
+                data = self._backend.read(handle, info, c0, c1)
+            # Cached arrays are shared - make sure nobody modifies them.
+            data.flags.writeable = False
+            return data
+
+        chunks = [
+            (
+                c * n,
+                self.trace_cache.get_or_create(
+                    (filename, channel_id, c),
+                    lambda c=c: _read(c * n, min((c + 1) * n, info["npts"])),
+                ),
+            )
+            for c in range(i0 // n, (i1 - 1) // n + 1)
+        ]
+        if len(chunks) == 1:
+            c0, data = chunks[0]
+            return data[i0 - c0 : i1 - c0]
+        data = np.concatenate([d[max(i0 - c0, 0) : i1 - c0] for c0, d in chunks])
+        data.flags.writeable = False
+        return data
+
+    def _read_channel_slice(
+        self,
+        filename: pathlib.Path,
+        channel_id: str,
+        start_time_ns: int,
+        end_time_ns: int,
+        dtype: typing.Optional[np.dtype] = None,
+    ) -> typing.Optional[obspy.Trace]:
+        """
+        Read the part of a channel in a file that falls into a time window.
+
+        Only the chunks of the channel overlapping the window are read so the
+        cost is proportional to the length of the window. They are cached in
+        the trace cache.
+
+        Returns:
+            A new trace or `None` if the file has no samples in the window.
+        """
+        info = self._get_channel_info(filename=filename, channel_id=channel_id)
+        i0, i1 = _get_sample_range(
+            info=info, start_time_ns=start_time_ns, end_time_ns=end_time_ns
+        )
+        if i1 <= i0:
+            return None
+
+        data = self._read_samples(
+            filename=filename, channel_id=channel_id, info=info, i0=i0, i1=i1
+        )
+
+        net, sta, loc, cha = channel_id.split(".")
+        return obspy.Trace(
+            # Copy to hand out an independent trace. Converting the dtype is
+            # part of that copy.
+            data=data.astype(data.dtype if dtype is None else dtype),
+            header={
+                "network": net,
+                "station": sta,
+                "location": loc,
+                "channel": cha,
+                "sampling_rate": info["sampling_rate"],
+                "starttime": obspy.UTCDateTime(
+                    ns=info["start_time_ns"]
+                    + int(round(i0 * 1e9 / info["sampling_rate"]))
+                ),
+            },
+        )
 
     @property
     def starttime(self) -> obspy.UTCDateTime:
@@ -127,19 +609,50 @@ class WaveformHandler:
         """
         return max(t[1] for t in self._time_ranges)
 
+    @property
+    def time_ranges(self) -> typing.List[_TimeRange]:
+        """
+        Start and end time of each continuous stretch of data, sorted by time.
+        """
+        return [tuple(t) for t in self._time_ranges]
+
+    @property
+    def gaps(self) -> typing.List[_TimeRange]:
+        """
+        The gaps between the time ranges with data. Each gap is given by the
+        time of the last sample before and the first sample after it.
+        """
+        return [
+            (a[1], b[0]) for a, b in zip(self._time_ranges[:-1], self._time_ranges[1:])
+        ]
+
+    def _get_time_ranges_in_window(
+        self, start_time_ns: int, end_time_ns: int
+    ) -> typing.List[typing.Tuple[int, int]]:
+        """
+        The parts of a time window covered by data as nanosecond timestamps.
+        """
+        out = []
+        for s, e in self._time_ranges_ns:
+            s = max(s, start_time_ns)
+            e = min(e, end_time_ns)
+            if s <= e:
+                out.append((s, e))
+        return out
+
     @property
     def receivers(self) -> typing.List[str]:
         """
         List of all receivers.
         """
-        return self._cache["receivers"]
+        return self._receivers
 
     @property
     def channel_list(self) -> typing.List[str]:
         """
         Get a list of all channels.
         """
-        return self._cache["receivers"]
+        return self._receivers
 
     def _get_index_for_channel(self, channel_id: str) -> int:
         """
@@ -148,14 +661,14 @@ class WaveformHandler:
         Args:
             channel_id: Channel to use.
         """
-        return self.receivers.index(channel_id)
+        return self._index.receivers.index(channel_id)
 
     @property
     def sampling_rate(self) -> float:
         """
         Sampling rate in Hz.
         """
-        return self._cache["data_sampling_rate_in_hz"]
+        return self._index.data_sampling_rate_in_hz
 
     @property
     def dt(self) -> float:
@@ -165,244 +678,531 @@ class WaveformHandler:
         return 1.0 / self.sampling_rate
 
     @property
-    def _cache_start_timestamp_ns(self) -> int:
+    def _cache_dt_ns(self) -> int:
         """
-        Time of the first sample in the cache as a nanosecond timestamp.
+        Sample spacing of the the cache in nanoseconds.
         """
-        return self._cache["start_time_stamp_in_ns"]
+        return self._index.dt_ns
 
-    @property
-    def _cache_end_timestamp_ns(self) -> int:
-        """
-        Time of the last sample in the cache as a nanosecond timestamp.
-        """
-        return (
-            self._cache_start_timestamp_ns + (self._cache_npts - 1) * self._cache_dt_ns
+    def _build_cache(self):
+        self._cache_folder.mkdir(parents=True, exist_ok=True)
+
+        # One persistent index per project and index sampling rate.
+        name = f"minmax_index_{self._index_sampling_rate_in_hz}hz"
+        self._validate_cache_entry(
+            name=name, kind="index_store", version=INDEX_STORE_VERSION
+        )
+        self._index = IndexStore(
+            folder=self._cache_folder / name,
+            dt_ns=int(round(1.0 / self._index_sampling_rate_in_hz * 1e9)),
+            # Allows finding quiet intervals without reading any data.
+            with_energy=True,
         )
+        # The levels of the pyramid depend on the sampling rate of the data so
+        # they can only be opened once something has been indexed.
+        self._pyramid = {}
+        if self._pyramid_finest_decimation and not self._index.is_empty:
+            for dt_ns in compute_pyramid_dts(
+                sampling_rate_in_hz=self._index.data_sampling_rate_in_hz,
+                finest_decimation=self._pyramid_finest_decimation,
+            ):
+                self._get_pyramid_store(dt_ns=dt_ns)
+
+        self._index_files(files=self._files)
 
-    @property
-    def _cache_npts(self) -> int:
+        # Keep track of which file stores which receivers.
+        self._filename_receivers_map = {
+            name: set(self._index.get_receivers_for_file(filename=name))
+            for name in self._files.keys()
+        }
+        self._file_lookup, self._receivers = self._build_file_lookup(
+            files=self._files, filename_receivers_map=self._filename_receivers_map
+        )
+        self._update_cache_manifest()
+        self._start_hashing()
+
+    def _update_cache_manifest(self):
         """
-        Number of time samples in the binned cache.
+        Mark everything this handler uses as recently used, remove orphans,
+        and keep the cache folder within its budget.
         """
-        return self._cache["data"].shape[-1]
+        entries = {
+            self._backend.catalog_filename: ("catalog", CATALOG_VERSION),
+            **{
+                store.folder.name: ("index_store", INDEX_STORE_VERSION)
+                for store in [self._index, *self._pyramid.values()]
+            },
+        }
+        manifest = CacheManifest(folder=self._cache_folder)
+        try:
+            for name, (kind, version) in entries.items():
+                manifest.touch(
+                    name=name,
+                    kind=kind,
+                    version=version,
+                    sources=self._waveform_folders,
+                )
+            manifest.collect_garbage()
+            if self._max_cache_folder_size_in_bytes is not None:
+                manifest.evict(
+                    max_size=self._max_cache_folder_size_in_bytes, keep=entries.keys()
+                )
+        finally:
+            manifest.close()
 
-    @property
-    def _cache_dt_ns(self) -> int:
+    def _validate_cache_entry(self, name: str, kind: str, version: int):
         """
-        Sample spacing of the the cache in nanoseconds.
+        Remove an outdated entry of the cache folder before opening it.
         """
-        return self._cache["cache_dt_ns"]
+        manifest = CacheManifest(folder=self._cache_folder)
+        try:
+            manifest.validate(name=name, kind=kind, version=version)
+        finally:
+            manifest.close()
 
-    def _build_cache(self, existing_caches: typing.Optional[typing.Dict] = None):
-        self._cache_folder.mkdir(parents=True, exist_ok=True)
+    def _index_files(self, files: typing.Dict[pathlib.Path, typing.Dict]):
+        """
+        Add all files that are not yet part of the index to it.
+        """
+        missing = [
+            (name, info)
+            for name, info in files.items()
+            if not all(
+                store.is_indexed(
+                    filename=name, mtime_ns=info["mtime_ns"], size=info["size"]
+                )
+                for store in [self._index, *self._pyramid.values()]
+            )
+        ]
+        if missing:
+            logger.info(
+                f"Indexing {len(missing)} new or changed waveform file(s) using "
+                f"{min(self._num_workers, len(missing))} process(es)."
+            )
+        for name, info, filehash, index in tqdm.tqdm(
+            self._compute_indices(files=missing),
+            total=len(missing),
+            desc="Creating/updating cache",
+            disable=len(missing) <= 1,
+        ):
+            for level in [index, *index["pyramid"]]:
+                if level is index:
+                    store = self._index
+                else:
+                    store = self._get_pyramid_store(dt_ns=level["index_dt_ns"])
+                # Only missing from some of the stores, e.g. a new pyramid
+                # level.
+                if store.is_indexed(
+                    filename=name, mtime_ns=info["mtime_ns"], size=info["size"]
+                ):
+                    continue
+                store.add(
+                    filename=name,
+                    mtime_ns=info["mtime_ns"],
+                    size=info["size"],
+                    filehash=filehash,
+                    index=level,
+                )
 
-        caches = {}
+    def _start_hashing(self):
+        """
+        Compute missing full hashes in the background.
+        """
+        if self._fingerprint != "full":
+            return
+        if self._hash_thread is not None and self._hash_thread.is_alive():
+            return
+        if not self._index.get_files_without_hash():
+            return
+        self._hash_thread = threading.Thread(
+            target=_compute_full_hashes,
+            kwargs={
+                "folder": self._index.folder,
+                "dt_ns": self._index.dt_ns,
+                "with_energy": self._index.with_energy,
+            },
+            daemon=True,
+        )
+        self._hash_thread.start()
 
-        filename_receivers_map = {}
+    def refresh(
+        self, min_file_age_in_seconds: float = 0.0, full_scan: bool = False
+    ) -> typing.Dict[str, typing.List[pathlib.Path]]:
+        """
+        Pick up new, changed, and removed files in the waveform folders.
 
-        for name, info in tqdm.tqdm(
-            self._files.items(), desc="Creating/updating cache"
-        ):
-            # Reuse existing caches if necessary.
-            if existing_caches is None or name not in existing_caches:
-                single_file_cache = self._cache_single_file(filename=name, info=info)
-            else:
-                single_file_cache = existing_caches[name]
+        New files are indexed and appended to the existing index, so the cost
+        only depends on the number of new files and not on the amount of
+        data already there. Changed or removed files require reopening
+        everything, during which reads from other threads wait.
 
-            caches[name] = single_file_cache
-            filename_receivers_map[name] = set(single_file_cache["receivers"])
+        Args:
+            min_file_age_in_seconds: New or changed files modified more
+                recently than this are only picked up by a later refresh.
+                Avoids indexing files that are still being written.
+            full_scan: Also check all known files for changes. Otherwise
+                that only happens every ``full_scan_interval_in_seconds``.
+
+        Returns:
+            The added, updated, and removed files compared to what this
+            handler knew before. Files outside of the temporal range of the
+            handler are not part of it.
+        """
+        # The catalog is shared with other handlers using the same cache
+        # folder, which might have updated it already. Only look at what
+        # changed since this handler last looked at it and compare that to
+        # the files this handler knows about.
+        catalog = self._open_catalog()
+        try:
+            self._update_catalog(
+                catalog=catalog,
+                min_file_age_in_seconds=min_file_age_in_seconds,
+                full_scan=full_scan,
+            )
+            generation = catalog.generation
+            files, removed = {}, []
+            if generation != self._catalog_generation:
+                files = self._get_catalog_files(
+                    catalog=catalog, since_generation=self._catalog_generation
+                )
+                removed = catalog.get_removed_files(
+                    folders=self._waveform_folders,
+                    since_generation=self._catalog_generation,
+                )
+        finally:
+            catalog.close()
+
+        changes = {
+            "added": [f for f in files if f not in self._files],
+            "updated": [
+                f for f, v in files.items() if f in self._files and v != self._files[f]
+            ],
+            "removed": [f for f in removed if f in self._files],
+        }
+        if not changes["updated"] and not changes["removed"]:
+            if changes["added"]:
+                changes["added"] = self._add_new_files(
+                    files={f: files[f] for f in changes["added"]}
+                )
+            self._catalog_generation = generation
+            return changes
+
+        logger.info("Waveform files changed or were removed - reopening everything.")
+        # Concurrent reads wait until everything has been reopened.
+        with self._state_lock.write():
+            for store in [self._index, *self._pyramid.values()]:
+                store.close()
+            self.trace_cache.clear()
+            self.filtered_cache.clear()
+            self._filter_states.clear()
+            self._open_files.clear()
+            self._channel_infos.clear()
+            self._open_folder(update_catalog=False)
+            self._build_cache()
+        return changes
+
+    def add_files(self, paths: typing.List[pathlib.Path]) -> typing.List[pathlib.Path]:
+        """
+        Add new waveform files to the handler without touching the existing
+        ones.
 
-        # Combine everything into a single cache.
-        self._individual_caches = caches
-        self._cache = combine_caches(caches=list(caches.values()))
+        The files are added to the index and the file catalog. Files that
+        are already known, outside of the temporal range of the handler, or
+        that do not satisfy the filename convention are skipped.
 
-        # Keep track of which file stores which receivers.
-        self._filename_receivers_map = filename_receivers_map
+        Args:
+            paths: The new files. They must be in one of the waveform folders.
 
-    def _cache_single_file(self, filename: pathlib.Path, info: typing.Dict):
-        filename = filename.absolute()
+        Returns:
+            The files that have been added.
+        """
+        catalog = self._open_catalog()
+        try:
+            files = catalog.describe_files(paths=paths)
+            added = self._add_new_files(
+                files={
+                    f["path"]: _get_file_info(f)
+                    for f in files
+                    if f["start_time_ns"] <= self._end_time.ns
+                    and f["end_time_ns"] >= self._start_time.ns
+                }
+            )
+            # Only written to the catalog once they have been indexed so
+            # files that fail are offered again by the next refresh.
+            catalog.add_files(files=files)
+        finally:
+            catalog.close()
+        return added
+
+    def _add_new_files(
+        self, files: typing.Dict[pathlib.Path, typing.Dict]
+    ) -> typing.List[pathlib.Path]:
+        """
+        Index files within the temporal range of the handler and add them to
+        it. Files that are already known are skipped.
 
-        # hash the filename
-        file_hash = hashlib.sha256()
-        file_hash.update(str(filename).encode())
-        file_hash_hex = file_hash.hexdigest()
+        Returns:
+            The files that have been added.
+        """
+        new_files = {k: v for k, v in files.items() if k not in self._files}
+        if not new_files:
+            return []
+
+        self._check_file_durations(files=new_files)
+        self._index_files(files=new_files)
+
+        # Everything is built first and then published at once so concurrent
+        # readers always see a consistent state.
+        all_files = {**self._files, **new_files}
+        filename_receivers_map = {
+            **self._filename_receivers_map,
+            **{
+                name: set(self._index.get_receivers_for_file(filename=name))
+                for name in new_files.keys()
+            },
+        }
+        time_ranges_ns = _merge_time_ranges(
+            times=self._time_ranges_ns
+            + [(f["start_time_ns"], f["end_time_ns"]) for f in new_files.values()],
+            threshold_ns=self._gap_threshold_ns,
+        )
+        lookup, receivers = self._build_file_lookup(
+            files=all_files,
+            filename_receivers_map=filename_receivers_map,
+            new_files=list(new_files.keys()),
+        )
+        with self._state_lock.write():
+            self._files = all_files
+            self._filename_receivers_map = filename_receivers_map
+            self._total_size += sum(f["size"] for f in new_files.values())
+            self._pretty_total_size = pretty_filesize(self._total_size)
+            self._set_time_ranges(time_ranges_ns=time_ranges_ns, log=False)
+            self._file_lookup = lookup
+            self._receivers = receivers
+        self._update_cache_manifest()
+        self._start_hashing()
+
+        logger.info(f"Added {len(new_files)} waveform file(s).")
+        return list(new_files.keys())
+
+    def _build_file_lookup(
+        self,
+        files: typing.Dict[pathlib.Path, typing.Dict],
+        filename_receivers_map: typing.Dict[pathlib.Path, typing.Set[str]],
+        new_files: typing.Optional[typing.List[pathlib.Path]] = None,
+    ) -> typing.Tuple[_FileLookup, typing.List[str]]:
+        """
+        Build the data structures to quickly find the files overlapping a time
+        window: the start and end times of all files as sorted arrays and a
+        receivers x files membership bitmap.
 
-        cache_file = self._cache_folder / f"{filename.stem}__{file_hash_hex}.npz"
+        Args:
+            files: All files.
+            filename_receivers_map: The receivers of all files.
+            new_files: If given, only these files are new. They are appended
+                to the current lookup if they start after all existing files,
+                otherwise everything is rebuilt.
+
+        Returns:
+            The lookup and the sorted receivers.
+        """
+        receivers = sorted(set().union(*filename_receivers_map.values()))
+        old = getattr(self, "_file_lookup", None)
+        if new_files is None or old is None or receivers != self._receivers:
+            lookup = _FileLookup.create(
+                files=files,
+                receivers=receivers,
+                filename_receivers_map=filename_receivers_map,
+            )
+        else:
+            new = _FileLookup.create(
+                files={k: files[k] for k in new_files},
+                receivers=receivers,
+                filename_receivers_map=filename_receivers_map,
+            )
+            if old.names and new.start_ns[0] < old.start_ns[-1]:
+                lookup = _FileLookup.create(
+                    files=files,
+                    receivers=receivers,
+                    filename_receivers_map=filename_receivers_map,
+                )
+            else:
+                lookup = old.extend(new)
+        return lookup, receivers
 
-        waveform_file = filename
-        assert waveform_file.exists()
+    def _get_files_in_window(
+        self, channel_id: str, start_time_ns: int, end_time_ns: int
+    ) -> typing.List[pathlib.Path]:
+        """
+        Get all files with data for a channel overlapping a time window,
+        sorted by start time.
 
-        stat = waveform_file.stat()
+        Args:
+            channel_id: The channel.
+            start_time_ns: Start of the window as a nanosecond timestamp.
+            end_time_ns: End of the window as a nanosecond timestamp.
+        """
+        lookup = self._file_lookup
+        r = lookup.receiver_ids.get(channel_id)
+        if r is None:
+            return []
+        # Only files in [lo, hi) can overlap the window.
+        lo = np.searchsorted(lookup.max_end_ns, start_time_ns, side="left")
+        hi = np.searchsorted(lookup.start_ns, end_time_ns, side="right")
+        if hi <= lo:
+            return []
+        selected = (lookup.end_ns[lo:hi] >= start_time_ns) & (lookup.mask[r, lo:hi])
+        return [lookup.names[i] for i in np.nonzero(selected)[0] + lo]
+
+    def _get_pyramid_store(self, dt_ns: int) -> IndexStore:
+        """
+        Get the pyramid level with the given bin width.
+        """
+        if dt_ns not in self._pyramid:
+            name = f"minmax_pyramid_{dt_ns}ns"
+            self._validate_cache_entry(
+                name=name, kind="index_store", version=INDEX_STORE_VERSION
+            )
+            self._pyramid[dt_ns] = IndexStore(
+                folder=self._cache_folder / name, dt_ns=dt_ns
+            )
+        return self._pyramid[dt_ns]
 
-        expected_keys = {
-            "start_time_stamp_in_ns",
-            "index_sampling_rate_in_hz",
-            "data_sampling_rate_in_hz",
-            "receivers",
-            "data",
-            "mtime",
-            "filesize",
-            "filehash",
+    @property
+    def _index_kwargs(self) -> typing.Dict:
+        return {
+            "index_sampling_rate_in_hz": self._index_sampling_rate_in_hz,
+            "pyramid_finest_decimation": self._pyramid_finest_decimation,
+            "fingerprint": self._fingerprint,
+            "backend": self._backend.name,
         }
 
-        if cache_file.exists():
-            # Keep track if we want to keep analyzing the cache file or
-            # recompute it.
-            cache_file_valid = True
+    def _compute_indices(
+        self, files: typing.List[typing.Tuple[pathlib.Path, typing.Dict]]
+    ) -> typing.Iterator[typing.Tuple[pathlib.Path, typing.Dict, str, typing.Dict]]:
+        """
+        Hash and index the given files, possibly in parallel.
 
-            # Try loading it - if it fails delete it so it can be recomputed.
-            try:
-                d = np.load(cache_file)
-            except Exception as e:
-                logger.warning(
-                    f"Failed to open cache file '{cache_file}' due to: {str(e)}. "
-                    "Will recompute cache file."
+        Results are always yielded in the order of the passed files so the
+        resulting index does not depend on the number of workers.
+        """
+        if self._num_workers == 1 or len(files) <= 1:
+            for name, info in files:
+                yield (
+                    name,
+                    info,
+                    *_hash_and_index_waveform_file(filename=name, **self._index_kwargs),
                 )
-                cache_file.unlink()
-                cache_file_valid = False
-
-            # If the cache file can be opened check the contents.
-            if cache_file_valid:
-                keys = set(d.keys())
-                # First check if all available keys exist.
-                if keys != expected_keys:
-                    logger.warning(
-                        f"Cache file '{cache_file}' might be outdated. Has keys: {keys}. "
-                        f"Expected keys: {expected_keys}. "
-                        "Will recompute cache file."
-                    )
-                    cache_file_valid = False
-                # Then make sure the file has not been modified.
-                elif d["mtime"] != stat.st_mtime or d["filesize"] != stat.st_size:
-                    logger.warning(
-                        f"Cache file '{cache_file}' might be outdated. mtime or size changed. "
-                        "Will recompute cache file."
-                    )
-                    cache_file_valid = False
-                # The index sampling rate might not match.
-                elif (
-                    int(d["index_sampling_rate_in_hz"])
-                    != self._index_sampling_rate_in_hz
-                ):
-                    idx_sr = int(d["index_sampling_rate_in_hz"])
-                    logger.warning(
-                        f"Cache file '{cache_file}' has an index sampling rate of {idx_sr}. "
-                        "Cache should have an index sampling rate of "
-                        f"{self._index_sampling_rate_in_hz}. Will recompute cache file."
+            return
+
+        num_workers = min(self._num_workers, len(files))
+        files = iter(files)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as ex:
+
+            def _submit(n):
+                for name, info in itertools.islice(files, n):
+                    pending.append(
+                        (
+                            name,
+                            info,
+                            ex.submit(
+                                _hash_and_index_waveform_file,
+                                filename=name,
+                                **self._index_kwargs,
+                            ),
+                        )
                     )
-                    cache_file_valid = False
-
-                if not cache_file_valid:
-                    d.close()
-                    del d
-                    cache_file.unlink()
-
-            if cache_file_valid:
-                return {
-                    "start_time_stamp_in_ns": int(d["start_time_stamp_in_ns"]),
-                    "data_sampling_rate_in_hz": float(d["data_sampling_rate_in_hz"]),
-                    "index_sampling_rate_in_hz": float(d["index_sampling_rate_in_hz"]),
-                    "receivers": [str(i) for i in d["receivers"]],
-                    "data": d["data"],
-                }
 
-        file_hash = compute_sha256_hash_for_file(filename=waveform_file)
-
-        cache = {}
-        # Open file and index each trace.
-        with pyasdf.ASDFDataSet(waveform_file, mode="r") as ds:
-            for station in ds.waveforms:
-                tags = station.get_waveform_tags()
-                assert len(tags) == 1
-                tag = tags[0]
-                st = station[tag]
-                for tr in st:
-                    cache[tr.id] = index_trace(
-                        trace=tr,
-                        index_sampling_rate_in_hz=self._index_sampling_rate_in_hz,
-                    )
+            # Only keep a few files in flight to bound the memory usage.
+            pending = collections.deque()
+            _submit(2 * num_workers)
+            while pending:
+                name, info, future = pending.popleft()
+                _submit(1)
+                yield (name, info, *future.result())
 
-        # Some sanity checks to make sure every trace is idencial.
-        sr = set(i["index_sampling_rate_in_hz"] for i in cache.values())
-        sr_d = set(i["data_sampling_rate_in_hz"] for i in cache.values())
-        st = set(i["start_time_stamp_in_ns"] for i in cache.values())
-        assert len(sr) == 1
-        assert len(st) == 1
-
-        index_sampling_rate_in_hz = list(sr)[0]
-        data_sampling_rate_in_hz = list(sr_d)[0]
-        start_time_stamp_in_ns = list(st)[0]
-
-        # Also every trace in the file must have the same length.
-        assert len(set(len(i["min_values"]) for i in cache.values())) == 1
-        assert len(set(len(i["max_values"]) for i in cache.values())) == 1
-
-        # Assemble into large dataset.
-        receivers = sorted(cache.keys())
-        data = np.empty(
-            (len(cache), 2, cache[receivers[0]]["min_values"].shape[0]),
-            # Make sure the dtype is the same as the data.
-            dtype=cache[receivers[0]]["min_values"].dtype,
-        )
-        for _i, r in enumerate(receivers):
-            data[_i, 0, :] = cache[r]["min_values"]
-            data[_i, 1, :] = cache[r]["max_values"]
-
-        # Store everything in a simple npz file for now.
-        np.savez(
-            cache_file,
-            start_time_stamp_in_ns=start_time_stamp_in_ns,
-            index_sampling_rate_in_hz=index_sampling_rate_in_hz,
-            data_sampling_rate_in_hz=data_sampling_rate_in_hz,
-            receivers=np.array(receivers),
-            data=data,
-            mtime=stat.st_mtime,
-            filesize=stat.st_size,
-            filehash=file_hash,
+    def _open_catalog(self) -> FileCatalog:
+        """
+        Open the catalog of the waveform files of the backend.
+        """
+        self._validate_cache_entry(
+            name=self._backend.catalog_filename,
+            kind="catalog",
+            version=CATALOG_VERSION,
+        )
+        return FileCatalog(
+            filename=self._cache_folder / self._backend.catalog_filename,
+            pattern=self._backend.pattern,
+            parse=self._backend.parse_filename,
+        )
+
+    def _update_catalog(
+        self,
+        catalog: FileCatalog,
+        min_file_age_in_seconds: float = 0.0,
+        full_scan: bool = False,
+    ):
+        """
+        Update the catalog with the waveform folders. Scans everything if
+        asked to or if the last full scan is too long ago.
+        """
+        last_full_scan = catalog.last_full_scan
+        if (
+            last_full_scan is None
+            or self._full_scan_interval_in_seconds is not None
+            and time.time() - last_full_scan > self._full_scan_interval_in_seconds
+        ):
+            full_scan = True
+        catalog.update(
+            folders=self._waveform_folders,
+            min_file_age_in_seconds=min_file_age_in_seconds,
+            full_scan=full_scan,
         )
 
+    def _get_catalog_files(
+        self, catalog: FileCatalog, since_generation: typing.Optional[int] = None
+    ) -> typing.Dict[pathlib.Path, typing.Dict]:
+        """
+        The files of the catalog in the waveform folders and the temporal
+        range of the handler, sorted by start time.
+        """
         return {
-            "start_time_stamp_in_ns": start_time_stamp_in_ns,
-            "index_sampling_rate_in_hz": index_sampling_rate_in_hz,
-            "data_sampling_rate_in_hz": data_sampling_rate_in_hz,
-            "receivers": receivers,
-            "data": data,
+            f["path"]: _get_file_info(f)
+            for f in catalog.get_files(
+                folders=self._waveform_folders,
+                start_time_ns=self._start_time.ns,
+                end_time_ns=self._end_time.ns,
+                since_generation=since_generation,
+            )
         }
 
-    def _open_folder(self):
+    def _open_folder(self, update_catalog: bool = True):
+        """
+        Args:
+            update_catalog: Update the catalog first. Otherwise the files
+                already in it are used.
+        """
         logger.info(f"Opening waveform {len(self._waveform_folders)} folder(s) ...")
-        self._files = {}
-
-        # Loop over all files and store some basic information.
-        files = []
-        for folder in self._waveform_folders:
-            files.extend([i for i in folder.glob("*__*__*.h5") if i.is_file()])
-        total_size = 0
-        for f in files:
-            m = re.match(FILENAME_REGEX, f.stem)
-            if not m:
-                continue
-            g = m.groups()
-
-            # Filter the times.
-            starttime = obspy.UTCDateTime(*[int(i) for i in g[:7]])
-            endtime = obspy.UTCDateTime(*[int(i) for i in g[7:]])
-            if starttime > self._end_time or endtime < self._start_time:
-                continue
 
-            s = f.stat()
-            self._files[f] = {
-                "starttime": starttime,
-                "endtime": endtime,
-                "mtime": s.st_mtime,
-                "size": s.st_size,
-            }
-            total_size += s.st_size
+        # Only new or removed files are looked at - everything else comes
+        # straight from the catalog.
+        catalog = self._open_catalog()
+        try:
+            if update_catalog:
+                self._update_catalog(catalog=catalog)
+            # Before reading the files - changes in the meanwhile are looked
+            # at again by the next refresh.
+            self._catalog_generation = catalog.generation
+            files = self._get_catalog_files(catalog=catalog)
+        finally:
+            catalog.close()
+
+        self._files = files
 
         if not self._files:
             raise ValueError("Could not find any waveform data files.")
 
+        total_size = sum(f["size"] for f in files.values())
         self._total_size = total_size
         self._pretty_total_size = pretty_filesize(total_size)
 
@@ -416,67 +1216,99 @@ class WaveformHandler:
         """
         A bit of analysis to determine if there are any gaps in the data and what not.
         """
-        durations = np.array(
-            [i["endtime"] - i["starttime"] for i in self._files.values()],
-            dtype=np.float64,
+        start_times = np.array(
+            [i["start_time_ns"] for i in self._files.values()], dtype=np.int64
         )
-        mean_duration = durations.mean()
-        if np.any(np.abs(durations - mean_duration) > 0.01 * durations.mean()):
-            # XXX: Better error handling/messages required.
-            raise ValueError(
-                "The durations of the individual files are not equal enough."
-            )
+        end_times = np.array(
+            [i["end_time_ns"] for i in self._files.values()], dtype=np.int64
+        )
+        durations = (end_times - start_times) / 1e9
+        self._mean_file_duration = durations.mean()
+        self._check_file_durations(files=self._files)
 
         # Again likely overkill but better safe than sorry.
         #
         # Fraction of the duration that can be missing.
-        threshold = 0.01
-        time_ranges = []
-        for t in sorted(self._files.values(), key=lambda x: x["starttime"]):
-            # First time in the loop.
-            if not time_ranges:
-                time_ranges.append([t["starttime"], t["endtime"]])
-                continue
-
-            # Latest time range.
-            lr = time_ranges[-1]
-
-            # New time range.
-            if t["starttime"] > (lr[1] + threshold * mean_duration):
-                time_ranges.append([t["starttime"], t["endtime"]])
-                continue
-
-            if t["endtime"] > lr[1]:
-                lr[1] = t["endtime"]
+        self._gap_threshold_ns = int(0.01 * self._mean_file_duration * 1e9)
+        self._set_time_ranges(
+            time_ranges_ns=_merge_time_ranges(
+                times=list(zip(start_times, end_times)),
+                threshold_ns=self._gap_threshold_ns,
+            ),
+            log=True,
+        )
 
-        # Cannot really happen.
-        assert time_ranges
-        logger.info(f"Found {len(time_ranges)} time range(s) with waveform data.")
-        for t in time_ranges:
-            logger.info(
-                f"Time range: {t[0]}-{t[1]} [Duration: {t[1] - t[0]:.1f} seconds]"
+    def _check_file_durations(self, files: typing.Dict[pathlib.Path, typing.Dict]):
+        if not self._backend.equal_file_durations:
+            return
+        durations = np.array(
+            [(i["end_time_ns"] - i["start_time_ns"]) / 1e9 for i in files.values()]
+        )
+        mean_duration = self._mean_file_duration
+        if np.any(np.abs(durations - mean_duration) > 0.01 * mean_duration):
+            # XXX: Better error handling/messages required.
+            raise ValueError(
+                "The durations of the individual files are not equal enough."
             )
 
-        # For now only a single time range is supported!
-        if len(time_ranges) != 1:
-            raise NotImplementedError(
-                "Currently only supports a single continuous time range."
-            )
+    def _set_time_ranges(
+        self, time_ranges_ns: typing.List[typing.Tuple[int, int]], log: bool
+    ):
+        # Cannot really happen.
+        assert time_ranges_ns
+        time_ranges = [
+            [obspy.UTCDateTime(ns=int(s)), obspy.UTCDateTime(ns=int(e))]
+            for s, e in time_ranges_ns
+        ]
+        if log:
+            logger.info(f"Found {len(time_ranges)} time range(s) with waveform data.")
+            for t in time_ranges:
+                logger.info(
+                    f"Time range: {t[0]}-{t[1]} [Duration: {t[1] - t[0]:.1f} seconds]"
+                )
 
         self._time_ranges = time_ranges
+        # Avoids converting the times on every lookup.
+        self._time_ranges_ns = [(int(s), int(e)) for s, e in time_ranges_ns]
 
-    def _get_timestamps_for_binned_index(self) -> np.ndarray:
-        if not hasattr(self, "_timestamp_cache"):
-            t = np.linspace(
-                self._cache_start_timestamp_ns / 1e9,
-                self._cache_end_timestamp_ns / 1e9,
-                self._cache_npts,
+    def _get_index_pieces(
+        self, store: IndexStore, channel_id: str, start_time_ns: int, end_time_ns: int
+    ) -> typing.List[typing.Tuple[int, np.ndarray]]:
+        """
+        The bins of a store in all time ranges with data in the window. Gaps
+        between time ranges are skipped.
+        """
+        pieces = []
+        for s, e in self._get_time_ranges_in_window(
+            start_time_ns=start_time_ns, end_time_ns=end_time_ns
+        ):
+            pieces.extend(
+                store.get_data(receiver=channel_id, start_time_ns=s, end_time_ns=e)
             )
-            times = _interweave_arrays(t, t)
-            self._timestamp_cache = times
+        return pieces
 
-        return self._timestamp_cache
+    @staticmethod
+    def _join_index_pieces(
+        pieces: typing.List[typing.Tuple[int, np.ndarray]], dt_ns: int, offset: float
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Join index pieces to interleaved times and min/max values. A single
+        piece is returned without copying the values.
+
+        Args:
+            pieces: ``(start time in ns, bins)`` tuples.
+            dt_ns: Bin width in nanoseconds.
+            offset: Time of each bin relative to its start in bins.
+        """
+        values = [p.reshape(-1) for _, p in pieces]
+        values = values[0] if len(values) == 1 else np.concatenate(values)
+        values.flags.writeable = False
+        t = np.concatenate(
+            [(s + (np.arange(p.shape[0]) + offset) * dt_ns) / 1e9 for s, p in pieces]
+        )
+        return _interweave_arrays(t, t), values
 
+    @_reading
     def get_binned_index_data(
         self, channel_id: str
     ) -> typing.Tuple[np.ndarray, np.ndarray]:
@@ -488,40 +1320,717 @@ class WaveformHandler:
         Args:
             channel_id: Id of the channel to get.
         """
-        index = self._get_index_for_channel(channel_id=channel_id)
-        min_values = self._cache["data"][index, 0, :]
-        max_values = self._cache["data"][index, 1, :]
-        return self._get_timestamps_for_binned_index(), _interweave_arrays(
-            min_values, max_values
+        if channel_id not in self._index.receivers:
+            raise ValueError(f"Channel {channel_id} is not part of the index.")
+        # The index already stores min and max interleaved - with a single
+        # time range this is a view into the memory-mapped index without any
+        # copy. Gaps between time ranges are skipped.
+        return self._join_index_pieces(
+            pieces=self._get_index_pieces(
+                store=self._index,
+                channel_id=channel_id,
+                start_time_ns=self.starttime.ns,
+                end_time_ns=self.endtime.ns,
+            ),
+            dt_ns=self._index.dt_ns,
+            offset=0.0,
         )
 
+    @_reading
+    def get_rms_envelope(
+        self,
+        channel_id: str,
+        start_time: typing.Optional[obspy.UTCDateTime] = None,
+        end_time: typing.Optional[obspy.UTCDateTime] = None,
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        RMS amplitude of each bin of the index.
+
+        Computed from the sums stored in the index so no waveform data is
+        read. The mean of each bin is removed. Gaps between time ranges are
+        skipped.
+
+        Args:
+            channel_id: Id of the channel.
+            start_time: Start of the time window. Defaults to the start of
+                the temporal range of the handler.
+            end_time: End of the time window. The bin containing it is still
+                part of the result. Defaults to the end of the temporal range
+                of the handler.
+
+        Returns:
+            Start times of the bins as timestamps in seconds and the RMS of
+            each bin.
+        """
+        if channel_id not in self._index.receivers:
+            raise ValueError(f"Channel {channel_id} is not part of the index.")
+        pieces = []
+        for s, e in self._get_time_ranges_in_window(
+            start_time_ns=obspy.UTCDateTime(
+                self.starttime if start_time is None else start_time
+            ).ns,
+            end_time_ns=obspy.UTCDateTime(
+                self.endtime if end_time is None else end_time
+            ).ns,
+        ):
+            pieces.extend(
+                self._index.get_energy(
+                    receiver=channel_id, start_time_ns=s, end_time_ns=e
+                )
+            )
+        if not pieces:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+        times = np.concatenate(
+            [(s + np.arange(p.shape[0]) * self._index.dt_ns) / 1e9 for s, p in pieces]
+        )
+        return times, energy_to_rms(np.concatenate([p for _, p in pieces]))
+
+    @_reading
+    def get_noise_levels(
+        self,
+        channel_ids: typing.List[str],
+        start_time: typing.Optional[obspy.UTCDateTime] = None,
+        end_time: typing.Optional[obspy.UTCDateTime] = None,
+        percentile: float = 50.0,
+    ) -> typing.Dict[str, float]:
+        """
+        Estimate the background noise level of each channel from the index.
+
+        Events only take up a small fraction of the data so a percentile of
+        the RMS of all bins is a robust estimate. Bins without data are
+        ignored.
+
+        Args:
+            channel_ids: List of channel ids.
+            start_time: Start of the time window to estimate it from.
+                Defaults to the start of the temporal range of the handler.
+            end_time: End of that time window. Defaults to the end of the
+                temporal range of the handler.
+            percentile: The percentile of the RMS of all bins.
+
+        Returns:
+            The noise level of each channel in the units of the data.
+        """
+        levels = {}
+        for channel_id in channel_ids:
+            _, rms = self.get_rms_envelope(
+                channel_id=channel_id, start_time=start_time, end_time=end_time
+            )
+            rms = rms[rms > 0]
+            levels[channel_id] = (
+                float(np.percentile(rms, percentile)) if rms.size else 0.0
+            )
+        return levels
+
+    def _drop_quiet_intervals(
+        self,
+        intervals: typing.Iterable[typing.Tuple[obspy.UTCDateTime, obspy.UTCDateTime]],
+        quiet_thresholds: typing.Optional[typing.Dict[str, float]],
+    ) -> typing.Iterator[typing.Tuple[obspy.UTCDateTime, obspy.UTCDateTime]]:
+        """
+        Only yield intervals in which at least one channel exceeds its
+        threshold in at least one bin of the index.
+        """
+        if not quiet_thresholds:
+            yield from intervals
+            return
+        skipped = 0
+        for interval in intervals:
+            for channel_id, threshold in quiet_thresholds.items():
+                _, rms = self.get_rms_envelope(
+                    channel_id=channel_id, start_time=interval[0], end_time=interval[1]
+                )
+                if rms.size and rms.max() >= threshold:
+                    yield interval
+                    break
+            else:
+                skipped += 1
+                logger.debug(
+                    f"Skipping quiet interval {interval[0]}-{interval[1]} "
+                    f"({skipped} so far)."
+                )
+
+    @_reading
     def get_waveforms(
         self,
         channel_ids: typing.List[str],
         start_time: obspy.UTCDateTime,
         end_time: obspy.UTCDateTime,
+        dtype: typing.Optional[np.dtype] = None,
     ) -> obspy.Stream:
         """
         Retrieve waveforms as an ObsPy Stream objects.
 
+        Gaps between time ranges are not filled - there is one trace per
+        channel and time range with data in the requested window.
+
         Args:
             channel_ids: List of channel ids.
             start_time: The start time of the requested data.
             end_time: The end time of the requested data.
+            dtype: Convert the samples to this dtype, e.g. ``np.float32``
+                for stages that need floating point data. By default the
+                samples keep the dtype they are stored with, usually int16
+                or int32, which keeps all copies small.
         """
+        time_ranges = self._get_time_ranges_in_window(
+            start_time_ns=obspy.UTCDateTime(start_time).ns,
+            end_time_ns=obspy.UTCDateTime(end_time).ns,
+        )
         st = obspy.Stream()
         for channel_id in channel_ids:
-            st.append(
-                self.get_waveform_data(
+            traces = [
+                self._get_trace(
+                    channel_id=channel_id, start_time_ns=s, end_time_ns=e, dtype=dtype
+                )
+                for s, e in time_ranges
+            ]
+            traces = [tr for tr in traces if tr is not None]
+            if not traces:
+                raise ValueError(
+                    f"Could not find data for channel: {channel_id}, "
+                    f"start time: {start_time}, end time: {end_time}."
+                )
+            st.extend(traces)
+        return st
+
+    @_reading
+    def get_filtered_waveforms(
+        self,
+        channel_ids: typing.List[str],
+        start_time: obspy.UTCDateTime,
+        end_time: obspy.UTCDateTime,
+        filter_id: str,
+    ) -> obspy.Stream:
+        """
+        Retrieve filtered waveforms.
+
+        Same as `get_waveforms()` followed by applying one of the project's
+        filters, but the filtered data is cached. The filter coefficients are
+        only designed once per sampling rate.
+
+        Causal filters carry their state over from the directly preceding
+        window if that has been filtered before, i.e. if ``start_time`` is
+        the time of the sample after the end of that window. Reading
+        consecutive windows then gives the same result as filtering all data
+        at once, without any transients at the window boundaries.
+
+        Args:
+            channel_ids: List of channel ids.
+            start_time: The start time of the requested data.
+            end_time: The end time of the requested data.
+            filter_id: The id of the filter in the project configuration.
+        """
+        if filter_id not in self._filters:
+            raise ValueError(
+                f"Unknown filter '{filter_id}'. Available filters: "
+                f"{', '.join(self._filters) or 'none'}."
+            )
+        time_ranges = self._get_time_ranges_in_window(
+            start_time_ns=obspy.UTCDateTime(start_time).ns,
+            end_time_ns=obspy.UTCDateTime(end_time).ns,
+        )
+        st = obspy.Stream()
+        for channel_id in channel_ids:
+            traces = [
+                self._get_filtered_trace(
                     channel_id=channel_id,
-                    start_time=start_time,
-                    end_time=end_time,
-                    npts=10000000000000,
-                    return_trace=True,
+                    start_time_ns=s,
+                    end_time_ns=e,
+                    filter_id=filter_id,
+                )
+                for s, e in time_ranges
+            ]
+            traces = [tr for tr in traces if tr is not None]
+            if not traces:
+                raise ValueError(
+                    f"Could not find data for channel: {channel_id}, "
+                    f"start time: {start_time}, end time: {end_time}."
+                )
+            st.extend(traces)
+        return st
+
+    def _get_filtered_trace(
+        self, channel_id: str, start_time_ns: int, end_time_ns: int, filter_id: str
+    ) -> typing.Optional[obspy.Trace]:
+        """
+        Filtered version of `_get_trace()`, served from the filtered cache.
+        """
+        butterworth_filter = self._filters[filter_id]
+        zi = None
+        if not butterworth_filter.zerophase:
+            zi = self._filter_states.get((channel_id, filter_id, start_time_ns))
+        # Different preceding windows leave different states behind, so the
+        # state itself is part of the key.
+        key = (
+            channel_id,
+            start_time_ns,
+            end_time_ns,
+            filter_id,
+            None if zi is None else zi.tobytes(),
+        )
+
+        def _filter():
+            tr = self._get_trace(
+                channel_id=channel_id,
+                start_time_ns=start_time_ns,
+                end_time_ns=end_time_ns,
+            )
+            if tr is None:
+                # Nothing to cache.
+                return np.empty(0)
+            data, zf = butterworth_filter.apply(
+                data=tr.data, sampling_rate=tr.stats.sampling_rate, zi=zi
+            )
+            if zf is not None:
+                next_sample_ns = tr.stats.starttime.ns + int(
+                    round(tr.stats.npts * 1e9 / tr.stats.sampling_rate)
                 )
+                self._filter_states.put((channel_id, filter_id, next_sample_ns), zf)
+            tr.data = data
+            return tr
+
+        tr = self.filtered_cache.get_or_create(key, _filter)
+        if not isinstance(tr, obspy.Trace):
+            return None
+        # Every caller gets its own copy.
+        return tr.copy()
+
+    def iter_intervals(
+        self,
+        channel_ids: typing.List[str],
+        interval_length_in_seconds: float,
+        interval_overlap_in_seconds: float,
+        start_time: typing.Optional[obspy.UTCDateTime] = None,
+        end_time: typing.Optional[obspy.UTCDateTime] = None,
+        prefetch: int = 1,
+        dtype: typing.Optional[np.dtype] = None,
+        quiet_thresholds: typing.Optional[typing.Dict[str, float]] = None,
+    ) -> typing.Iterator[
+        typing.Tuple[obspy.UTCDateTime, obspy.UTCDateTime, obspy.Stream]
+    ]:
+        """
+        Loop over intervals and get the waveforms of each of them.
+
+        The intervals are the same as the ones from
+        `dug_seis.util.compute_intervals()`. The waveforms of the next
+        intervals are read in a background thread while the current one is
+        being processed.
+
+        Args:
+            channel_ids: List of channel ids.
+            interval_length_in_seconds: The length of each interval in
+                seconds.
+            interval_overlap_in_seconds: The overlap between two intervals in
+                seconds.
+            start_time: Start of the first interval. Defaults to the start
+                of the temporal range of the handler.
+            end_time: No interval starts after this time. Defaults to the
+                end of the temporal range of the handler.
+            prefetch: Number of intervals to read ahead. Everything is read
+                in the calling thread if this is 0.
+            dtype: See `get_waveforms()`.
+            quiet_thresholds: Optional RMS threshold per channel. Intervals in
+                which the RMS of every bin of the index stays below the
+                threshold for all of these channels are skipped without
+                reading any data. A multiple of `get_noise_levels()` is a
+                good choice.
+
+        Yields:
+            (start time, end time, waveforms) tuples.
+        """
+        intervals = self._drop_quiet_intervals(
+            intervals=_compute_intervals(
+                start_time=obspy.UTCDateTime(
+                    self._start_time if start_time is None else start_time
+                ),
+                end_time=obspy.UTCDateTime(
+                    self._end_time if end_time is None else end_time
+                ),
+                time_ranges=self.time_ranges,
+                interval_length_in_seconds=interval_length_in_seconds,
+                interval_overlap_in_seconds=interval_overlap_in_seconds,
+            ),
+            quiet_thresholds=quiet_thresholds,
+        )
+
+        def _get(interval):
+            return self.get_waveforms(
+                channel_ids=channel_ids,
+                start_time=interval[0],
+                end_time=interval[1],
+                dtype=dtype,
+            )
+
+        if prefetch <= 0:
+            for interval in intervals:
+                yield interval[0], interval[1], _get(interval)
+            return
+
+        intervals = iter(intervals)
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
+
+            def _submit(n):
+                for interval in itertools.islice(intervals, n):
+                    pending.append((interval, ex.submit(_get, interval)))
+
+            try:
+                # The current interval and the ones to read ahead.
+                _submit(prefetch + 1)
+                while pending:
+                    interval, future = pending.popleft()
+                    st = future.result()
+                    yield interval[0], interval[1], st
+                    _submit(1)
+            finally:
+                # Do not read anything else if the loop is left early.
+                for _, future in pending:
+                    future.cancel()
+
+    def _get_async_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._async_executor is None:
+            self._async_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._async_max_workers,
+                thread_name_prefix="dug_seis_waveforms",
+            )
+        return self._async_executor
+
+    async def _aget_trace(
+        self,
+        channel_id: str,
+        start_time_ns: int,
+        end_time_ns: int,
+        dtype: typing.Optional[np.dtype] = None,
+    ) -> typing.Optional[obspy.Trace]:
+        """
+        Async version of `_get_trace()`.
+
+        Concurrent requests for the same channel and time window share a
+        single read. The read is cancelled once all requests waiting for it
+        have been cancelled and it did not yet start.
+        """
+        loop = asyncio.get_running_loop()
+        dtype = None if dtype is None else np.dtype(dtype)
+        key = (loop, channel_id, start_time_ns, end_time_ns, dtype)
+        entry = self._async_reads.get(key)
+        if entry is None:
+            future = loop.run_in_executor(
+                self._get_async_executor(),
+                functools.partial(
+                    self._get_trace,
+                    channel_id=channel_id,
+                    start_time_ns=start_time_ns,
+                    end_time_ns=end_time_ns,
+                    dtype=dtype,
+                ),
             )
+            # [future, number of waiters]
+            entry = [future, 0]
+            self._async_reads[key] = entry
+
+            def _done(_, entry=entry):
+                if self._async_reads.get(key) is entry:
+                    del self._async_reads[key]
+
+            future.add_done_callback(_done)
+
+        entry[1] += 1
+        try:
+            tr = await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            if entry[1] == 1:
+                entry[0].cancel()
+            raise
+        finally:
+            entry[1] -= 1
+        # Every request gets its own copy.
+        return None if tr is None else tr.copy()
+
+    async def aget_waveforms(
+        self,
+        channel_ids: typing.List[str],
+        start_time: obspy.UTCDateTime,
+        end_time: obspy.UTCDateTime,
+        dtype: typing.Optional[np.dtype] = None,
+    ) -> obspy.Stream:
+        """
+        Async version of `get_waveforms()`.
+
+        The data is read in a bounded thread pool so the event loop is never
+        blocked. All channels are read concurrently.
+
+        Args:
+            channel_ids: List of channel ids.
+            start_time: The start time of the requested data.
+            end_time: The end time of the requested data.
+            dtype: See `get_waveforms()`.
+        """
+        time_ranges = self._get_time_ranges_in_window(
+            start_time_ns=obspy.UTCDateTime(start_time).ns,
+            end_time_ns=obspy.UTCDateTime(end_time).ns,
+        )
+        traces = await asyncio.gather(
+            *[
+                self._aget_trace(
+                    channel_id=channel_id, start_time_ns=s, end_time_ns=e, dtype=dtype
+                )
+                for channel_id in channel_ids
+                for s, e in time_ranges
+            ]
+        )
+
+        st = obspy.Stream()
+        for i, channel_id in enumerate(channel_ids):
+            t = traces[i * len(time_ranges) : (i + 1) * len(time_ranges)]
+            t = [tr for tr in t if tr is not None]
+            if not t:
+                raise ValueError(
+                    f"Could not find data for channel: {channel_id}, "
+                    f"start time: {start_time}, end time: {end_time}."
+                )
+            st.extend(t)
         return st
 
+    async def aiter_intervals(
+        self,
+        channel_ids: typing.List[str],
+        interval_length_in_seconds: float,
+        interval_overlap_in_seconds: float,
+        start_time: typing.Optional[obspy.UTCDateTime] = None,
+        end_time: typing.Optional[obspy.UTCDateTime] = None,
+        prefetch: int = 1,
+        dtype: typing.Optional[np.dtype] = None,
+        quiet_thresholds: typing.Optional[typing.Dict[str, float]] = None,
+    ) -> typing.AsyncIterator[
+        typing.Tuple[obspy.UTCDateTime, obspy.UTCDateTime, obspy.Stream]
+    ]:
+        """
+        Async version of `iter_intervals()`.
+
+        The next ``prefetch`` intervals are read concurrently while the
+        current one is being processed. Pending reads are cancelled if the
+        loop is left early.
+        """
+        intervals = self._drop_quiet_intervals(
+            intervals=_compute_intervals(
+                start_time=obspy.UTCDateTime(
+                    self._start_time if start_time is None else start_time
+                ),
+                end_time=obspy.UTCDateTime(
+                    self._end_time if end_time is None else end_time
+                ),
+                time_ranges=self.time_ranges,
+                interval_length_in_seconds=interval_length_in_seconds,
+                interval_overlap_in_seconds=interval_overlap_in_seconds,
+            ),
+            quiet_thresholds=quiet_thresholds,
+        )
+        pending = collections.deque()
+
+        def _submit(n):
+            for interval in itertools.islice(intervals, n):
+                task = asyncio.ensure_future(
+                    self.aget_waveforms(
+                        channel_ids=channel_ids,
+                        start_time=interval[0],
+                        end_time=interval[1],
+                        dtype=dtype,
+                    )
+                )
+                pending.append((interval, task))
+
+        try:
+            # The current interval and the ones to read ahead.
+            _submit(max(prefetch, 0) + 1)
+            while pending:
+                interval, task = pending.popleft()
+                st = await task
+                yield interval[0], interval[1], st
+                _submit(1)
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    @_reading
+    def get_waveform_array(
+        self,
+        channel_ids: typing.List[str],
+        start_time: obspy.UTCDateTime,
+        end_time: obspy.UTCDateTime,
+        dtype: typing.Optional[np.dtype] = None,
+    ) -> WaveformArray:
+        """
+        Retrieve waveforms of multiple channels as one contiguous array.
+
+        Much less overhead than `get_waveforms()` as the samples are directly
+        read into a preallocated array without any intermediate ObsPy
+        objects. Like `get_waveforms()` the nearest samples to the start and
+        end time are selected. The array only covers the part of the
+        requested window with data - gaps within it are filled with zeros.
+
+        Args:
+            channel_ids: List of channel ids. Determines the order of the
+                rows in the returned array.
+            start_time: The start time of the requested data.
+            end_time: The end time of the requested data.
+            dtype: See `get_waveforms()`. The samples are converted while
+                copying them into the array.
+        """
+        start_time_ns = obspy.UTCDateTime(start_time).ns
+        end_time_ns = obspy.UTCDateTime(end_time).ns
+
+        # All (file, info) pairs with data for each channel.
+        parts = []
+        for channel_id in channel_ids:
+            p = []
+            for f in self._get_files_in_window(
+                channel_id=channel_id,
+                start_time_ns=start_time_ns,
+                end_time_ns=end_time_ns,
+            ):
+                info = self._get_channel_info(filename=f, channel_id=channel_id)
+                i0, i1 = _get_sample_range(
+                    info=info, start_time_ns=start_time_ns, end_time_ns=end_time_ns
+                )
+                if i1 > i0:
+                    p.append((f, info, i0, i1))
+            if not p:
+                raise ValueError(
+                    f"Could not find data for channel: {channel_id}, "
+                    f"start time: {start_time}, end time: {end_time}."
+                )
+            parts.append(p)
+
+        # All files share the same sample grid - derive the covered time span
+        # from the first and last sample of any of the channels.
+        sampling_rate = parts[0][0][1]["sampling_rate"]
+        dt_ns = 1e9 / sampling_rate
+        first_sample_ns = min(
+            p[0][1]["start_time_ns"] + int(round(p[0][2] * dt_ns)) for p in parts
+        )
+        last_sample_ns = max(
+            p[-1][1]["start_time_ns"] + int(round((p[-1][3] - 1) * dt_ns))
+            for p in parts
+        )
+        npts = int(round((last_sample_ns - first_sample_ns) / dt_ns)) + 1
+
+        data = np.zeros(
+            (len(channel_ids), npts),
+            dtype=(
+                np.result_type(*[i[1]["dtype"] for p in parts for i in p])
+                if dtype is None
+                else dtype
+            ),
+        )
+        for row, (channel_id, p) in enumerate(zip(channel_ids, parts)):
+            for f, info, i0, i1 in p:
+                if info["sampling_rate"] != sampling_rate:
+                    raise ValueError(
+                        "All channels must have the same sampling rate. "
+                        f"{channel_id}: {info['sampling_rate']} Hz, expected "
+                        f"{sampling_rate} Hz."
+                    )
+                offset = int(
+                    round((info["start_time_ns"] - first_sample_ns) / dt_ns + i0)
+                )
+                samples = self._read_samples(
+                    filename=f, channel_id=channel_id, info=info, i0=i0, i1=i1
+                )
+                data[row, offset : offset + samples.shape[0]] = samples[: npts - offset]
+
+        return WaveformArray(
+            data=data,
+            channel_ids=list(channel_ids),
+            start_time_ns=first_sample_ns,
+            sampling_rate=sampling_rate,
+        )
+
+    def _get_pyramid_data(
+        self, channel_id: str, start_time_ns: int, end_time_ns: int, npts: int
+    ) -> typing.Optional[typing.Dict]:
+        """
+        Get min/max data from the closest level of the pyramid.
+
+        Returns `None` if the raw data is better suited, i.e. if it has no
+        more than ``2 * npts`` samples in the window or if even the finest
+        level would be much coarser than requested.
+        """
+        duration_ns = end_time_ns - start_time_ns
+        if duration_ns * self.sampling_rate / 1e9 <= npts * 2:
+            return None
+
+        # The finest level with not too many bins - or the coarsest one.
+        levels = [self._pyramid[dt_ns] for dt_ns in sorted(self._pyramid.keys())]
+        store = levels[-1]
+        for store in levels:
+            if duration_ns // store.dt_ns + 1 <= npts * 2:
+                break
+        if store is levels[0] and duration_ns // store.dt_ns + 1 < npts // 2:
+            return None
+
+        pieces = self._get_index_pieces(
+            store=store,
+            channel_id=channel_id,
+            start_time_ns=start_time_ns,
+            end_time_ns=end_time_ns,
+        )
+        if not pieces:
+            return None
+
+        # Min and max are interleaved in the store - no copy required for a
+        # single time range. Use the center of each bin.
+        times, values = self._join_index_pieces(
+            pieces=pieces, dt_ns=store.dt_ns, offset=0.5
+        )
+        return {
+            "data": values,
+            "times": times,
+            "start_time": times[0],
+            "end_time": times[-1],
+            "npts": values.shape[0] // 2,
+            "delta": store.dt_ns / 1e9,
+            "is_max_resolution": False,
+        }
+
+    @_reading
+    def _get_trace(
+        self,
+        channel_id: str,
+        start_time_ns: int,
+        end_time_ns: int,
+        dtype: typing.Optional[np.dtype] = None,
+    ) -> typing.Optional[obspy.Trace]:
+        """
+        Read and merge the data of a single channel in a time window. Returns
+        `None` if there is no data.
+        """
+        # Only read the samples in the requested time window.
+        st = obspy.Stream()
+        for f in self._get_files_in_window(
+            channel_id=channel_id, start_time_ns=start_time_ns, end_time_ns=end_time_ns
+        ):
+            tr = self._read_channel_slice(
+                filename=f,
+                channel_id=channel_id,
+                start_time_ns=start_time_ns,
+                end_time_ns=end_time_ns,
+                dtype=dtype,
+            )
+            if tr is not None:
+                st.append(tr)
+        if not st:
+            return None
+        deltas = {tr.stats.delta for tr in st}
+        if len(deltas) != 1:
+            breakpoint()
+        for tr in st:
+            tr.stats.delta = list(deltas)[0]
+        st.merge()
+        assert len(st) == 1, "Merging failed somehow."
+        return st[0]
+
+    @_reading
     def get_waveform_data(
         self,
         channel_id: str,
@@ -529,90 +2038,76 @@ class WaveformHandler:
         end_time: obspy.UTCDateTime,
         npts: int,
         return_trace: bool = False,
+        filter_id: typing.Optional[str] = None,
     ):
         """
         Lower level waveform access. Please use the ``.get_waveforms()`` method
         instead.
-        """
-        # Get all the files that contain part of that trace.
-        files = {
-            key: value
-            for key, value in self._files.items()
-            if value["starttime"] <= end_time
-            and value["endtime"] > start_time
-            and channel_id in self._filename_receivers_map[key]
-        }
 
-        if not files:
+        If ``filter_id`` is given, data that is read from the waveform files
+        is filtered. Overviews served from the min/max pyramid always show
+        the unfiltered data.
+        """
+        # Serve from the min/max pyramid if possible.
+        if not return_trace and self._pyramid:
+            out = self._get_pyramid_data(
+                channel_id=channel_id,
+                start_time_ns=obspy.UTCDateTime(start_time).ns,
+                end_time_ns=obspy.UTCDateTime(end_time).ns,
+                npts=npts,
+            )
+            if out is not None:
+                return out
+
+        if filter_id is not None:
+            st = self.get_filtered_waveforms(
+                channel_ids=[channel_id],
+                start_time=start_time,
+                end_time=end_time,
+                filter_id=filter_id,
+            )
+            st.merge()
+            tr = st[0]
+        else:
+            tr = self._get_trace(
+                channel_id=channel_id,
+                start_time_ns=obspy.UTCDateTime(start_time).ns,
+                end_time_ns=obspy.UTCDateTime(end_time).ns,
+            )
+        if tr is None:
             raise ValueError(
                 f"Could not find data for channel: {channel_id}, "
                 f"start time: {start_time}, end time: {end_time}."
             )
 
-        st = obspy.Stream(
-            traces=[
-                _get_channel_from_file(filename=f, channel_id=channel_id).copy()
-                for f in files.keys()
-            ]
-        )
-        st.trim(obspy.UTCDateTime(start_time), obspy.UTCDateTime(end_time))
-        deltas = {tr.stats.delta for tr in st}
-        if len(deltas) != 1:
-            breakpoint()
-        for tr in st:
-            tr.stats.delta = list(deltas)[0]
-        st.merge()
-        assert len(st) == 1, "Merging failed somehow."
-        tr = st[0]
-
         if return_trace:
             return tr
 
         # If it has too many samples, bin the data.
         if tr.stats.npts > npts * 2:
-            factor = int(tr.stats.npts // npts)
-            for _ in range(10):
-                if tr.stats.npts / factor < npts:
-                    factor *= 2
-                    continue
-                break
-            else:
-                raise ValueError(
-                    "Something went wrong with the decimation factor " "computation."
-                )
-            if factor > 1:
-                size = tr.stats.npts // factor
-                array_size = size
-                if tr.stats.npts % factor:
-                    array_size += 1
-                data = np.empty((array_size, 2))
-                d = tr.data[: size * factor].reshape((size, factor))
-                data[:size, 0] = d.min(axis=1)
-                data[:size, 1] = d.max(axis=1)
-
-                # Fill the last sample that does not exactly fit.
-                if size != array_size:
-                    d = tr.data[size * factor :]  # noqa
-                    data[-1, 0] = d.min()
-                    data[-1, 1] = d.max()
-
-                # The end time is off by a bit if it is not an even division.
-                # More than likely does not matter for anything so should be
-                # fine.
-                new_dt = tr.stats.delta * factor
-                new_start_time = tr.stats.starttime.timestamp + new_dt * 0.5
-                new_end_time = new_start_time + (data.shape[0] - 1) * new_dt
-                times = np.linspace(new_start_time, new_end_time, data.shape[0])
-
-                return {
-                    "data": _interweave_arrays(data[:, 0], data[:, 1]),
-                    "times": _interweave_arrays(times, times),
-                    "start_time": new_start_time,
-                    "end_time": new_end_time,
-                    "npts": data.shape[0],
-                    "delta": new_dt,
-                    "is_max_resolution": False,
-                }
+            # Between npts and 2 * npts bins.
+            factor = tr.stats.npts // npts
+            new_dt = tr.stats.delta * factor
+            new_start_time = tr.stats.starttime.timestamp + new_dt * 0.5
+            # Gaps are filled with whatever the merge put there.
+            data, times = decimate_min_max(
+                data=np.ma.getdata(tr.data),
+                factor=factor,
+                first_time=new_start_time,
+                dt=new_dt,
+            )
+            # The end time is off by a bit if it is not an even division.
+            # More than likely does not matter for anything so should be
+            # fine.
+            return {
+                "data": data,
+                "times": times,
+                "start_time": new_start_time,
+                "end_time": float(times[-1]),
+                "npts": data.shape[0] // 2,
+                "delta": new_dt,
+                "is_max_resolution": False,
+            }
 
         return {
             "data": tr.data,
@@ -0,0 +1,63 @@
+"""
+Measure the time it takes to import DUGSeis and open a project.
+
+Each run happens in a fresh interpreter so the import cost is included.
+Prints the median of all runs and optionally fails if it exceeds a limit,
+e.g. to catch regressions in CI:
+
+    python benchmark_startup.py dug_seis_example.yaml --runs 5 --max-seconds 1.0
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+CODE = """
+import sys
+import time
+
+t = time.perf_counter()
+from dug_seis.project.project import DUGSeisProject
+
+t_import = time.perf_counter() - t
+DUGSeisProject(config=sys.argv[1])
+print(t_import, time.perf_counter() - t)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("config", help="Path to the DUGSeis configuration file.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=None,
+        help="Exit with an error if the median time to the first project "
+        "exceeds this.",
+    )
+    args = parser.parse_args()
+
+    imports = []
+    totals = []
+    for _ in range(args.runs):
+        out = subprocess.run(
+            [sys.executable, "-c", CODE, args.config],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        t_import, t_total = map(float, out.stdout.strip().splitlines()[-1].split())
+        imports.append(t_import)
+        totals.append(t_total)
+
+    median = statistics.median(totals)
+    print(f"Import of dug_seis.project:  {statistics.median(imports):.3f} s")
+    print(f"Time to first DUGSeisProject: {median:.3f} s (median of {args.runs})")
+    if args.max_seconds is not None and median > args.max_seconds:
+        sys.exit(f"Startup takes longer than {args.max_seconds} s.")
+
+
+if __name__ == "__main__":
+    main()
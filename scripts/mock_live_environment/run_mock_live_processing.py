@@ -8,8 +8,6 @@ it will be used in the end.
 
 import copy
 import logging
-import pathlib
-import re
 import time
 
 import obspy
@@ -18,7 +16,6 @@ import yaml
 
 # Import from the DUGSeis library.
 from dug_seis.project.project import DUGSeisProject
-from dug_seis.waveform_handler.waveform_handler import FILENAME_REGEX
 from dug_seis import util
 
 from dug_seis.event_processing.detection.dug_trigger import dug_trigger
@@ -169,10 +166,6 @@ def launch_processing(project):
 with open("./live_processing_example.yaml", "r") as fh:
     yaml_template = yaml.load(fh, Loader=yaml.SafeLoader)
 
-all_folders = [
-    pathlib.Path(i).absolute() for i in yaml_template["paths"]["asdf_folders"]
-]
-
 ping_interval_in_seconds = 2.5
 
 while True:
@@ -193,16 +186,12 @@ while True:
 
 launch_processing(project=project)
 
-# These files have already been processed.
-already_processed_files = set([p.absolute() for p in project.waveforms._files.keys()])
-
 # Monitor the folders and launch the processing again.
 while True:
-    all_available_files = set()
-    for p in all_folders:
-        all_available_files = all_available_files.union(p.glob("*.h5"))
-
-    new_files = all_available_files.difference(already_processed_files)
+    # Only new files are indexed - the existing index is extended in place.
+    # Small grace period for everything to finish copying - files modified
+    # more recently are picked up the next time around.
+    new_files = project.waveforms.refresh(min_file_age_in_seconds=0.25)["added"]
     if not new_files:
         logger.info(
             "No new files yet - trying again in "
@@ -211,26 +200,12 @@ while True:
         time.sleep(ping_interval_in_seconds)
         continue
 
-    starttimes = []
-    endtimes = []
-    for f in new_files:
-        m = re.match(FILENAME_REGEX, f.stem)
-        if not m:
-            continue
-        g = m.groups()
-        s = f.stat()
-
-        starttimes.append(obspy.UTCDateTime(*[int(i) for i in g[:7]]))
-        endtimes.append(obspy.UTCDateTime(*[int(i) for i in g[7:]]))
-
-    config = copy.deepcopy(yaml_template)
-    config["temporal_range"]["start_time"] = min(starttimes)
-    config["temporal_range"]["end_time"] = max(endtimes)
-    # Small grace period for everything to finish copying.
-    time.sleep(0.25)
-    project = DUGSeisProject(config=config)
-    launch_processing(project=project)
-
-    already_processed_files = already_processed_files.union(
-        set([p.absolute() for p in project.waveforms._files.keys()])
+    # Only process the time span of the new files.
+    files = [project.waveforms._files[f] for f in new_files]
+    project.config["temporal_range"]["start_time"] = obspy.UTCDateTime(
+        ns=min(f["start_time_ns"] for f in files)
     )
+    project.config["temporal_range"]["end_time"] = obspy.UTCDateTime(
+        ns=max(f["end_time_ns"] for f in files)
+    )
+    launch_processing(project=project)
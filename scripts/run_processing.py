@@ -29,16 +29,13 @@ logger = logging.getLogger(__name__)
 # Load the DUGSeis project.
 project = DUGSeisProject(config="dug_seis_example.yaml")
 
-# Helper function to compute intervals over the project.
-intervals = util.compute_intervals(
-    project=project, interval_length_in_seconds=5, interval_overlap_in_seconds=0.1
-)
-
 total_event_count = 0
 
-for interval_start, interval_end in tqdm.tqdm(intervals):
-    # Run the trigger only on a few waveforms.
-    st_triggering = project.waveforms.get_waveforms(
+# Loop over intervals and run the trigger only on a few waveforms. The
+# waveforms of the next interval are read in the background while the current
+# one is being processed.
+for interval_start, interval_end, st_triggering in tqdm.tqdm(
+    project.waveforms.iter_intervals(
         channel_ids=[
             "GRM.001.001.001",
             "GRM.016.001.001",
@@ -47,10 +44,20 @@ for interval_start, interval_end in tqdm.tqdm(intervals):
             "GRM.019.001.001",
             "GRM.020.001.001",
         ],
-        start_time=interval_start,
-        end_time=interval_end,
+        interval_length_in_seconds=5,
+        interval_overlap_in_seconds=0.1,
+        prefetch=1,
+        # Optionally skip intervals in which the RMS amplitude of all given
+        # channels stays below a multiple of their noise level. This only
+        # uses the index so quiet intervals are never read.
+        # quiet_thresholds={
+        #     k: 3.0 * v
+        #     for k, v in project.waveforms.get_noise_levels(
+        #         channel_ids=["GRM.001.001.001", "GRM.016.001.001"]
+        #     ).items()
+        # },
     )
-
+):
     # Standard DUGSeis trigger.
     detected_events = dug_trigger(
         st=st_triggering,